@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import asyncio
 import typing
 from memory.memory import Message
 
@@ -16,7 +17,15 @@ class AbstractAPI(ABC):
         pass
 
     @abstractmethod
-    async def get_response(self, s: str, stop: typing.List[str] | None = None, options: dict[str, typing.Any] | None = None) -> str:
+    async def get_response(self,
+                           s: str,
+                           stop: typing.List[str] | None = None,
+                           options: dict[str, typing.Any] | None = None,
+                           *,
+                           affinity: typing.Hashable | None = None) -> str:
+        """
+        :param affinity: See get_response_structured
+        """
         pass
 
     @abstractmethod
@@ -25,22 +34,96 @@ class AbstractAPI(ABC):
                                       history: typing.List[Message] | None = None,
                                       indexes: typing.List[int] | None = None,
                                       *,
-                                      options: dict[str, typing.Any] | None = None) -> str:
+                                      options: dict[str, typing.Any] | None = None,
+                                      affinity: typing.Hashable | None = None) -> str:
+        """
+        :param affinity: A key (e.g. the channel) for APIs that route requests between servers, so requests with the
+        same key go to the same server. APIs with one server ignore it
+        """
         pass
 
+    async def get_response_structured_stream(self,
+                                             message: str,
+                                             history: typing.List[Message] | None = None,
+                                             indexes: typing.List[int] | None = None,
+                                             *,
+                                             options: dict[str, typing.Any] | None = None,
+                                             affinity: typing.Hashable | None = None) -> typing.AsyncIterator[str]:
+        """
+        Streams a response in chunks as it is generated. Takes the same arguments as get_response_structured.
+
+        Override this if your API supports streaming. By default, the whole response is yielded as a single chunk.
+
+        :return: An async iterator of text chunks that make up the response when joined
+        """
+        yield await self.get_response_structured(message, history, indexes, options=options, affinity=affinity)
+
     @abstractmethod
     async def count_tokens(self, text: Message) -> int:
         """
         Returns the token count of a string using the chosen API's tokenizer.
 
         Implement this method if you want your API to access stored token counts in memory.
-        Otherwise, ignore or just return 0.
+        Otherwise, ignore or just return 0. Prefer a local tokenizer when one is available, since this is called for
+        every stored message.
 
         :param text: The text to count tokens
         :return:
         """
         return 0
 
+    def history_token_budget(self, message: str) -> int | None:
+        """
+        The number of tokens of history that fit in a prompt along with a message. Memories use it to skip history
+        that would be cut anyway.
+
+        :param message: The new message
+        :return: The budget, or None if there isn't a limit
+        """
+        return None
+
+    @property
+    def history_trim_chunk(self) -> int:
+        """
+        How many tokens of history to drop at once when the budget is reached. See
+        AbstractMemory.get_related_history. 0 trims one message at a time.
+        """
+        return 0
+
+    def estimate_generation_time(self, message: str) -> float | None:
+        """
+        How long answering a message is expected to take, for telling queued users how long they'll wait
+
+        :param message: The new message
+        :return: Seconds, or None if the API can't tell
+        """
+        return None
+
+    async def count_tokens_many(self, messages: typing.List[Message], max_concurrency: int = 4) -> typing.List[int]:
+        """
+        Returns the token counts of several messages, in the same order.
+
+        By default, this calls count_tokens for each message with at most max_concurrency calls running at once.
+        Override it if your API can count several texts in one request.
+
+        :param messages: The messages to count
+        :param max_concurrency: The most count_tokens calls to run at the same time
+        :return: The token counts
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def count(message: Message) -> int:
+            async with semaphore:
+                return await self.count_tokens(message)
+
+        return list(await asyncio.gather(*[count(msg) for msg in messages]))
+
+    def save(self) -> None:
+        """
+        Persists any state the API keeps between runs. Called at shutdown.
+        """
+        pass
+
     @staticmethod
     def estimate_tokens(text: str, method: typing.Literal['chars', 'words', 'avg'] = 'avg') -> int:
         # Might want to look into tiktoken to estimate tokens
@@ -0,0 +1,153 @@
+import logging
+import time
+import typing
+
+
+class TokenBucket:
+    """
+    A token bucket measured in generated tokens. It refills continuously up to its capacity.
+
+    Spending is allowed to go below zero, since the cost of a generation is only known after it's done.
+    The debt has to be refilled before the bucket admits anything again.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        """
+        :param capacity: The most tokens the bucket can hold (the burst size)
+        :param refill_rate: Tokens added per second
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.refill_rate)
+        self.last = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def is_full(self) -> bool:
+        return self.available() >= self.capacity
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def time_until_available(self) -> float:
+        """
+        :return: Seconds until the bucket can admit a request again
+        """
+        tokens = self.available()
+        if tokens > 0:
+            return 0.0
+        if self.refill_rate <= 0:
+            return float('inf')
+        return (-tokens + 1) / self.refill_rate
+
+
+class AdmissionController:
+    """
+    Decides whether a message gets a generation at all, so work can be refused cheaply when the backend falls behind.
+
+    A message is refused when too many requests are already waiting, or when its user or guild has spent their token
+    budget. Budgets are token buckets that refill over time. A rate of None disables that limit.
+    """
+
+    BUSY_MESSAGE = '[Too many messages are waiting for a response. Try again in a moment]'
+
+    def __init__(self,
+                 *,
+                 max_queue_depth: int | None = None,
+                 user_rate: float | None = None,
+                 user_burst: float = 0,
+                 guild_rate: float | None = None,
+                 guild_burst: float = 0,
+                 prune_size: int = 1000):
+        """
+        :param max_queue_depth: Refuse new messages once this many are waiting. Unlimited if None
+        :param user_rate: Generated tokens per second each user may use
+        :param user_burst: The most tokens a user can save up. Must be positive if user_rate is set
+        :param guild_rate: Generated tokens per second each guild may use
+        :param guild_burst: The most tokens a guild can save up. Must be positive if guild_rate is set
+        :param prune_size: Number of stored buckets that triggers dropping the full (idle) ones
+        """
+        # An empty bucket never admits anything, so every message would be refused
+        if user_rate is not None and user_burst <= 0:
+            raise ValueError('A user token rate needs a positive user burst')
+        if guild_rate is not None and guild_burst <= 0:
+            raise ValueError('A guild token rate needs a positive guild burst')
+
+        self.logger = logging.getLogger(__name__)
+        self.max_queue_depth = max_queue_depth
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.prune_size = prune_size
+
+        self._user_buckets: dict[tuple[int, str], TokenBucket] = {}
+        self._guild_buckets: dict[int, TokenBucket] = {}
+
+    def admit(self, guild_id: int, user: str, queue_depth: int = 0) -> str | None:
+        """
+        Checks whether a message should be answered
+
+        :param guild_id: The guild the message came from
+        :param user: The user that sent the message
+        :param queue_depth: The number of messages already waiting for a response
+        :return: None if admitted, otherwise the reply to send instead
+        """
+        if self.max_queue_depth is not None and queue_depth >= self.max_queue_depth:
+            self.logger.info(f'Refusing message, queue depth is {queue_depth}')
+            return self.BUSY_MESSAGE
+
+        for bucket, name in ((self._user_bucket(guild_id, user), 'Your'),
+                             (self._guild_bucket(guild_id), 'This server\'s')):
+            if bucket is None:
+                continue
+            wait = bucket.time_until_available()
+            if wait > 0:
+                self.logger.info(f'Refusing message from {user} in guild {guild_id}, token budget spent')
+                return f'[{name} token budget is used up. Try again in {int(wait) + 1} seconds]'
+        return None
+
+    def charge(self, guild_id: int, user: str, tokens: float) -> None:
+        """
+        Spends generated tokens from the user's and guild's budgets
+
+        :param guild_id: The guild the message came from
+        :param user: The user that sent the message
+        :param tokens: The number of tokens generated for them
+        """
+        for bucket in (self._user_bucket(guild_id, user), self._guild_bucket(guild_id)):
+            if bucket is not None:
+                bucket.consume(tokens)
+
+        if len(self._user_buckets) + len(self._guild_buckets) > self.prune_size:
+            self._prune()
+
+    def _user_bucket(self, guild_id: int, user: str) -> TokenBucket | None:
+        if self.user_rate is None:
+            return None
+        key = (guild_id, user)
+        if key not in self._user_buckets:
+            self._user_buckets[key] = TokenBucket(self.user_burst, self.user_rate)
+        return self._user_buckets[key]
+
+    def _guild_bucket(self, guild_id: int) -> TokenBucket | None:
+        if self.guild_rate is None:
+            return None
+        if guild_id not in self._guild_buckets:
+            self._guild_buckets[guild_id] = TokenBucket(self.guild_burst, self.guild_rate)
+        return self._guild_buckets[guild_id]
+
+    def _prune(self) -> None:
+        # A full bucket is the same as a new one, so it doesn't need to be kept
+        for buckets in (self._user_buckets, self._guild_buckets):
+            buckets: dict[typing.Hashable, TokenBucket]
+            for key in [k for k, b in buckets.items() if b.is_full()]:
+                del buckets[key]
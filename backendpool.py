@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+import typing
+import koboldai
+
+T = typing.TypeVar('T')
+
+
+class Backend:
+    """
+    One KoboldCpp server in a BackendPool
+    """
+
+    def __init__(self, url: str, client: koboldai.Client | None = None):
+        self.url = url
+        self.client = client if client is not None else koboldai.Client(url)
+        self.healthy = True  # Assumed until the first probe says otherwise
+        self.outstanding = 0  # Requests in flight
+        self.requests = 0
+        self.failures = 0
+        self.model: str | None = None
+        self.version: str | None = None
+        self.max_context_length: int | None = None
+        self.max_length: int | None = None
+        self.last_probe = float('-inf')
+        self.limits_checked = float('-inf')
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'model': self.model,
+            'version': self.version,
+            'max_context_length': self.max_context_length,
+            'max_length': self.max_length,
+            'breaker': self.client.breaker.state,
+            'throughput': self.client.throughput,
+            **{f'http_{key}': value for key, value in self.client.connections.stats(self.url).items()},
+            **self.client.metrics
+        }
+
+
+class BackendPool:
+    """
+    Spreads requests over several KoboldCpp servers.
+
+    Requests go to the healthy backend with the fewest requests in flight. Requests with an affinity key (e.g. a
+    channel ID) stick to the backend they were first sent to, since that backend has the key's previous prompt
+    cached and only needs to process the new part. Keys move to another backend only if theirs becomes unhealthy.
+
+    A backend is skipped while its circuit breaker is open, which happens after several failed requests in a row, and
+    its probes fail fast until the breaker lets a trial through. A backend is also marked unhealthy when a probe
+    (version and model) fails, and gets no new requests until one succeeds again. Probes also read the backend's
+    context size and generation length, again whenever the model changes or limits_ttl has passed. Requests already in
+    flight are left to finish.
+
+    Cheap requests can be hedged: if the first backend hasn't answered within hedge_delay seconds, the same request is
+    sent to another backend and whichever answers first is used.
+    """
+
+    def __init__(self,
+                 urls: typing.List[str],
+                 *,
+                 probe_interval: float = 30.0,
+                 max_affinity_keys: int = 10000,
+                 retry: koboldai.RetryPolicy | None = None,
+                 breaker_threshold: int = 5,
+                 breaker_reset: float = 30.0,
+                 hedge_delay: float | None = None,
+                 timeouts: koboldai.TimeoutPolicy | None = None,
+                 connections: koboldai.ConnectionPool | None = None,
+                 limits_ttl: float = 600.0):
+        """
+        :param urls: Base URLs of the KoboldCpp servers
+        :param probe_interval: Seconds between health probes of every backend
+        :param max_affinity_keys: Most affinity keys remembered. The oldest are forgotten first
+        :param retry: Retries of idempotent requests, shared by every backend
+        :param breaker_threshold: Failures in a row that open a backend's circuit breaker
+        :param breaker_reset: Seconds a backend's breaker stays open before a trial request
+        :param hedge_delay: Seconds to wait on a hedged request before sending it to a second backend. None disables
+        hedging
+        :param timeouts: Request timeouts, shared by every backend. Each backend measures its own throughput
+        :param connections: HTTP clients for the backends. Defaults to ConnectionPool.default(), which is shared with
+        every other pool
+        :param limits_ttl: Seconds before a backend's context size and generation length are read again
+        """
+        if len(urls) == 0:
+            raise ValueError('A backend pool needs at least one URL')
+        self.logger = logging.getLogger(__name__)
+        self.connections = connections if connections is not None else koboldai.ConnectionPool.default()
+        self.backends = [Backend(url, koboldai.Client(url, retry=retry,
+                                                      breaker=koboldai.CircuitBreaker(breaker_threshold,
+                                                                                      breaker_reset),
+                                                      timeouts=timeouts,
+                                                      connections=self.connections))
+                         for url in urls]
+        self.probe_interval = probe_interval
+        self.max_affinity_keys = max_affinity_keys
+        self.hedge_delay = hedge_delay
+        self.limits_ttl = limits_ttl
+        self.metrics: collections.Counter[str] = collections.Counter()  # hedges and hedge_wins
+
+        self._affinity: dict[typing.Hashable, Backend] = {}  # Insertion ordered, oldest first
+        self._next = 0  # Breaks ties between equally loaded backends
+        self._task: asyncio.Task | None = None
+
+    @property
+    def healthy(self) -> typing.List[Backend]:
+        return [backend for backend in self.backends if backend.healthy and not backend.client.breaker.is_open]
+
+    def pick(self, affinity: typing.Hashable | None = None) -> Backend:
+        """
+        Chooses the backend for a request
+
+        :param affinity: Requests with the same key go to the same backend while it's healthy
+        :return: The backend
+        """
+        if affinity is not None:
+            backend = self._affinity.get(affinity)
+            if backend is not None and backend.healthy and not backend.client.breaker.is_open:
+                return backend
+
+        healthy = self.healthy
+        if len(healthy) == 0:
+            raise RuntimeError('No KoboldCpp server is available')
+        # Least outstanding requests, rotating the starting point so ties are spread out
+        self._next = (self._next + 1) % len(healthy)
+        backend = min(healthy[self._next:] + healthy[:self._next], key=lambda b: b.outstanding)
+
+        if affinity is not None:
+            self._affinity.pop(affinity, None)
+            self._affinity[affinity] = backend
+            if len(self._affinity) > self.max_affinity_keys:
+                del self._affinity[next(iter(self._affinity))]
+        return backend
+
+    @contextlib.asynccontextmanager
+    async def use(self, affinity: typing.Hashable | None = None) -> typing.AsyncIterator[Backend]:
+        """
+        Picks a backend and counts a request as in flight on it. A RuntimeError raised inside counts as a failure of the
+        backend, unless it's a RequestRejectedError, which means the request was bad rather than the backend. Whether
+        the backend is skipped is left to its client's circuit breaker, so one timeout doesn't take it out of the pool
+
+        :param affinity: See pick()
+        :return: An async context manager giving the backend
+        """
+        backend = self.pick(affinity)
+        backend.outstanding += 1
+        backend.requests += 1
+        try:
+            yield backend
+        except koboldai.RequestRejectedError:
+            raise
+        except RuntimeError:
+            backend.failures += 1
+            raise
+        finally:
+            backend.outstanding -= 1
+
+    def limits(self) -> tuple[int, int] | None:
+        """
+        The limits every healthy backend (or every backend, if none are healthy) can handle
+
+        :return: The smallest context size and generation length, or None if no backend has been probed yet
+        """
+        known = [backend for backend in (self.healthy or self.backends)
+                 if backend.max_context_length is not None and backend.max_length is not None]
+        if len(known) == 0:
+            return None
+        return min(b.max_context_length for b in known), min(b.max_length for b in known)
+
+    def estimate_duration(self, prompt_tokens: int, max_length: int) -> float:
+        """
+        :param prompt_tokens: Size of the prompt
+        :param max_length: Most tokens to generate
+        :return: Expected seconds for a generation, averaged over the healthy backends (or all if none are)
+        """
+        backends = self.healthy or self.backends
+        return sum(b.client.estimate_duration(prompt_tokens, max_length) for b in backends) / len(backends)
+
+    async def hedged(self, call: typing.Callable[[Backend], typing.Awaitable[T]]) -> T:
+        """
+        Makes a request, sending it to a second backend too if the first is slow. Only for cheap requests that are
+        safe to send twice, like token counts
+
+        :param call: Makes the request on the backend it's given
+        :return: The first successful result
+        """
+        async def attempt() -> T:
+            async with self.use() as backend:
+                return await call(backend)
+
+        if self.hedge_delay is None or len(self.healthy) < 2:
+            return await attempt()
+
+        tasks = [asyncio.ensure_future(attempt())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if len(done) == 0:
+                # The first backend is already counted as outstanding, so this goes to another one
+                self.metrics['hedges'] += 1
+                tasks.append(asyncio.ensure_future(attempt()))
+
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.metrics['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def probe(self, backend: Backend) -> bool:
+        """
+        Checks that a backend answers and which model it has loaded
+
+        :param backend: The backend
+        :return: Whether it's healthy
+        """
+        try:
+            backend.version = await backend.client.version()
+            model = await backend.client.model()
+            now = time.monotonic()
+            if model != backend.model or now - backend.limits_checked >= self.limits_ttl:
+                # Set both together, so a failed second request can't leave them mismatched
+                max_context_length = await backend.client.max_context_length()
+                max_length = await backend.client.max_length()
+                backend.max_context_length, backend.max_length = max_context_length, max_length
+                backend.limits_checked = now
+                self.logger.info(f'Backend {backend.url} has {model} loaded, with a context of '
+                                 f'{backend.max_context_length} tokens and max_length {backend.max_length}')
+            backend.model = model
+        except RuntimeError as ex:
+            if backend.healthy:
+                self.logger.warning(f'Backend {backend.url} failed its health probe: {ex}')
+            backend.healthy = False
+        else:
+            if not backend.healthy:
+                self.logger.info(f'Backend {backend.url} is healthy again')
+            backend.healthy = True
+        backend.last_probe = time.monotonic()
+        return backend.healthy
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(*[self.probe(backend) for backend in self.backends])
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def aclose(self) -> None:
+        """
+        Stops the probes and closes the backends' connections
+        """
+        await self.stop()
+        await self.connections.aclose()
+
+    async def __aenter__(self) -> 'BackendPool':
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def _run(self) -> None:
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.probe_interval)
+
+    def stats(self) -> typing.List[dict[str, typing.Any]]:
+        return [backend.stats() for backend in self.backends]
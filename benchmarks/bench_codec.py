@@ -0,0 +1,53 @@
+"""
+Compares encode time, decode time and size of the memory codecs on 1M messages spread over 1000 channels.
+
+Run from the repository root: python -m benchmarks.bench_codec [message count]
+"""
+import io
+import random
+import sys
+import time
+from memory.memory import Message, Role
+from memory.basic_memory import BasicMemory
+from jsoncustom.codec import JSONCodec, JSONLinesCodec, MsgpackCodec, MemoryCodec
+
+CHANNELS = 1000
+
+
+def make_memories(count: int) -> dict[str, BasicMemory]:
+    words = ['hello', 'there', 'what', 'is', 'the', 'weather', 'like', 'today', 'pizza', 'cat', 'bot', 'please']
+    rng = random.Random(0)
+    memories = {str(channel): BasicMemory() for channel in range(CHANNELS)}
+    for i in range(count):
+        content = ' '.join(rng.choices(words, k=rng.randint(3, 20)))
+        memories[str(i % CHANNELS)].add_log(Message(role=Role(i % 2), content=content, tokens=len(content) // 4))
+    return memories
+
+
+def measure(name: str, codec: MemoryCodec, memories: dict[str, BasicMemory]) -> None:
+    start = time.perf_counter()
+    data = codec.encode(memories)
+    encoded = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stream = io.BytesIO(data)
+    stream.seek(len(codec.magic))
+    count = sum(len(memory.log) for _, memory in codec.iter_decode(stream))
+    decoded = time.perf_counter() - start
+    assert count == COUNT
+
+    print(f'{name:<24} encode {encoded:6.2f}s  decode {decoded:6.2f}s  size {len(data) / 2 ** 20:7.1f} MiB')
+
+
+if __name__ == '__main__':
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f'{COUNT} messages in {CHANNELS} channels')
+    memories = make_memories(COUNT)
+    measure('json (indent=2, legacy)', JSONCodec(), memories)
+    measure('json (compact)', JSONCodec(indent=None), memories)
+    measure('jsonl (stdlib json)', JSONLinesCodec(use_orjson=False), memories)
+    measure('jsonl (orjson)', JSONLinesCodec(), memories)
+    try:
+        measure('msgpack', MsgpackCodec(), memories)
+    except ImportError:
+        print('msgpack                  not installed')
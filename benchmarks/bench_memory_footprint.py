@@ -0,0 +1,65 @@
+"""
+Compares the memory used by 1M stored messages as dict-based objects, __slots__ Message objects and a ColumnarLog.
+
+Run from the repository root: python -m benchmarks.bench_memory_footprint [message count]
+"""
+import random
+import sys
+import time
+import tracemalloc
+from memory.memory import Message, Role
+from memory.basic_memory import BasicMemory
+
+
+class DictMessage:
+    # What Message looked like before it used __slots__
+    def __init__(self, *, role: Role, content: str, tokens: int = 0):
+        self.role = role
+        self.content = content
+        self.tokens = tokens
+
+
+def make_contents(count: int) -> list[str]:
+    words = ['hello', 'there', 'what', 'is', 'the', 'weather', 'like', 'today', 'pizza', 'cat', 'bot', 'please']
+    rng = random.Random(0)
+    return [' '.join(rng.choices(words, k=rng.randint(3, 20))) for _ in range(count)]
+
+
+def measure(name: str, build) -> None:
+    # Contents are made while tracing so the strings the store keeps alive are counted
+    tracemalloc.start()
+    contents = make_contents(COUNT)
+    start = time.perf_counter()
+    stored = build(contents)
+    elapsed = time.perf_counter() - start
+    del contents  # Only count what the store keeps alive
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<22} {current / 2 ** 20:8.1f} MiB  {current / COUNT:6.1f} B/message  built in {elapsed:.2f}s')
+    del stored
+
+
+def dict_objects(contents: list[str]):
+    return [DictMessage(role=Role(i % 2), content=c, tokens=len(c) // 4) for i, c in enumerate(contents)]
+
+
+def slots_memory(contents: list[str]):
+    mem = BasicMemory()
+    for i, c in enumerate(contents):
+        mem.add_log(Message(role=Role(i % 2), content=c, tokens=len(c) // 4))
+    return mem
+
+
+def columnar_memory(contents: list[str]):
+    mem = BasicMemory(columnar=True)
+    for i, c in enumerate(contents):
+        mem.add_log(Message(role=Role(i % 2), content=c, tokens=len(c) // 4))
+    return mem
+
+
+if __name__ == '__main__':
+    COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f'{COUNT} messages')
+    measure('dict objects (list)', dict_objects)
+    measure('BasicMemory (slots)', slots_memory)
+    measure('BasicMemory columnar', columnar_memory)
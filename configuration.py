@@ -1,5 +1,6 @@
 import logging
 import json
+import copy
 from typing import Any, List
 
 
@@ -9,6 +10,37 @@ class Fields:
     Owner = 'owner'
     DevGuild = 'development_guild'
     MaxChannels = 'channels_per_guild'
+    MaxConcurrentGenerations = 'max_concurrent_generations'
+    SchedulingPolicy = 'scheduling_policy'
+    MaxQueueDepth = 'max_queue_depth'
+    UserTokenRate = 'user_token_rate'
+    UserTokenBurst = 'user_token_burst'
+    GuildTokenRate = 'guild_token_rate'
+    GuildTokenBurst = 'guild_token_burst'
+    TokenizerPath = 'tokenizer_path'
+    TokenCacheSize = 'token_cache_size'
+    MemoryStorage = 'memory_storage'
+    MemoryTailTokens = 'memory_tail_tokens'
+    MaxResidentMemories = 'max_resident_memories'
+    SnapshotInterval = 'snapshot_interval'
+    MemoryCodec = 'memory_codec'
+    CoalesceWindow = 'coalesce_window'
+    BackendURLs = 'backend_urls'
+    BackendProbeInterval = 'backend_probe_interval'
+    RequestAttempts = 'request_attempts'
+    RetryBaseDelay = 'retry_base_delay'
+    BreakerThreshold = 'breaker_threshold'
+    BreakerResetTimeout = 'breaker_reset_timeout'
+    HedgeDelay = 'hedge_delay'
+    TokenCountTimeout = 'tokencount_timeout'
+    MaxGenerateTimeout = 'max_generate_timeout'
+    QueueNotice = 'queue_notice_seconds'
+    HTTPMaxConnections = 'http_max_connections'
+    HTTPMaxKeepalive = 'http_max_keepalive'
+    HTTPKeepaliveExpiry = 'http_keepalive_expiry'
+    HTTP2 = 'http2'
+    BackendLimitsTTL = 'backend_limits_ttl'
+    ResponseLength = 'response_length'
 
 
 class Configuration:
@@ -18,6 +50,38 @@ class Configuration:
         Fields.DevGuild: None,
         Fields.Token: None,
         Fields.MaxChannels: 2,
+        Fields.MaxConcurrentGenerations: 1,
+        Fields.SchedulingPolicy: 'round_robin',
+        # Admission control is off until limits are set
+        Fields.MaxQueueDepth: 0,
+        Fields.UserTokenRate: 0,
+        Fields.UserTokenBurst: 0,
+        Fields.GuildTokenRate: 0,
+        Fields.GuildTokenBurst: 0,
+        Fields.TokenizerPath: None,
+        Fields.TokenCacheSize: 10000,
+        Fields.MemoryStorage: 'sqlite',
+        Fields.MemoryTailTokens: 4096,
+        Fields.MaxResidentMemories: 500,
+        Fields.SnapshotInterval: 300,
+        Fields.MemoryCodec: 'jsonl',
+        Fields.CoalesceWindow: 0,
+        Fields.BackendURLs: ['http://localhost:5001'],
+        Fields.BackendProbeInterval: 30,
+        Fields.RequestAttempts: 3,
+        Fields.RetryBaseDelay: 0.25,
+        Fields.BreakerThreshold: 5,
+        Fields.BreakerResetTimeout: 30,
+        Fields.HedgeDelay: 0,
+        Fields.TokenCountTimeout: 5,
+        Fields.MaxGenerateTimeout: 600,
+        Fields.QueueNotice: 15,
+        Fields.HTTPMaxConnections: 10,
+        Fields.HTTPMaxKeepalive: 5,
+        Fields.HTTPKeepaliveExpiry: 30,
+        Fields.HTTP2: False,
+        Fields.BackendLimitsTTL: 600,
+        Fields.ResponseLength: 0,
         Fields.Guilds: {}
     }
 
@@ -43,6 +107,40 @@ class Configuration:
             'channels': {}
         }
 
+    def guild_weight(self, guild_id: int) -> int:
+        """
+        The share of generation time a guild gets when the scheduler uses weighted fair queuing. Defaults to 1
+
+        :param guild_id: The guild's ID
+        :return: The guild's weight
+        """
+        guild = self.options[Fields.Guilds].get(str(guild_id), {})
+        return int(guild.get('weight', 1))
+
+    def guild_usage(self, guild_id: int) -> dict[str, int]:
+        """
+        The guild's consumption counters, saved with the rest of the configuration
+
+        :param guild_id: The guild's ID
+        :return: A dictionary with the number of responses, generated tokens and refused messages
+        """
+        guild = self.options[Fields.Guilds][str(guild_id)]
+        if 'usage' not in guild:
+            guild['usage'] = {
+                'responses': 0,
+                'generated_tokens': 0,
+                'refused': 0
+            }
+        return guild['usage']
+
+    def add_guild_usage(self, guild_id: int, tokens: int) -> None:
+        usage = self.guild_usage(guild_id)
+        usage['responses'] += 1
+        usage['generated_tokens'] += tokens
+
+    def add_guild_refusal(self, guild_id: int) -> None:
+        self.guild_usage(guild_id)['refused'] += 1
+
     def get_channels(self, guild_id: int) -> dict[str, Any]:
         return self.options[Fields.Guilds][str(guild_id)]['channels']
 
@@ -125,9 +223,21 @@ class Configuration:
         self.logger.info(f'Saving configuration to file: {filename}')
         self.logger.debug(str(self.options))
         file = open(filename, 'w')
-        file.write(json.dumps(self.options, indent=2, separators=(', ', ': ')))
+        file.write(self.serialize(self.options))
         file.close()
 
+    def snapshot(self) -> dict:
+        """
+        A copy of the options that later changes won't affect, so it can be saved from another thread
+
+        :return: The copied options
+        """
+        return copy.deepcopy(self.options)
+
+    @staticmethod
+    def serialize(options: dict) -> str:
+        return json.dumps(options, indent=2, separators=(', ', ': '))
+
     def verify_types(self):
         try:
             assert type(self.options[Fields.Owner]) == str, 'Owner ID needs to be a string'
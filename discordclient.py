@@ -1,12 +1,15 @@
 import logging
 import typing
 import asyncio
+import time
 from collections.abc import Callable
 import discord
 from discord.ext import commands
 from discord import app_commands
 from configuration import Configuration, Fields
-from discordhandlers.abstracthandler import Handler, BasicMessage
+from discordhandlers.abstracthandler import Handler, BasicMessage, ReplacingChunk
+from snapshot import Snapshotter
+from backendpool import BackendPool
 
 # Maybe set roles for command usage
 
@@ -22,16 +25,50 @@ class DiscordClient(commands.Bot):
                  handler: Handler,
                  config: Configuration,
                  intents: discord.flags.Intents = None,
+                 stream: bool = True,
+                 edit_interval: float = 1.0,
+                 snapshotter: Snapshotter | None = None,
+                 backend_pool: BackendPool | None = None,
+                 queue_notice: float | None = None,
                  **kwargs):
+        """
+        :param handler: Handles the messages from allowed channels
+        :param config: The bot configuration
+        :param intents: Discord intents. Uses get_intents() if not specified
+        :param stream: Send responses while they are generated, editing the message as more text arrives
+        :param edit_interval: Minimum number of seconds between edits of a streamed message (Discord rate limits edits)
+        :param snapshotter: Saves memories and configuration periodically while the bot runs
+        :param backend_pool: Its health probes run while the bot runs, and its connections are closed at shutdown
+        :param queue_notice: Tell users their message is queued when the estimated wait is at least this many seconds.
+        Never if None
+        """
         super().__init__(command_prefix='$',
                          intents=get_intents() if intents is None else intents,  # Default intents if none specified
                          **kwargs)
         self.handler = handler
         self.logger = logging.getLogger(__name__)
         self.config = config
+        self.stream = stream
+        self.edit_interval = edit_interval
+        self.snapshotter = snapshotter
+        self.backend_pool = backend_pool
+        self.queue_notice = queue_notice
 
         asyncio.run(self.add_cog(Commands(self)))
 
+    async def setup_hook(self) -> None:
+        if self.snapshotter is not None:
+            self.snapshotter.start()
+        if self.backend_pool is not None:
+            self.backend_pool.start()
+
+    async def close(self) -> None:
+        if self.snapshotter is not None:
+            await self.snapshotter.stop()
+        if self.backend_pool is not None:
+            await self.backend_pool.aclose()
+        await super().close()
+
     async def on_ready(self) -> None:
         for guild in self.guilds:
             self.config.add_guild(guild.id, guild.name)
@@ -52,10 +89,49 @@ class DiscordClient(commands.Bot):
             self.logger.info('Message is None')
             return
         msg = BasicMessage(message.content, user=message.author.name, channel_id=message.channel.id, guild_id=message.guild.id)
+        if self.queue_notice is not None:
+            wait = self.handler.estimated_wait(msg)
+            if wait is not None and wait >= self.queue_notice:
+                await message.channel.send(f'[Queued. Estimated wait: about {round(wait)} seconds]')
+        if self.stream:
+            await self.send_streamed(message.channel, self.handler.respond_stream(msg))
+            return
         response = await self.handler.respond(msg)
         if response is not None:
             await message.channel.send(response)
 
+    async def send_streamed(self, channel: discord.abc.Messageable, chunks: typing.AsyncIterator[str]) -> None:
+        """
+        Sends a message as soon as the first visible chunk arrives, then edits it as more chunks come in.
+        Edits are throttled to one per edit_interval, with a final edit once the stream is done. A ReplacingChunk
+        replaces the text shown so far.
+
+        :param channel: The channel to send to
+        :param chunks: The response chunks
+        """
+        sent: discord.Message | None = None
+        text = ''
+        shown = ''
+        last_edit = 0.0
+        async for chunk in chunks:
+            text = chunk if isinstance(chunk, ReplacingChunk) else text + chunk
+            if len(text.strip()) == 0:
+                # Discord doesn't allow empty messages
+                continue
+            now = time.monotonic()
+            if sent is None:
+                self.logger.debug('Sending first chunk')
+                sent = await channel.send(text)
+                shown = text
+                last_edit = now
+            elif now - last_edit >= self.edit_interval:
+                await sent.edit(content=text)
+                shown = text
+                last_edit = now
+
+        if sent is not None and shown != text:
+            await sent.edit(content=text)
+
 
 class Commands(commands.Cog):
     def __init__(self, bot: DiscordClient):
@@ -112,6 +188,20 @@ class Commands(commands.Cog):
                 choices.append(app_commands.Choice(name=opt, value=opt))
         return choices
 
+    @app_commands.command(name='set-memory', description='Change how the bot remembers this channel\'s history.')
+    @app_commands.default_permissions(manage_channels=True)
+    async def set_memory(self, interaction: discord.Interaction, memory_type: str):
+        msg = await self.bot.handler.set_memory_type(memory_type, interaction.channel_id)
+        await interaction.response.send_message(msg, ephemeral=True)  # noqa
+
+    @set_memory.autocomplete('memory_type')
+    async def set_memory_autocomplete(self,
+                                      interaction: discord.Interaction,
+                                      current: str
+                                      ) -> typing.List[app_commands.Choice[str]]:
+        types = await self.bot.handler.get_memory_types()
+        return [app_commands.Choice(name=t, value=t) for t in types if current in t]
+
     @app_commands.command(name='sync', description='Syncs the bots commands with the current guild, or globally if True.')
     @app_commands.rename(globally='global')
     @app_commands.default_permissions(manage_guild=True)
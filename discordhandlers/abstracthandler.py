@@ -11,6 +11,14 @@ class BasicMessage:
         self.guild_id = guild_id
 
 
+class ReplacingChunk(str):
+    """
+    A chunk from respond_stream() that replaces everything streamed before it instead of being added to it, e.g. an
+    error after part of the response was already shown
+    """
+    pass
+
+
 # This class exists solely to abstract away the implementation of a handler from discordclient.py
 class Handler(ABC):
 
@@ -18,6 +26,26 @@ class Handler(ABC):
     async def respond(self, message: BasicMessage) -> str | None:
         pass
 
+    async def respond_stream(self, message: BasicMessage) -> typing.AsyncIterator[str]:
+        """
+        Streams the response to a message in chunks. The chunks joined together form the full response.
+
+        By default, the whole response from respond() is yielded at once.
+        """
+        response = await self.respond(message)
+        if response is not None:
+            yield response
+
+    def estimated_wait(self, message: BasicMessage) -> float | None:
+        """
+        How long a new message would wait for its answer, so the user can be told when it's queued.
+        None (unknown) by default.
+
+        :param message: The new message
+        :return: Seconds, or None if unknown
+        """
+        return None
+
     @abstractmethod
     async def get_options(self) -> typing.List[str]:
         pass
@@ -29,3 +57,12 @@ class Handler(ABC):
     @abstractmethod
     async def get_default_options(self) -> dict[str, typing.Any]:
         pass
+
+    async def get_memory_types(self) -> typing.List[str]:
+        """
+        The names of the memory types a channel can be switched to. None by default.
+        """
+        return []
+
+    async def set_memory_type(self, memory_type: str, channel_id: int) -> str | None:
+        return 'Memory types can\'t be changed'
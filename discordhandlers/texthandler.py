@@ -1,31 +1,80 @@
 import logging
 import asyncio
 import typing
-import json
+import collections
+import contextlib
+import concurrent.futures
+import os
+import sqlite3
 from configuration import Configuration
-from jsoncustom.memoryjson import MemoryEncoder, MemoryDecoder
+from jsoncustom.codec import MemoryCodec, JSONCodec, load_memories, iter_memories
 from AbstractAPI import AbstractAPI
-from discordhandlers.abstracthandler import BasicMessage
+from discordhandlers.abstracthandler import BasicMessage, ReplacingChunk
 from memory.memory import AbstractMemory, Message, Role
 from memory.factories.memoryfactory import MemoryFactory
 from memory.factories.factories import NoMemoryFactory  # To give a default factory if none specified
 from discordhandlers.abstracthandler import Handler
+from scheduler import GenerationScheduler
+from admission import AdmissionController
+from memory.journal import Journal
+from memory.sqlite_store import SQLiteMemoryStore
 
 
 class TextHandler(Handler):
 
+    BACKGROUND_KEY = 'background'  # Scheduler key of generations that don't answer a message
+
     def __init__(self,
                  api: AbstractAPI,
                  memory_factory_lookup: dict[str, MemoryFactory],
                  *,
                  config: Configuration,
-                 default_factory: MemoryFactory = NoMemoryFactory):
+                 default_factory: MemoryFactory = NoMemoryFactory,
+                 scheduler: GenerationScheduler | None = None,
+                 schedule_by: typing.Literal['channel', 'guild'] = 'guild',
+                 admission: AdmissionController | None = None,
+                 journal: Journal | None = None,
+                 store: SQLiteMemoryStore | None = None,
+                 max_resident: int | None = None,
+                 codec: MemoryCodec | None = None,
+                 coalesce_window: float | None = None):
+        """
+        :param api: The API used to generate responses
+        :param memory_factory_lookup: Memory factories by name, used to change a memory type at runtime
+        :param config: The bot configuration
+        :param default_factory: Creates the memory for channels that don't have one yet
+        :param scheduler: Shares generation slots fairly between channels or guilds. Generations aren't limited if None
+        :param schedule_by: Whether the scheduler queues generations per channel or per guild
+        :param admission: Refuses messages when too many are waiting or token budgets are spent. Admits all if None
+        :param journal: Saves new messages as they come in. If None, memories are only saved to memory.txt by save()
+        :param store: Keeps memories in a database and loads each channel on first use instead of all at startup
+        :param max_resident: Most memories kept in RAM. The least recently used idle ones are dropped, and loaded from
+        the store again when needed. Needs a store. No limit if None
+        :param codec: The format memory.txt is written in. Any format is read. Indented JSON if None
+        :param coalesce_window: If set, messages in a channel are collected for this many seconds, plus however long
+        the channel is busy, and answered together with one generation. Each message is answered separately if None
+        """
         self.api = api
         self.config = config
         self.logger = logging.getLogger(__name__)
         self.memory_factory_lookup = memory_factory_lookup  # Used to change a memory type at runtime
-        self.memories: dict[str, MemoryAndLock] = {}
+        self.memories: collections.OrderedDict[str, MemoryAndLock] = collections.OrderedDict()  # Oldest use first
         self.default_factory = default_factory
+        self.scheduler = scheduler
+        self.schedule_by = schedule_by
+        self.admission = admission
+        self.journal = journal
+        self._compacting: set[str] = set()  # Channels with a compaction task scheduled
+        self.store = store
+        if max_resident is not None and store is None:
+            raise ValueError('Evicting memories needs a store to load them back from')
+        self.max_resident = max_resident
+        self.codec = codec if codec is not None else JSONCodec()
+        self.coalesce_window = coalesce_window
+        # Messages waiting to be answered together, and the task that will answer them
+        self._bursts: dict[str, tuple[asyncio.Task, typing.List[BasicMessage]]] = {}
+        self._loading: dict[str, asyncio.Task] = {}  # Channels being loaded from the store
+        self._waiting = 0  # Messages waiting for their channel lock or a generation slot
 
     async def respond(self, message: BasicMessage) -> str | None:
 
@@ -46,13 +95,26 @@ class TextHandler(Handler):
         # Return None if suppressed
         # Discord client needs to handle None
 
-        async with self.lock(message.id):
+        # Checked first, so a message can't get around its sender's budget by joining someone else's burst
+        refusal = self.admit(message)
+        if refusal is not None:
+            return refusal
+
+        if self._join_burst(message):
+            # Answered along with the message that started the burst
+            return None
+
+        await self._start_burst(message)
+        async with self.generation(message):
+            message, senders = self._take_burst(message)
             try:
                 # Errors caught here and not inside the API because the messages shouldn't be saved
+                history, indexes = self.history(message)
                 msg = await self.api.get_response_structured(message.content,
-                                                             history=self.memory(message.id).log,
-                                                             indexes=self.memory(message.id).get_related_history(message.content),
-                                                             options=self.config.get_active_options(message.guild_id, message.id))
+                                                             history=history,
+                                                             indexes=indexes,
+                                                             options=self.config.get_active_options(message.guild_id, message.id),
+                                                             affinity=message.id)
             except ValueError as ex:
                 self.logger.error(repr(ex))
                 # Returned message doesn't use the error because this error shouldn't happen in the first place.
@@ -65,47 +127,402 @@ class TextHandler(Handler):
         if len(msg.strip()) == 0:
             msg = '[No response]'
 
-        # Save user message
+        self.record_usage(senders, msg)
+        self._save_turn(message, msg)
+
+        self.logger.info('Returning response')
+        return msg
+
+    async def respond_stream(self, message: BasicMessage) -> typing.AsyncIterator[str]:
+        """
+        Same as respond(), but yields the response in chunks as the API generates it.
+        Errors are yielded as a bracketed ReplacingChunk, and the turn is only saved if the generation finished.
+        """
+        refusal = self.admit(message)
+        if refusal is not None:
+            yield refusal
+            return
+
+        if self._join_burst(message):
+            return
+
+        await self._start_burst(message)
+        async with self.generation(message):
+            message, senders = self._take_burst(message)
+            msg = ''
+            try:
+                history, indexes = self.history(message)
+                async for chunk in self.api.get_response_structured_stream(message.content,
+                                                                           history=history,
+                                                                           indexes=indexes,
+                                                                           options=self.config.get_active_options(message.guild_id, message.id),
+                                                                           affinity=message.id):
+                    msg += chunk
+                    yield chunk
+            except ValueError as ex:
+                self.logger.error(repr(ex))
+                # Replaces the part already streamed, since the turn isn't saved
+                yield ReplacingChunk('[Internal error encountered during processing]')
+                return
+            except RuntimeError as ex:
+                self.logger.error(f'Encountered error while processing message {repr(message.content)}')
+                yield ReplacingChunk(f'[{str(ex)}]')
+                return
+
+            # Saved before anything else is yielded, so the channel's next message can't generate without this turn
+            empty = len(msg.strip()) == 0
+            if empty:
+                msg = '[No response]'
+            self.record_usage(senders, msg)
+            self._save_turn(message, msg)
+            if empty:
+                yield msg
+        self.logger.info('Finished streaming response')
+
+    def _join_burst(self, message: BasicMessage) -> bool:
+        """
+        Adds a message to its channel's burst, if coalescing and one is being collected
+
+        :param message: The new message
+        :return: True if the message joined a burst and needs no response of its own
+        """
+        if self.coalesce_window is None or str(message.id) not in self._bursts:
+            return False
+        task, burst = self._bursts[str(message.id)]
+        if task.done():
+            # The task that started it was cancelled or failed before answering
+            del self._bursts[str(message.id)]
+            return False
+        burst.append(message)
+        self.logger.debug(f'Message joined a burst of {len(burst)} in channel {message.id}')
+        return True
+
+    async def _start_burst(self, message: BasicMessage) -> None:
+        """
+        Starts collecting a burst with this message, and waits out the coalescing window
+        """
+        if self.coalesce_window is None:
+            return
+        self._bursts[str(message.id)] = (asyncio.current_task(), [message])
+        await asyncio.sleep(self.coalesce_window)
+
+    def _take_burst(self, message: BasicMessage) -> tuple[BasicMessage, typing.List[BasicMessage]]:
+        """
+        Ends the channel's burst. Call once the generation is about to start, so every message that came in while
+        waiting is answered by it
+
+        :param message: The message that started the burst
+        :return: The burst's messages merged into one, one per line, and the messages it was merged from
+        """
+        if str(message.id) not in self._bursts:
+            return message, [message]
+        _, burst = self._bursts.pop(str(message.id))
+        if len(burst) == 1:
+            return message, burst
+        self.logger.info(f'Answering {len(burst)} messages in channel {message.id} together')
+        return BasicMessage('\n'.join(msg.content for msg in burst),
+                            user=message.user,
+                            guild_id=message.guild_id,
+                            channel_id=message.id), burst
+
+    def _save_turn(self, message: BasicMessage, response: str) -> None:
+        """
+        Saves the user message and the response to memory right away, with estimated token counts. The exact counts
+        are filled in later by message_work()
+
+        :param message: The user's message
+        :param response: The generated response
+        """
         new_messages = [
             Message(role=Role.USER,
                     content=message.content,
-                    tokens=0),
+                    tokens=max(1, self.api.estimate_tokens(message.content)),
+                    estimated=True),
             Message(role=Role.ASSISTANT,
-                    content=msg,
-                    tokens=0)
+                    content=response,
+                    tokens=max(1, self.api.estimate_tokens(response)),
+                    estimated=True)
         ]
 
-        # Task is created and set to run, but never awaited because there is no return value
-        task = asyncio.get_event_loop().create_task(self.message_work(new_messages, message.id))
-        await asyncio.sleep(0)
+        # No await since the generation finished, so the next respond() in this channel always sees these
+        meml = self._mem_and_lock(message.id)
+        memory = meml.memory
+        stored = []
+        journal_seqs = []
+        store_seqs = []
+        for msg in new_messages:
+            memory.add_log(msg)
+            # Some memories keep their own copy (a columnar row). Its count is the one to update, and looking it up by
+            # content later could find a repeat of the same message instead
+            stored.append(memory.log[-1] if len(memory.log) > 0 else msg)
+            if self.journal is not None:
+                journal_seqs.append(self.journal.append(message.id, msg))
+            if self.store is not None:
+                store_seqs.append(self.store.append(message.id, msg))
+        self.logger.info('Messages saved to memory')
 
-        self.logger.info('Returning response')
-        return msg
+        # Every message in the memory is journaled already, so it can be compacted at any point
+        if (self.journal is not None and message.id not in self._compacting
+                and self.journal.needs_compaction(message.id)):
+            # Only one compaction per channel at a time, more turns can be saved before it gets the lock
+            self._compacting.add(message.id)
+            compaction = asyncio.get_event_loop().create_task(self.journal.compact(message.id, memory))
+            compaction.add_done_callback(lambda _: self._compacting.discard(message.id))
+
+        # Task is created and set to run, but never awaited because there is no return value. The memory stays
+        # resident until the counts are in
+        meml.users += 1
+        task = asyncio.get_event_loop().create_task(self.message_work(stored, message.id,
+                                                                      journal_seqs or None, store_seqs or None))
+
+        def counted(_: asyncio.Task) -> None:
+            meml.users -= 1
+        task.add_done_callback(counted)
 
-    async def message_work(self, msgs: typing.List[Message], memory_id: int) -> None:
-        # An async lock is used to ensure this method finishes before another respond() can run
-        async with self.lock(memory_id):
-            self.logger.info('Getting token counts')
-            task = asyncio.gather(self.api.count_tokens(msgs[0]),
-                                  self.api.count_tokens(msgs[1]))
-            for i in range(len(msgs)):
-                self.memory(memory_id).add_log(msgs[i])
-            tokens = await task
-            for i in range(len(msgs)):
+    async def message_work(self,
+                           msgs: typing.List[Message],
+                           memory_id: int,
+                           journal_seqs: typing.List[int] | None = None,
+                           store_seqs: typing.List[concurrent.futures.Future] | None = None) -> None:
+        """
+        Replaces the estimated token counts of saved messages with exact ones, in memory and in the journal or store.
+        Doesn't take the channel lock, so the next response never waits for the counts
+
+        :param msgs: Messages saved with estimated counts
+        :param memory_id: The ID of the memory they were saved to
+        :param journal_seqs: The messages' journal sequence numbers
+        :param store_seqs: Futures of the messages' sequence numbers in the store
+        """
+        self.logger.info('Getting token counts')
+        try:
+            tokens = await self.api.count_tokens_many(msgs)
+        except RuntimeError as ex:
+            # The estimates stay, prompts keep a margin for them
+            self.logger.error(f'Could not count tokens: {repr(ex)}')
+            return
+
+        meml = self.memories.get(str(memory_id))
+        for i in range(len(msgs)):
+            if meml is not None:
+                meml.memory.set_tokens(msgs[i], tokens[i])
+            else:
+                # Evicted meanwhile, it'll be loaded again with the estimates
                 msgs[i].tokens = tokens[i]
-                self.logger.info(msgs[i])
-            self.logger.info('Messages saved to memory')
+                msgs[i].estimated = False
+            if journal_seqs is not None:
+                self.journal.update_tokens(memory_id, journal_seqs[i], tokens[i])
+            if store_seqs is not None:
+                try:
+                    seq = await asyncio.wrap_future(store_seqs[i])
+                except sqlite3.Error:
+                    continue  # Already logged by the store
+                self.store.update_tokens(memory_id, seq, tokens[i])
+            self.logger.info(msgs[i])
+
+    def history(self, message: BasicMessage) -> tuple[typing.List[Message], typing.List[int]]:
+        """
+        Gets the channel's message log and the indexes of the history that fits in the API's token budget
+
+        :param message: The message being responded to
+        :return: The log and the indexes to use, most important first
+        """
+        memory = self.memory(message.id)
+        budget = self.api.history_token_budget(message.content)
+        return memory.log, memory.get_related_history(message.content, budget, self.api.history_trim_chunk)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The number of messages waiting for their turn to generate
+        """
+        return self._waiting
+
+    def estimated_wait(self, message: BasicMessage) -> float | None:
+        """
+        Expected seconds until a new message is answered: the generations ahead of it (queued and running), spread
+        over the generation slots, plus its own
+
+        :param message: The new message
+        :return: Seconds, or None if the API can't estimate generation times or the message joins a burst
+        """
+        if self.coalesce_window is not None and str(message.id) in self._bursts:
+            return None
+        duration = self.api.estimate_generation_time(message.content)
+        if duration is None:
+            return None
+        ahead = self.queue_depth
+        slots = 1
+        if self.scheduler is not None:
+            ahead += self.scheduler.active
+            slots = self.scheduler.max_concurrent
+        return (ahead / slots + 1) * duration
+
+    def admit(self, message: BasicMessage) -> str | None:
+        """
+        Checks with the admission controller whether a message should be answered
+
+        :param message: The incoming message
+        :return: None if admitted, otherwise the reply to send instead
+        """
+        if self.admission is None:
+            return None
+        refusal = self.admission.admit(message.guild_id, message.user, self.queue_depth)
+        if refusal is not None:
+            self.config.add_guild_refusal(message.guild_id)
+        return refusal
+
+    def record_usage(self, messages: typing.List[BasicMessage], response: str) -> None:
+        """
+        Counts the generated tokens against the senders' budgets, if admission control is on, and the guild's usage
+        counters, which are always kept
+
+        :param messages: The messages that were answered, more than one if a burst was answered together. Each one's
+        sender is charged an equal share
+        :param response: The generated response
+        """
+        tokens = self.api.estimate_tokens(response)
+        if self.admission is not None:
+            for message in messages:
+                self.admission.charge(message.guild_id, message.user, tokens / len(messages))
+        self.config.add_guild_usage(messages[0].guild_id, tokens)
+
+    @contextlib.asynccontextmanager
+    async def generation(self, message: BasicMessage) -> typing.AsyncIterator[None]:
+        """
+        Holds the channel lock and a generation slot, counting the message as waiting until it has both
+
+        :param message: The message being responded to
+        """
+        waiting = True
+        self._waiting += 1
+        try:
+            async with self.hold(message.id), self.generation_slot(message):
+                self._waiting -= 1
+                waiting = False
+                yield
+        finally:
+            if waiting:
+                self._waiting -= 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, memory_id: int) -> typing.AsyncIterator['MemoryAndLock']:
+        """
+        Loads a memory if needed and holds its lock. It isn't evicted meanwhile, including while waiting for the lock
+
+        :param memory_id: The ID of the memory
+        :return: An async context manager giving the memory and its lock
+        """
+        # Loading awaits, so another channel could evict it again before this one gets to it
+        while self.store is not None and self.store.has_header(memory_id) and str(memory_id) not in self.memories:
+            await self.ensure_memory(memory_id)
+        meml = self._mem_and_lock(memory_id)
+        meml.users += 1
+        try:
+            async with meml.lock:
+                yield meml
+        finally:
+            meml.users -= 1
+
+    def generation_slot(self, message: BasicMessage) -> typing.AsyncContextManager:
+        """
+        Waits for the scheduler to allow a generation for this message
+
+        :param message: The message being responded to
+        :return: An async context manager holding the slot
+        """
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        key = message.guild_id if self.schedule_by == 'guild' else message.id
+        return self.scheduler.slot(key, self.config.guild_weight(message.guild_id))
+
+    async def ensure_memory(self, memory_id: int) -> None:
+        """
+        Loads a memory from the store if it isn't in RAM yet. Call before anything that uses the memory or its lock
+        (or use hold()), since _mem_and_lock refuses a stored memory that isn't loaded
+
+        :param memory_id: The ID of the memory
+        """
+        temp_id = str(memory_id)
+        if self.store is None or temp_id in self.memories:
+            return
+        # Several messages can arrive before the first load finishes, they all wait for the same one
+        task = self._loading.get(temp_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load_memory(temp_id))
+            self._loading[temp_id] = task
+        await task
+
+    async def _load_memory(self, temp_id: str) -> None:
+        try:
+            memory = await self.store.load(temp_id, self.api)
+            if memory is not None and temp_id not in self.memories:
+                self.logger.debug(f'Loaded memory ID {temp_id} with {len(memory.log)} messages')
+                self._add_resident(temp_id, MemoryAndLock(self._bind(memory, temp_id)))
+        finally:
+            del self._loading[temp_id]
 
     def _mem_and_lock(self, memory_id: int) -> 'MemoryAndLock':
         self.logger.debug(f'Accessing memory ID: {memory_id}')
         temp_id = str(memory_id)
         if temp_id not in self.memories:
+            if self.store is not None and self.store.has_header(temp_id):
+                # A default memory would replace what's stored
+                raise ValueError(f'Memory ID {temp_id} is stored but not loaded, use ensure_memory() first')
             # Add a default memory
             self.logger.debug('Creating new memory')
-            self.memories[temp_id] = MemoryAndLock(self.default_factory.make_memory())
+            memory = self.default_factory.make_memory()
+            if self.store is not None:
+                self.store.save_header(temp_id, memory)
+            meml = MemoryAndLock(self._bind(memory, temp_id))
+            self._add_resident(temp_id, meml)
+            return meml
 
+        if self.max_resident is not None:
+            self.memories.move_to_end(temp_id)
         return self.memories[temp_id]
 
+    def _bind(self, memory: AbstractMemory, memory_id: int | str) -> AbstractMemory:
+        """
+        Makes generations a memory starts itself (summaries) wait for the scheduler too, and go to the same server as
+        its channel's responses
+
+        :param memory: A memory about to become resident
+        :param memory_id: Its ID
+        :return: The same memory
+        """
+        memory.set_generation_slot(self.background_slot)
+        # Same key as respond() routes by
+        memory.set_affinity(int(memory_id))
+        return memory
+
+    def background_slot(self) -> typing.AsyncContextManager:
+        """
+        Waits for the scheduler to allow a generation that isn't answering a message. All of them share one queue,
+        so they take one turn between channels and can't crowd out users
+
+        :return: An async context manager holding the slot
+        """
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(self.BACKGROUND_KEY)
+
+    def _add_resident(self, temp_id: str, meml: 'MemoryAndLock') -> None:
+        self.memories[temp_id] = meml
+        if self.max_resident is None or len(self.memories) <= self.max_resident:
+            return
+
+        # Oldest use first. A channel in use was used moments ago, so it's near the other end
+        for key in list(self.memories.keys()):
+            if len(self.memories) <= self.max_resident:
+                break
+            evicted = self.memories[key]
+            if key == temp_id or evicted.in_use:
+                continue
+            # Messages are already in the store, only the settings might have changed
+            self.store.save_header(key, evicted.memory)
+            del self.memories[key]
+            self.logger.debug(f'Evicted memory ID {key}')
+
     def memory(self, memory_id: int) -> AbstractMemory:
         """
         Retrieve the memory associated with an ID
@@ -135,34 +552,108 @@ class TextHandler(Handler):
         self.config.set_active_option(guild_id, channel_id, option, value)
         return 'Option set'
 
+    async def get_memory_types(self) -> typing.List[str]:
+        return list(self.memory_factory_lookup.keys())
+
+    async def set_memory_type(self, memory_type: str, channel_id: int) -> str | None:
+        """
+        Replaces a channel's memory with a new one from memory_factory_lookup. The conversation's messages are copied
+        over, so memories with a cap keep only what fits. System messages (like a summary) belong to the old memory
+        type and are left behind.
+
+        :param memory_type: Name of the factory in memory_factory_lookup
+        :param channel_id: The channel to change
+        :return: A message for the user
+        """
+        factory = self.memory_factory_lookup.get(memory_type)
+        if factory is None:
+            return f'Unknown memory type {memory_type}'
+
+        async with self.hold(channel_id) as meml:
+            memory = self._bind(factory.make_memory(), channel_id)
+            for msg in meml.memory.log:
+                if msg.role == Role.SYSTEM or len(msg.content) == 0:
+                    continue
+                # Copy, since some memories hand out views into their own storage
+                memory.add_log(Message(role=msg.role, content=msg.content, tokens=msg.tokens, estimated=msg.estimated))
+            meml.memory = memory
+            if self.journal is not None:
+                # Journal records only make sense on top of a snapshot of the same memory type
+                await self.journal.compact(channel_id, memory)
+            if self.store is not None:
+                self.store.save_header(channel_id, memory)
+        self.logger.info(f'Channel {channel_id} switched to {memory_type} memory')
+        return f'Memory set to {memory_type}'
+
     async def get_default_options(self) -> dict[str, typing.Any]:
         presets = self.api.presets
         return presets['Default'].copy()
 
     def save(self):
+        if self.store is not None:
+            self.logger.info('Closing memory store')
+            self.store.close({key: meml.memory for key, meml in self.memories.items()})
+            return
+
+        if self.journal is not None:
+            # New messages are already journaled, only what's still buffered needs writing
+            self.logger.info('Flushing memory journal')
+            self.journal.close()
+            return
+
         self.logger.info('Saving memory')
-        f = open('memory.txt', 'w')
+        f = open('memory.txt', 'wb')
 
         # Convert MemoryAndLock dict to AbstractMemory dict
         temp = {}
         for key, meml in self.memories.items():
             temp[key] = meml.memory
 
-        f.write(json.dumps(temp, cls=MemoryEncoder, indent=2))
+        f.write(self.codec.encode(temp))
         f.close()
 
+    async def snapshot_memories(self) -> dict[str, dict[str, typing.Any]] | None:
+        """
+        Copies every memory as a dict so memory.txt can be written from another thread. Each memory is copied in one
+        go, and the event loop gets a turn between memories.
+
+        :return: The copied memories by ID, or None if a store or journal already saves them as they change
+        """
+        if self.store is not None:
+            # Messages are saved already, but settings like a summary change over time. Only the settings are copied
+            # here, they're encoded and written in the store's thread
+            try:
+                await asyncio.wrap_future(self.store.save_headers({key: meml.memory
+                                                                   for key, meml in self.memories.items()}))
+            except sqlite3.Error:
+                pass  # Logged by the store, and tried again next snapshot
+            return None
+        if self.journal is not None:
+            return None
+
+        temp = {}
+        for key in list(self.memories.keys()):
+            meml = self.memories.get(key)
+            if meml is not None:
+                temp[key] = meml.memory.to_dict()
+                await asyncio.sleep(0)
+        return temp
+
     def load(self) -> None:
+        if self.store is not None:
+            # Memories are loaded from the store when first used
+            self._import_memory_file()
+            return
+
         self.logger.info('Loading memory...')
 
         try:
-            f = open('memory.txt', 'r')
-            dump = f.read()
-            temp: dict[str, AbstractMemory] = json.loads(dump, cls=MemoryDecoder)
+            temp = load_memories('memory.txt', self.api)
             self.logger.debug(temp)
 
             # Convert AbstractMemory dict to MemoryAndLock dict
             for key, mem in temp.items():
-                self.memories[key] = MemoryAndLock(mem)
+                self.memories[key] = MemoryAndLock(self._bind(mem, key))
 
         except Exception as ex:
             self.logger.error(repr(ex))
@@ -170,6 +661,37 @@ class TextHandler(Handler):
             # Currently just keeps an empty list which will overwrite unreadable json data
             # Might want to save old file under different name in case it's easily fixable
 
+        if self.journal is not None:
+            replayed = self.journal.replay(self.default_factory, self.api)
+            for key, meml in self.memories.items():
+                if key not in replayed:
+                    # Moving over from memory.txt, so the journal has everything from now on
+                    self.journal.write_snapshot(key, meml.memory)
+            for key, mem in replayed.items():
+                self.memories[key] = MemoryAndLock(self._bind(mem, key))
+
+    def _import_memory_file(self) -> None:
+        """
+        Moves memories from memory.txt into the store, once
+        """
+        if not os.path.exists('memory.txt'):
+            return
+
+        self.logger.info('Importing memory.txt into the memory store')
+        count = 0
+        try:
+            # One memory at a time, importing replaces, so a retry after an error is fine
+            for key, mem in iter_memories('memory.txt', self.api):
+                self.store.import_memory(key, mem)
+                count += 1
+        except Exception as ex:
+            self.logger.error(repr(ex))
+            self.logger.info('Could not read memory.txt, leaving it in place')
+            return
+
+        os.replace('memory.txt', 'memory.txt.imported')
+        self.logger.info(f'Imported {count} memories')
+
 
 class MemoryAndLock:
     """
@@ -180,3 +702,10 @@ class MemoryAndLock:
     def __init__(self, memory: AbstractMemory):
         self.memory = memory
         self.lock = asyncio.Lock()
+        # Messages waiting for or holding the lock, and token counts still to be filled in. The lock alone doesn't
+        # show a waiter that was just handed the lock but hasn't woken up yet
+        self.users = 0
+
+    @property
+    def in_use(self) -> bool:
+        return self.users > 0 or self.lock.locked() or self.memory.busy
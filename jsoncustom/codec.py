@@ -0,0 +1,192 @@
+import io
+import json
+import typing
+from abc import ABC, abstractmethod
+from typing import Any
+from memory.memory import AbstractMemory
+from jsoncustom.memoryjson import MemoryEncoder, MemoryDecoder, memory_from_dict
+from AbstractAPI import AbstractAPI
+
+
+# A memory, or its to_dict() representation (e.g. from TextHandler.snapshot_memories())
+MemoryOrDict = AbstractMemory | dict[str, Any]
+
+
+def _as_dict(memory: MemoryOrDict) -> dict[str, Any]:
+    return memory.to_dict() if isinstance(memory, AbstractMemory) else memory
+
+
+class MemoryCodec(ABC):
+    """
+    Turns a set of memories, by ID, into bytes and back.
+
+    Formats other than the legacy JSON start with a magic header, so detect_codec() can tell which codec wrote a file.
+    Decoding goes one memory at a time with iter_decode(), so the whole file's objects don't have to exist at once.
+    """
+
+    name: str
+    magic: bytes = b''
+
+    @abstractmethod
+    def encode(self, memories: typing.Mapping[str, MemoryOrDict]) -> bytes:
+        pass
+
+    @abstractmethod
+    def iter_decode(self,
+                    stream: typing.BinaryIO,
+                    api: AbstractAPI | None = None) -> typing.Iterator[tuple[str, AbstractMemory]]:
+        """
+        Decodes memories one at a time
+
+        :param stream: The encoded data, positioned after the magic header
+        :param api: Given to memories that need one, see memory_from_dict
+        :return: An iterator of (ID, memory)
+        """
+        pass
+
+    def decode(self, data: bytes, api: AbstractAPI | None = None) -> dict[str, AbstractMemory]:
+        stream = io.BytesIO(data)
+        stream.seek(len(self.magic))
+        return dict(self.iter_decode(stream, api))
+
+
+class JSONCodec(MemoryCodec):
+    """
+    The original memory.txt format: one indented JSON document, decoded with MemoryDecoder. Easy to read and edit,
+    but the slowest and largest, and it can't be decoded one memory at a time.
+    """
+
+    name = 'json'
+
+    def __init__(self, indent: int | None = 2):
+        self.indent = indent
+
+    def encode(self, memories: typing.Mapping[str, MemoryOrDict]) -> bytes:
+        return json.dumps(memories, cls=MemoryEncoder, indent=self.indent).encode()
+
+    def iter_decode(self,
+                    stream: typing.BinaryIO,
+                    api: AbstractAPI | None = None) -> typing.Iterator[tuple[str, AbstractMemory]]:
+        yield from json.loads(stream.read(), cls=MemoryDecoder, api=api).items()
+
+
+class JSONLinesCodec(MemoryCodec):
+    """
+    Compact JSON with one memory per line, as [ID, memory]. Still text, but without indentation, and decoding only
+    turns each memory's dict into objects once instead of running a hook on every message.
+
+    Uses orjson when it's installed and use_orjson is True, which writes the same format faster.
+    """
+
+    name = 'jsonl'
+    magic = b'#ZIPPAI-MEMORY-JSONL 1\n'
+
+    def __init__(self, use_orjson: bool = True):
+        self._orjson = None
+        if use_orjson:
+            try:
+                import orjson
+                self._orjson = orjson
+            except ImportError:
+                pass
+
+    def _dumps(self, obj: Any) -> bytes:
+        if self._orjson is not None:
+            return self._orjson.dumps(obj)
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+    def _loads(self, line: bytes) -> Any:
+        if self._orjson is not None:
+            return self._orjson.loads(line)
+        return json.loads(line)
+
+    def encode(self, memories: typing.Mapping[str, MemoryOrDict]) -> bytes:
+        lines = [self.magic]
+        for key, memory in memories.items():
+            lines.append(self._dumps([key, _as_dict(memory)]))
+            lines.append(b'\n')
+        return b''.join(lines)
+
+    def iter_decode(self,
+                    stream: typing.BinaryIO,
+                    api: AbstractAPI | None = None) -> typing.Iterator[tuple[str, AbstractMemory]]:
+        for line in stream:
+            if len(line.strip()) == 0:
+                continue
+            key, dct = self._loads(line)
+            yield key, memory_from_dict(dct, api)
+
+
+class MsgpackCodec(MemoryCodec):
+    """
+    MessagePack, a stream of [ID, memory] arrays. The smallest and fastest format, but binary. Needs msgpack.
+    """
+
+    name = 'msgpack'
+    magic = b'\x00ZIPPAI-MEMORY-MSGPACK 1\n'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('The msgpack codec needs msgpack: pip install msgpack')
+        self._msgpack = msgpack
+
+    def encode(self, memories: typing.Mapping[str, MemoryOrDict]) -> bytes:
+        packer = self._msgpack.Packer()
+        return self.magic + b''.join(packer.pack([key, _as_dict(memory)]) for key, memory in memories.items())
+
+    def iter_decode(self,
+                    stream: typing.BinaryIO,
+                    api: AbstractAPI | None = None) -> typing.Iterator[tuple[str, AbstractMemory]]:
+        for key, dct in self._msgpack.Unpacker(stream, raw=False):
+            yield key, memory_from_dict(dct, api)
+
+
+CODECS: dict[str, typing.Callable[[], MemoryCodec]] = {
+    JSONCodec.name: JSONCodec,
+    JSONLinesCodec.name: JSONLinesCodec,
+    MsgpackCodec.name: MsgpackCodec
+}
+
+
+def get_codec(name: str) -> MemoryCodec:
+    """
+    :param name: 'json', 'jsonl' or 'msgpack'
+    :return: A new codec
+    """
+    if name not in CODECS:
+        raise ValueError(f'Unknown memory codec {name}, expected one of {", ".join(CODECS)}')
+    return CODECS[name]()
+
+
+def detect_codec(stream: typing.BinaryIO) -> MemoryCodec:
+    """
+    Picks the codec from a file's magic header, and leaves the stream positioned after it
+
+    :param stream: The file, at its start
+    :return: The codec that wrote it. Files without a known header are legacy JSON
+    """
+    start = stream.read(32)
+    for codec_type in (JSONLinesCodec, MsgpackCodec):
+        if start.startswith(codec_type.magic):
+            stream.seek(len(codec_type.magic))
+            return codec_type()
+    stream.seek(0)
+    return JSONCodec()
+
+
+def iter_memories(path: str, api: AbstractAPI | None = None) -> typing.Iterator[tuple[str, AbstractMemory]]:
+    """
+    Reads a memory file in any format, one memory at a time
+
+    :param path: The file
+    :param api: Given to memories that need one, see memory_from_dict
+    :return: An iterator of (ID, memory)
+    """
+    with open(path, 'rb') as f:
+        yield from detect_codec(f).iter_decode(f, api)
+
+
+def load_memories(path: str, api: AbstractAPI | None = None) -> dict[str, AbstractMemory]:
+    return dict(iter_memories(path, api))
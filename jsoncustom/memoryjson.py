@@ -1,6 +1,11 @@
 from memory.memory import AbstractMemory
 from memory.basic_memory import BasicMemory
 from memory.no_memory import NoMemory
+from memory.summary_memory import SummaryMemory
+from memory.vector_memory import VectorMemory
+from memory.keyword_memory import KeywordMemory
+from memory.window_memory import WindowMemory
+from AbstractAPI import AbstractAPI
 import json
 import typing
 from typing import Any
@@ -16,14 +21,37 @@ class MemoryEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+# Converts the '__class__' attribute from memory classes to their actual class.
+MEMORY_TYPES: dict[str, typing.Type[AbstractMemory]] = {
+    'NoMemory': NoMemory,
+    'BasicMemory': BasicMemory,
+    'SummaryMemory': SummaryMemory,
+    'VectorMemory': VectorMemory,
+    'KeywordMemory': KeywordMemory,
+    'WindowMemory': WindowMemory
+}
+
+
+def memory_from_dict(dct: dict[str, Any], api: AbstractAPI | None = None) -> AbstractMemory:
+    """
+    Makes a memory from its to_dict() representation
+
+    :param dct: The memory as a dict, with its messages as plain dicts
+    :param api: Given to memories that generate text, since it can't be stored
+    :return: The memory
+    """
+    memory = MEMORY_TYPES[dct['__class__']].from_dict(dct)
+    if isinstance(memory, SummaryMemory) and api is not None:
+        memory.bind_api(api)
+    return memory
+
+
 class MemoryDecoder(json.JSONDecoder):
 
-    def __init__(self, *args, **kwargs):
-        # Converts the '__class__' attribute from memory classes to their actual class.
-        self.memory_type_mapping = {
-            'NoMemory': NoMemory,
-            'BasicMemory': BasicMemory
-        }
+    def __init__(self, *args, api: AbstractAPI | None = None, **kwargs):
+        self.memory_type_mapping = MEMORY_TYPES
+        # Memories that generate text need an API, which can't be stored in the file
+        self.api = api
 
         super().__init__(object_hook=self.my_obj_hook, *args, **kwargs)
 
@@ -31,7 +59,4 @@ class MemoryDecoder(json.JSONDecoder):
         # Non custom objects won't have '__class__'
         if dct.get('__class__') is None:
             return dct
-        class_type = self.memory_type_mapping[dct.get('__class__')]
-        if issubclass(class_type, AbstractMemory):  # Probably don't even need this if statement
-            return class_type.from_dict(dct)  # Return an object from its dict representation
-        return dct
+        return memory_from_dict(dct, self.api)  # Return an object from its dict representation
@@ -1,6 +1,242 @@
+import asyncio
+import collections
 import httpx
 import json
 import logging
+import math
+import random
+import time
+import typing
+
+
+class RequestRejectedError(RuntimeError):
+    """
+    The server answered with a client error (4xx). The server is fine, the request (e.g. an option value) was bad
+    """
+
+
+class RetryPolicy:
+    """
+    How often and how long to wait before a failed request is sent again.
+    Waits grow exponentially and are fully jittered, so clients that failed together don't retry together
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.25, max_delay: float = 4.0):
+        """
+        :param attempts: Tries per request, including the first. 1 disables retries
+        :param base_delay: Upper bound in seconds of the wait before the first retry. Doubles for every retry after it
+        :param max_delay: Upper bound in seconds of any wait
+        """
+        if attempts < 1:
+            raise ValueError('A request needs at least one attempt')
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """
+        :param attempt: How many attempts failed before this wait, minus one
+        :return: Seconds to wait before the next attempt
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a server that keeps failing.
+
+    After failure_threshold failures in a row the breaker opens and requests fail immediately. Once reset_timeout
+    seconds have passed one trial request is let through (half open). It closes the breaker if it succeeds and opens it
+    again if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        :param failure_threshold: Failures in a row that open the breaker
+        :param reset_timeout: Seconds the breaker stays open before a trial request
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened = float('-inf')
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Whether requests are being refused right now
+        """
+        return self.state != self.CLOSED and time.monotonic() - self._opened < self.reset_timeout
+
+    def allow(self) -> bool:
+        """
+        Called before each request
+
+        :return: Whether the request may be sent
+        """
+        if self.state == self.CLOSED:
+            return True
+        if self.is_open:
+            return False
+        # Let one trial through. If it never reports back, another is let through after reset_timeout
+        self.state = self.HALF_OPEN
+        self._opened = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> bool:
+        """
+        :return: Whether this failure opened the breaker
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            opened = self.state != self.OPEN
+            self.state = self.OPEN
+            self._opened = time.monotonic()
+            return opened
+        return False
+
+
+class TimeoutPolicy:
+    """
+    How long each kind of request may take.
+
+    Generation timeouts scale with the work requested: the tokens to generate plus the prompt, where a prompt token
+    counts as prompt_weight of a generated one since prompts are processed in parallel. The work is divided by the
+    backend's measured throughput and multiplied by slack, then kept between generate_min and generate_max.
+    """
+
+    def __init__(self,
+                 *,
+                 connect: float = 5.0,
+                 default: float = 20.0,
+                 tokencount: float = 5.0,
+                 generate_min: float = 20.0,
+                 generate_max: float = 600.0,
+                 slack: float = 2.0,
+                 prompt_weight: float = 0.05,
+                 initial_throughput: float = 10.0,
+                 smoothing: float = 0.2):
+        """
+        :param connect: Seconds to wait for a connection, for every route
+        :param default: Seconds for routes without their own timeout
+        :param tokencount: Seconds for token counting, which is quick unless the server is stuck
+        :param generate_min: Shortest generation timeout in seconds
+        :param generate_max: Longest generation timeout in seconds
+        :param slack: How many times the expected duration a generation may take
+        :param prompt_weight: Cost of a prompt token relative to a generated token
+        :param initial_throughput: Tokens per second assumed until a generation is measured
+        :param smoothing: Weight of each new measurement in the throughput's moving average
+        """
+        self.connect = connect
+        self.default = default
+        self.tokencount = tokencount
+        self.generate_min = generate_min
+        self.generate_max = generate_max
+        self.slack = slack
+        self.prompt_weight = prompt_weight
+        self.initial_throughput = initial_throughput
+        self.smoothing = smoothing
+
+
+class ConnectionPool:
+    """
+    HTTP clients shared by every Client, one per server URL, so connections are kept alive and reused between
+    requests instead of being opened for each one.
+
+    Use as an async context manager or call aclose() at shutdown. Clients are created again on first use after
+    closing.
+    """
+
+    _default: 'ConnectionPool | None' = None
+
+    def __init__(self,
+                 *,
+                 max_connections: int = 10,
+                 max_keepalive: int = 5,
+                 keepalive_expiry: float = 30.0,
+                 http2: bool = False):
+        """
+        :param max_connections: Most connections open to each server at once
+        :param max_keepalive: Most idle connections kept open to each server
+        :param keepalive_expiry: Seconds an idle connection is kept open
+        :param http2: Use HTTP/2 when the server supports it. Needs the h2 package
+        """
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                raise ImportError('HTTP/2 needs the h2 package. Install it with: pip install httpx[http2]')
+        self.logger = logging.getLogger(__name__)
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.http2 = http2
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._stats: dict[str, collections.Counter[str]] = {}
+
+    @classmethod
+    def default(cls) -> 'ConnectionPool':
+        """
+        The pool used by Clients that aren't given one
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        """
+        :param url: Base URL of the server
+        :return: The HTTP client for the server
+        """
+        client = self._clients.get(url)
+        if client is None or client.is_closed:
+            stats = self._stats.setdefault(url, collections.Counter())
+
+            async def trace(event: str, info: dict) -> None:
+                # Only new connections connect, reused ones go straight to sending
+                if event == 'connection.connect_tcp.complete':
+                    stats['connections'] += 1
+
+            async def on_request(request: httpx.Request) -> None:
+                stats['requests'] += 1
+                request.extensions['trace'] = trace
+
+            client = httpx.AsyncClient(base_url=url, limits=self.limits, http2=self.http2,
+                                       event_hooks={'request': [on_request]})
+            self._clients[url] = client
+        return client
+
+    def stats(self, url: str) -> dict[str, int]:
+        """
+        :param url: Base URL of the server
+        :return: Requests sent, connections opened and requests that reused an open connection
+        """
+        stats = self._stats.get(url, collections.Counter())
+        return {
+            'requests': stats['requests'],
+            'connections': stats['connections'],
+            'reused': max(0, stats['requests'] - stats['connections'])
+        }
+
+    async def aclose(self) -> None:
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    async def __aenter__(self) -> 'ConnectionPool':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
 
 
 class Client:
@@ -11,40 +247,156 @@ class Client:
     ROUTE_VERSION = '/api/v1/info/version'
     ROUTE_MODEL = '/api/v1/model'
     ROUTE_TOKENCOUNT = '/api/extra/tokencount'
-
-    def __init__(self, url: str):
-        self.http_client = httpx.AsyncClient(base_url=url)  # For better testing, don't initialize client here
+    ROUTE_GENERATE_STREAM = '/api/extra/generate/stream'
+
+    CHARS_PER_TOKEN = 4  # For estimating prompt and output sizes without a tokenizer
+    DEFAULT_MAX_LENGTH = 100  # KoboldCpp's default when a generation doesn't set max_length
+
+    # Routes that are safe to send again after a failure. Token counting is a POST but has no side effects
+    IDEMPOTENT_ROUTES = frozenset({ROUTE_MAX_CONTEXT_LENGTH, ROUTE_MAX_LENGTH, ROUTE_VERSION, ROUTE_MODEL,
+                                   ROUTE_TOKENCOUNT})
+
+    def __init__(self,
+                 url: str,
+                 *,
+                 retry: RetryPolicy | None = None,
+                 breaker: CircuitBreaker | None = None,
+                 timeouts: TimeoutPolicy | None = None,
+                 connections: ConnectionPool | None = None):
+        """
+        :param url: Base URL of the KoboldCpp server
+        :param retry: Retries of failed requests to idempotent routes. Defaults to RetryPolicy()
+        :param breaker: Refuses requests while the server keeps failing. Defaults to CircuitBreaker()
+        :param timeouts: Timeouts per route. Defaults to TimeoutPolicy()
+        :param connections: Where the HTTP client comes from. Defaults to ConnectionPool.default()
+        """
+        self.url = url
+        self.connections = connections if connections is not None else ConnectionPool.default()
         self.logger = logging.getLogger(__name__)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # requests, failures, retries, rejected (by the open breaker) and breaker_opened
+        self.metrics: collections.Counter[str] = collections.Counter()
+        self.timeouts = timeouts if timeouts is not None else TimeoutPolicy()
+        # Moving average of weighted tokens (see TimeoutPolicy) per second of generation
+        self.throughput = self.timeouts.initial_throughput
+        self.generations_measured = 0
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self.connections.get(self.url)
+
+    def estimate_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.CHARS_PER_TOKEN)
+
+    def estimate_duration(self, prompt_tokens: int, max_length: int) -> float:
+        """
+        :param prompt_tokens: Size of the prompt
+        :param max_length: Most tokens to generate
+        :return: Expected seconds for the generation at the measured throughput
+        """
+        return (max_length + prompt_tokens * self.timeouts.prompt_weight) / self.throughput
 
-    async def get_api(self, path: str) -> dict:
-        try:
-            response: httpx.Response = await self.http_client.get(path)
-            response.raise_for_status()
-        except httpx.RequestError as ex:
-            # Probably means there is no connection to the http server. Dropped or offline.
-            self.logger.error(repr(ex))
-            raise RuntimeError(f'Error getting HTTP response: {ex}')
-        except httpx.HTTPStatusError as ex:
-            self.logger.error(repr(ex))
-            raise RuntimeError(f'Error {ex.response.status_code}. The server is likely busy')
-
-        res_dict = json.loads(response.content)
-        return res_dict
-
-    async def post_api(self, path: str, body: dict) -> dict:
-        content = json.dumps(body)
+    def generate_timeout(self, prompt_tokens: int, max_length: int) -> httpx.Timeout:
+        """
+        :param prompt_tokens: Size of the prompt
+        :param max_length: Most tokens to generate
+        :return: The timeout for a generation of this size
+        """
+        seconds = self.estimate_duration(prompt_tokens, max_length) * self.timeouts.slack
+        seconds = min(max(seconds, self.timeouts.generate_min), self.timeouts.generate_max)
+        return httpx.Timeout(seconds, connect=self.timeouts.connect)
 
-        try:
-            response = await self.http_client.post(path, content=content, timeout=20.0)
-            response.raise_for_status()
-        except httpx.RequestError as ex:
-            self.logger.error(repr(ex))
-            raise RuntimeError(f'Error getting HTTP response: {ex}')
-        except httpx.HTTPStatusError as ex:
-            self.logger.error(repr(ex))
-            raise RuntimeError(f'Error {ex.response.status_code}. The server is likely busy')
+    def route_timeout(self, path: str) -> httpx.Timeout:
+        seconds = self.timeouts.tokencount if path == self.ROUTE_TOKENCOUNT else self.timeouts.default
+        return httpx.Timeout(seconds, connect=min(seconds, self.timeouts.connect))
+
+    def record_generation(self, prompt_tokens: int, generated_tokens: int, elapsed: float) -> None:
+        """
+        Updates the measured throughput with a finished generation
 
-        return json.loads(response.content)
+        :param prompt_tokens: Size of the prompt
+        :param generated_tokens: Tokens generated
+        :param elapsed: Seconds the generation took
+        """
+        if elapsed <= 0:
+            return
+        sample = (generated_tokens + prompt_tokens * self.timeouts.prompt_weight) / elapsed
+        if self.generations_measured == 0:
+            self.throughput = sample
+        else:
+            self.throughput += self.timeouts.smoothing * (sample - self.throughput)
+        self.generations_measured += 1
+
+    def _check_breaker(self) -> None:
+        if not self.breaker.allow():
+            self.metrics['rejected'] += 1
+            raise RuntimeError('The server is unavailable. Try again later')
+        self.metrics['requests'] += 1
+
+    def _record_failure(self, ex: httpx.HTTPError) -> RuntimeError:
+        """
+        Counts a failed request against the breaker
+
+        :param ex: The transport or status error
+        :return: The error to raise
+        """
+        self.logger.error(repr(ex))
+        if isinstance(ex, httpx.HTTPStatusError) and ex.response.status_code < 500:
+            # The server answered, so it's up. The request itself was bad
+            self.breaker.record_success()
+            return RequestRejectedError(f'Error {ex.response.status_code}. The request was rejected')
+
+        self.metrics['failures'] += 1
+        if self.breaker.record_failure():
+            self.metrics['breaker_opened'] += 1
+            self.logger.warning(f'{self.url} keeps failing, refusing requests for '
+                                f'{self.breaker.reset_timeout} seconds')
+        if isinstance(ex, httpx.HTTPStatusError):
+            return RuntimeError(f'Error {ex.response.status_code}. The server is likely busy')
+        # Probably means there is no connection to the http server. Dropped or offline.
+        return RuntimeError(f'Error getting HTTP response: {ex}')
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        """
+        Sends a request, retrying idempotent routes on transport errors and 5xx responses
+
+        :param method: HTTP method
+        :param path: Route
+        :param kwargs: Passed on to httpx
+        :return: The decoded JSON response
+        """
+        attempts = self.retry.attempts if path in self.IDEMPOTENT_ROUTES else 1
+        for attempt in range(attempts):
+            self._check_breaker()
+            try:
+                response = await self.http_client.request(method, path, **kwargs)
+                response.raise_for_status()
+            except httpx.HTTPError as ex:
+                error = self._record_failure(ex)
+                if (isinstance(ex, httpx.HTTPStatusError) and ex.response.status_code < 500) \
+                        or attempt + 1 == attempts:
+                    raise error
+            else:
+                self.breaker.record_success()
+                return json.loads(response.content)
+
+            self.metrics['retries'] += 1
+            await asyncio.sleep(self.retry.delay(attempt))
+
+    async def get_api(self, path: str) -> dict:
+        return await self._request('GET', path, timeout=self.route_timeout(path))
+
+    async def post_api(self, path: str, body: dict, timeout: httpx.Timeout | None = None) -> dict:
+        """
+        :param path: Route
+        :param body: Request body, sent as JSON
+        :param timeout: Overrides the route's timeout
+        :return: The decoded JSON response
+        """
+        content = json.dumps(body)
+        return await self._request('POST', path, content=content,
+                                   timeout=timeout if timeout is not None else self.route_timeout(path))
 
     async def max_context_length(self) -> int:
         response = await self.get_api(self.ROUTE_MAX_CONTEXT_LENGTH)
@@ -179,8 +531,53 @@ class Client:
             'prompt': prompt,
             **parameters
         }
-        output = await self.post_api(self.ROUTE_GENERATE, params)
-        return output['results'][0]['text']
+        prompt_tokens = self.estimate_tokens(prompt)
+        max_length = parameters.get('max_length', self.DEFAULT_MAX_LENGTH)
+        start = time.monotonic()
+        output = await self.post_api(self.ROUTE_GENERATE, params, self.generate_timeout(prompt_tokens, max_length))
+        text = output['results'][0]['text']
+        self.record_generation(prompt_tokens, min(self.estimate_tokens(text), max_length), time.monotonic() - start)
+        return text
+
+    async def generate_stream(self, prompt: str, **parameters) -> typing.AsyncIterator[str]:
+        """
+        Streams a generation as it is produced, using KoboldCpp's server-sent events endpoint.
+
+        Each yielded string is a new piece of text to append to the previous ones. Takes the same parameters as
+        generate().
+
+        :param prompt:
+        :param parameters: See generate()
+        :return: An async iterator of text chunks
+        """
+        self.logger.info('Initiating streaming generate call')
+        content = json.dumps({
+            'prompt': prompt,
+            **parameters
+        })
+        prompt_tokens = self.estimate_tokens(prompt)
+        # The read timeout applies between chunks. The longest gap is before the first one, while the prompt is
+        # processed, so the whole generation's timeout covers it
+        timeout = self.generate_timeout(prompt_tokens, parameters.get('max_length', self.DEFAULT_MAX_LENGTH))
+
+        self._check_breaker()
+        start = time.monotonic()
+        generated = 0
+        try:
+            async with self.http_client.stream('POST', self.ROUTE_GENERATE_STREAM, content=content, timeout=timeout) as response:
+                response.raise_for_status()
+                self.breaker.record_success()
+                async for line in response.aiter_lines():
+                    # Events look like 'event: message' followed by 'data: {"token": "..."}'
+                    if not line.startswith('data:'):
+                        continue
+                    generated += 1  # One event per token
+                    token = json.loads(line[len('data:'):]).get('token', '')
+                    if token:
+                        yield token
+        except httpx.HTTPError as ex:
+            raise self._record_failure(ex)
+        self.record_generation(prompt_tokens, generated, time.monotonic() - start)
 
     async def version(self) -> str:
         response = await self.get_api(self.ROUTE_VERSION)
@@ -194,6 +591,14 @@ class Client:
         response = await self.post_api(self.ROUTE_TOKENCOUNT, {'prompt': prompt})
         return response['value']
 
+    async def tokenize(self, prompt: str) -> typing.List[int]:
+        """
+        :param prompt: The text to tokenize
+        :return: The token IDs of the text
+        """
+        response = await self.post_api(self.ROUTE_TOKENCOUNT, {'prompt': prompt})
+        return response['ids']
+
 
 if __name__ == '__main__':
     cli = Client('http://localhost:5001')
@@ -1,7 +1,12 @@
 import logging
+import math
+import os
+import time
 import typing
 from AbstractAPI import AbstractAPI
-import koboldai
+from backendpool import Backend, BackendPool
+from localtokenizer import LocalTokenizer
+from tokencache import TokenCountCache
 from memory.memory import Message, Role
 from httpx import HTTPStatusError
 
@@ -49,45 +54,208 @@ class KoboldAPI(AbstractAPI):
             }
     }
 
-    def __init__(self):
+    INITIAL_PROMPT = '[The following is a chat message log between User and ZippAI. ZippAI follows instructions from User]\n\n' \
+                     'User: Hi.\n' \
+                     'ZippAI: Hello.'
+
+    # Joins texts that are counted in one request. The token IDs it produces are used to split the counts apart again
+    BATCH_SEPARATOR = '\n###\n'
+    ESTIMATE_MARGIN = 1.25  # Estimated token counts are scaled by this when fitting history into the prompt
+    # Used until a backend has been probed
+    DEFAULT_MAX_CONTEXT_LENGTH = 2048
+    DEFAULT_MAX_LENGTH = 200
+
+    def __init__(self,
+                 *,
+                 tokenizer: LocalTokenizer | None = None,
+                 cache: TokenCountCache | None = None,
+                 model_check_interval: float = 300.0,
+                 max_batch_chars: int = 8000,
+                 prompt_layout: typing.Literal['sliding', 'chunked'] = 'sliding',
+                 trim_chunk_tokens: int | None = None,
+                 pool: BackendPool | None = None,
+                 response_length: int | None = None):
+        """
+        :param tokenizer: Counts tokens in-process instead of asking the server. Must match the server's model
+        :param cache: Remembers token counts of texts that were already counted
+        :param model_check_interval: Seconds between checks of the server's model, which invalidate the cache
+        :param max_batch_chars: The longest text to send in one token count request when counting many messages
+        :param prompt_layout: 'sliding' drops the oldest message whenever the prompt is full. 'chunked' drops
+        trim_chunk_tokens worth of history at once, so the prompt's start stays the same between turns and
+        KoboldCpp can reuse its processed context
+        :param trim_chunk_tokens: Size of the steps history is trimmed in when chunked. Defaults to a quarter of the
+        context size
+        :param pool: The KoboldCpp servers to use. Defaults to one at http://localhost:5001
+        :param response_length: Most tokens generated per response. Defaults to the servers' max_length
+        """
         self.logger = logging.getLogger(__name__)
-        self.client = koboldai.Client('http://localhost:5001')
+        self.pool = pool if pool is not None else BackendPool(['http://localhost:5001'])
+        self.tokenizer = tokenizer
+        self.cache = cache
+        self.model_check_interval = model_check_interval
+        self._model_checked = float('-inf')
+        self.max_batch_chars = max_batch_chars
+        # Separator token IDs by backend URL and model, since each may tokenize differently
+        self._separator_ids: dict[tuple[str, str | None], typing.List[int]] = {}
+        self.prompt_layout = prompt_layout
+        self.trim_chunk_tokens = trim_chunk_tokens
+        self.response_length = response_length
+
+        # How much of each prompt matched the start of the previous one sent to the same backend (what its KoboldCpp
+        # can reuse)
+        self._last_prompt: dict[str, str] = {}
+        self._prefix_stats: dict[str, dict[str, typing.Any]] = {}
+        self.last_prefix_match = 0.0
+        self._prefix_match_total = 0.0
+        self.prompts_sent = 0
 
         # Create blank lookup, then fill it in
         self.translate_role = ['' for _ in range(len(Role))]
         self.translate_role[Role.USER] = 'User'
         self.translate_role[Role.ASSISTANT] = 'ZippAI'
-
-        # temp
-        self.max_tokens = 2048
-        self.max_length = 512
+        self.translate_role[Role.SYSTEM] = 'Summary'
 
     @property
     def options(self) -> dict[str, typing.Any]:
         return self.OPTIONS
 
+    @property
+    def max_tokens(self) -> int:
+        """
+        The context size, as probed from the servers
+        """
+        limits = self.pool.limits()
+        return limits[0] if limits is not None else self.DEFAULT_MAX_CONTEXT_LENGTH
+
+    @property
+    def max_length(self) -> int:
+        """
+        Most tokens generated per response. Never more than half the context, so the prompt keeps some room
+        """
+        length = self.response_length
+        if length is None:
+            limits = self.pool.limits()
+            length = limits[1] if limits is not None else self.DEFAULT_MAX_LENGTH
+        return min(length, self.max_tokens // 2)
+
     @property
     def presets(self) -> dict[str, dict[str, typing.Any]]:
         return self.PRESETS
 
-    async def get_response(self, s: str, stop: typing.List[str] | None = None, options: dict[str, typing.Any] | None = None) -> str:
+    async def get_response(self,
+                           s: str,
+                           stop: typing.List[str] | None = None,
+                           options: dict[str, typing.Any] | None = None,
+                           *,
+                           affinity: typing.Hashable | None = None) -> str:
         if stop is None:
             stop = []
         if options is None:
             options = self.PRESETS['Default']
 
         self.logger.info('Getting response using Kobold API')
-        return await self.client.generate(s,
-                                          max_length=200,
-                                          **options,
-                                          stop_sequence=stop)
+        async with self.pool.use(affinity) as backend:
+            self._record_prefix_match(backend, s)
+            return await backend.client.generate(s,
+                                                 max_context_length=self.max_tokens,
+                                                 max_length=self.max_length,
+                                                 **options,
+                                                 stop_sequence=stop)
+
+    async def get_response_stream(self,
+                                  s: str,
+                                  stop: typing.List[str] | None = None,
+                                  options: dict[str, typing.Any] | None = None,
+                                  *,
+                                  affinity: typing.Hashable | None = None) -> typing.AsyncIterator[str]:
+        """
+        Streaming version of get_response. Text that could be the start of a stop sequence is held back until it's
+        known not to be one, and a trailing stop sequence is never yielded.
+        """
+        if stop is None:
+            stop = []
+        if options is None:
+            options = self.PRESETS['Default']
+
+        self.logger.info('Streaming response using Kobold API')
+        pending = ''
+        async with self.pool.use(affinity) as backend:
+            self._record_prefix_match(backend, s)
+            async for token in backend.client.generate_stream(s,
+                                                              max_context_length=self.max_tokens,
+                                                              max_length=self.max_length,
+                                                              **options,
+                                                              stop_sequence=stop):
+                pending += token
+                held = self._stop_overlap(pending, stop)
+                if held < len(pending):
+                    yield pending[:len(pending) - held]
+                    pending = pending[len(pending) - held:]
+
+        for seq in stop:
+            if pending.endswith(seq):
+                pending = pending.removesuffix(seq)
+                break
+        if pending:
+            yield pending
+
+    def _record_prefix_match(self, backend: Backend, prompt: str) -> None:
+        matched = len(os.path.commonprefix([self._last_prompt.get(backend.url, ''), prompt]))
+        self.last_prefix_match = matched / len(prompt) if prompt else 0.0
+        self._prefix_match_total += self.last_prefix_match
+        self.prompts_sent += 1
+        self._last_prompt[backend.url] = prompt
+
+        stats = self._prefix_stats.setdefault(backend.url, {'prompts': 0, 'last_prefix_match': 0.0, 'total': 0.0})
+        stats['prompts'] += 1
+        stats['last_prefix_match'] = self.last_prefix_match
+        stats['total'] += self.last_prefix_match
+        self.logger.debug(f'Prompt prefix match on {backend.url}: {self.last_prefix_match:.1%}')
+
+    def prompt_cache_stats(self) -> dict[str, typing.Any]:
+        """
+        :return: The fraction of the last prompt that matched the start of the one before it on the same backend, and
+        the average over all prompts sent. Also broken down by backend URL
+        """
+        return {
+            'layout': self.prompt_layout,
+            'prompts': self.prompts_sent,
+            'last_prefix_match': self.last_prefix_match,
+            'mean_prefix_match': self._prefix_match_total / self.prompts_sent if self.prompts_sent else 0.0,
+            'backends': {
+                url: {
+                    'prompts': stats['prompts'],
+                    'last_prefix_match': stats['last_prefix_match'],
+                    'mean_prefix_match': stats['total'] / stats['prompts']
+                }
+                for url, stats in self._prefix_stats.items()
+            }
+        }
+
+    @staticmethod
+    def _stop_overlap(text: str, stop: typing.List[str]) -> int:
+        """
+        Finds how many characters at the end of text could be the beginning (or all) of a stop sequence
+
+        :param text: The text generated so far
+        :param stop: The stop sequences
+        :return: The number of trailing characters to hold back
+        """
+        longest = 0
+        for seq in stop:
+            for length in range(min(len(seq), len(text)), longest, -1):
+                if seq.startswith(text[-length:]):
+                    longest = length
+                    break
+        return longest
 
     async def get_response_structured(self,
                                       message: str,
                                       history: typing.List[Message] | None = None,
                                       indexes: typing.List[int] | None = None,
                                       *,
-                                      options: dict[str, typing.Any] | None = None) -> str:
+                                      options: dict[str, typing.Any] | None = None,
+                                      affinity: typing.Hashable | None = None) -> str:
         """
         Gets a response by structuring a response for the API, can also include a history
 
@@ -97,8 +265,33 @@ class KoboldAPI(AbstractAPI):
         right above the new message. Ex: If the message history contains [past question, past response] and indexes is
         [1, 0], the order becomes [past question, past response, new message]
         :param options: Keyword options to give to the AI
+        :param affinity: Requests with the same key go to the same server, which keeps their prompt cached
         :return:
         """
+        prompt = self.structure_prompt(message, history, indexes)
+        answer = await self.get_response(prompt, ['User:'], options, affinity=affinity)
+        return answer.removesuffix('User:')
+
+    async def get_response_structured_stream(self,
+                                             message: str,
+                                             history: typing.List[Message] | None = None,
+                                             indexes: typing.List[int] | None = None,
+                                             *,
+                                             options: dict[str, typing.Any] | None = None,
+                                             affinity: typing.Hashable | None = None) -> typing.AsyncIterator[str]:
+        prompt = self.structure_prompt(message, history, indexes)
+        async for chunk in self.get_response_stream(prompt, ['User:'], options, affinity=affinity):
+            yield chunk
+
+    def structure_prompt(self,
+                         message: str,
+                         history: typing.List[Message] | None = None,
+                         indexes: typing.List[int] | None = None) -> str:
+        """
+        Builds the prompt used by get_response_structured. See get_response_structured for the arguments.
+
+        :return: The prompt to send to the generator
+        """
 
         # I don't really like that the API needs to know about Message, but I don't know any other way to store
         # extra information like the role and token count such that:
@@ -109,16 +302,10 @@ class KoboldAPI(AbstractAPI):
             history = []
             indexes = []
 
-        initial_prompt = f'[The following is a chat message log between User and ZippAI. ZippAI follows instructions from User]\n\n' \
-                         'User: Hi.\n' \
-                         'ZippAI: Hello.'
-
         # Add user message and prompt the AI to respond
         message_log = [f'User: {message}\nZippAI: ']
 
-        available_tokens = self.max_tokens - (self.max_length +
-                                              self.estimate_tokens(initial_prompt) +
-                                              self.estimate_tokens(message))
+        available_tokens = self.history_token_budget(message)
 
         tokens = 0
         for index in indexes:
@@ -126,22 +313,159 @@ class KoboldAPI(AbstractAPI):
             msg = history[index]
             if msg.tokens <= 0:
                 raise ValueError('Message token count is 0')
-            tokens += msg.tokens
+            # Estimates can be low, so leave some room until the exact count is in
+            tokens += math.ceil(msg.tokens * self.ESTIMATE_MARGIN) if msg.estimated else msg.tokens
             if tokens > available_tokens:
                 self.logger.debug(f'Max tokens reached. Current count: {tokens}')
                 break
             message_log.append(f'{self.translate_role[msg.role]}: {msg.content}')
 
-        message_log.append(initial_prompt)
+        message_log.append(self.INITIAL_PROMPT)
 
         # Reverse the list because we need the most relevant things appended first and discard the rest
-        prompt = '\n'.join(message_log[::-1])
-        answer = await self.get_response(prompt, ['User:'], options)
-        return answer.removesuffix('User:')
+        return '\n'.join(message_log[::-1])
+
+    @property
+    def history_trim_chunk(self) -> int:
+        if self.prompt_layout != 'chunked':
+            return 0
+        if self.trim_chunk_tokens is None:
+            return self.max_tokens // 4
+        return self.trim_chunk_tokens
+
+    def history_token_budget(self, message: str) -> int:
+        return self.max_tokens - (self.max_length +
+                                  self.estimate_tokens(self.INITIAL_PROMPT) +
+                                  self.estimate_tokens(message))
+
+    def estimate_generation_time(self, message: str) -> float:
+        # History usually fills the prompt, so assume a full one
+        return self.pool.estimate_duration(self.max_tokens - self.max_length, self.max_length)
 
     async def count_tokens(self, text: Message) -> int:
         self.logger.debug(f'Counting tokens for "{text.content}"')
-        return await self.client.tokencount(f'{self.translate_role[text.role]}: {text.content}')
+        prompt = f'{self.translate_role[text.role]}: {text.content}'
+        if self.cache is not None:
+            await self.check_model()
+            count = self.cache.get(prompt)
+            if count is not None:
+                return count
+
+        if self.tokenizer is not None:
+            count = self.tokenizer.count(prompt)
+        else:
+            count = await self.pool.hedged(lambda backend: backend.client.tokencount(prompt))
+
+        if self.cache is not None:
+            self.cache.put(prompt, count)
+        return count
+
+    async def count_tokens_many(self, messages: typing.List[Message], max_concurrency: int = 4) -> typing.List[int]:
+        """
+        Counts several messages with as few token count requests as possible.
+
+        Texts are joined with BATCH_SEPARATOR and the returned token IDs are split on the separator's IDs. If the
+        split doesn't give one part per text (the separator merged with a neighbouring token), the batch is counted
+        one message at a time instead.
+        """
+        prompts = [f'{self.translate_role[msg.role]}: {msg.content}' for msg in messages]
+        counts: typing.List[int | None] = [None] * len(prompts)
+
+        if self.cache is not None:
+            await self.check_model()
+            counts = [self.cache.get(prompt) for prompt in prompts]
+        missing = [i for i in range(len(prompts)) if counts[i] is None]
+
+        if self.tokenizer is not None:
+            for i in missing:
+                counts[i] = self.tokenizer.count(prompts[i])
+        else:
+            for batch in self._batches(missing, prompts):
+                batch_counts = await self._count_batch([prompts[i] for i in batch])
+                if batch_counts is None:
+                    self.logger.debug('Could not split batched token counts, counting one at a time')
+                    batch_counts = await super().count_tokens_many([messages[i] for i in batch], max_concurrency)
+                for i, count in zip(batch, batch_counts):
+                    counts[i] = count
+
+        if self.cache is not None:
+            for i in missing:
+                self.cache.put(prompts[i], counts[i])
+        return counts
+
+    def _batches(self, indexes: typing.List[int], prompts: typing.List[str]) -> typing.Iterator[typing.List[int]]:
+        batch = []
+        length = 0
+        for i in indexes:
+            if batch and length + len(prompts[i]) > self.max_batch_chars:
+                yield batch
+                batch = []
+                length = 0
+            batch.append(i)
+            length += len(prompts[i]) + len(self.BATCH_SEPARATOR)
+        if batch:
+            yield batch
+
+    async def _count_batch(self, prompts: typing.List[str]) -> typing.List[int] | None:
+        """
+        Counts the tokens of several texts in one request
+
+        :param prompts: The texts to count
+        :return: The counts, or None if the token IDs couldn't be split back into one part per text
+        """
+        if len(prompts) == 1:
+            return [await self.pool.hedged(lambda backend: backend.client.tokencount(prompts[0]))]
+
+        async def tokenize(backend: Backend) -> tuple[typing.List[int], typing.List[int]]:
+            # The separator must come from the backend that tokenizes the batch
+            key = (backend.url, backend.model)
+            if key not in self._separator_ids:
+                self._separator_ids[key] = await backend.client.tokenize(self.BATCH_SEPARATOR)
+            return self._separator_ids[key], await backend.client.tokenize(self.BATCH_SEPARATOR.join(prompts))
+
+        sep, ids = await self.pool.hedged(tokenize)
+
+        counts = []
+        start = 0
+        i = 0
+        while len(sep) > 0 and i <= len(ids) - len(sep):
+            if ids[i:i + len(sep)] == sep:
+                counts.append(i - start)
+                i += len(sep)
+                start = i
+            else:
+                i += 1
+        counts.append(len(ids) - start)
+
+        if len(counts) != len(prompts):
+            return None
+        return counts
+
+    async def check_model(self) -> None:
+        """
+        Asks the server which model is loaded, at most once per model_check_interval.
+        The token count cache is cleared if the model changed. Counts from a local tokenizer belong to the tokenizer
+        instead, so no request is made for them. If the server can't be asked, the cached counts are kept.
+        """
+        if self.tokenizer is not None:
+            if self.cache is not None:
+                self.cache.set_model(self.tokenizer.name)
+            return
+        now = time.monotonic()
+        if now - self._model_checked < self.model_check_interval:
+            return
+        self._model_checked = now
+        try:
+            model = await self.pool.hedged(lambda backend: backend.client.model())
+        except RuntimeError as ex:
+            self.logger.warning(f'Could not check which model is loaded, keeping cached token counts: {repr(ex)}')
+            return
+        if self.cache is not None:
+            self.cache.set_model(model)
+
+    def save(self) -> None:
+        if self.cache is not None:
+            self.cache.save()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import logging
+import os
+import typing
+from abc import ABC, abstractmethod
+
+
+class LocalTokenizer(ABC):
+    """
+    A tokenizer that runs in-process, so counting tokens doesn't need a request to the API.
+
+    It needs to be the same tokenizer the model uses, or counts will be off.
+    """
+
+    path: str | None = None  # The file it was loaded from
+
+    @property
+    def name(self) -> str:
+        """
+        Identifies the tokenizer, e.g. to key cached token counts by
+        """
+        return f'{type(self).__name__}:{self.path}'
+
+    @abstractmethod
+    def encode(self, text: str) -> typing.List[int]:
+        """
+        :param text: The text to tokenize
+        :return: The token IDs, without any special tokens added
+        """
+        pass
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+
+class HuggingFaceTokenizer(LocalTokenizer):
+    """
+    Loads a Hugging Face tokenizer.json file. Needs the optional 'tokenizers' package.
+    """
+
+    def __init__(self, path: str):
+        try:
+            from tokenizers import Tokenizer
+        except ImportError as ex:
+            raise ImportError('The tokenizers package is needed to load tokenizer.json files. '
+                              'Install it with "pip install tokenizers"') from ex
+        self.logger = logging.getLogger(__name__)
+        self.logger.info(f'Loading tokenizer from {path}')
+        self.path = path
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def encode(self, text: str) -> typing.List[int]:
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+
+class SentencePieceTokenizer(LocalTokenizer):
+    """
+    Loads a SentencePiece .model file. Needs the optional 'sentencepiece' package.
+    """
+
+    def __init__(self, path: str):
+        try:
+            import sentencepiece
+        except ImportError as ex:
+            raise ImportError('The sentencepiece package is needed to load .model files. '
+                              'Install it with "pip install sentencepiece"') from ex
+        self.logger = logging.getLogger(__name__)
+        self.logger.info(f'Loading tokenizer from {path}')
+        self.path = path
+        self._processor = sentencepiece.SentencePieceProcessor(model_file=path)
+
+    def encode(self, text: str) -> typing.List[int]:
+        return self._processor.encode(text)
+
+
+def load_tokenizer(path: str) -> LocalTokenizer:
+    """
+    Loads a tokenizer from disk, picking the backend from the file extension
+
+    :param path: Path to a tokenizer.json (Hugging Face) or .model (SentencePiece) file
+    :return: The loaded tokenizer
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        return HuggingFaceTokenizer(path)
+    if extension == '.model':
+        return SentencePieceTokenizer(path)
+    raise ValueError(f'Unknown tokenizer file type: {path}')
@@ -12,7 +12,18 @@ from discordhandlers.texthandler import TextHandler
 import logging
 from logging import handlers
 from configuration import Configuration, Fields
-from memory.factories.factories import BasicMemoryFactory, NoMemoryFactory
+from memory.factories.factories import BasicMemoryFactory, NoMemoryFactory, SummaryMemoryFactory, VectorMemoryFactory, \
+    KeywordMemoryFactory, WindowMemoryFactory
+from scheduler import GenerationScheduler
+from admission import AdmissionController
+from localtokenizer import load_tokenizer
+from tokencache import TokenCountCache
+from memory.journal import Journal
+from memory.sqlite_store import SQLiteMemoryStore
+from snapshot import Snapshotter
+from jsoncustom.codec import get_codec
+from backendpool import BackendPool
+from koboldai import RetryPolicy, TimeoutPolicy, ConnectionPool
 
 
 def getToken() -> str:
@@ -41,20 +52,78 @@ def main() -> None:
 
     log_handler.flush()
 
-    #api = KoboldAPI()
+    # A local tokenizer saves a request to the server for every token count
+    tokenizer_path = config.options[Fields.TokenizerPath]
+    token_cache = TokenCountCache(config.options[Fields.TokenCacheSize], 'tokencache.txt')
+    connections = ConnectionPool(max_connections=config.options[Fields.HTTPMaxConnections],
+                                 max_keepalive=config.options[Fields.HTTPMaxKeepalive],
+                                 keepalive_expiry=config.options[Fields.HTTPKeepaliveExpiry],
+                                 http2=config.options[Fields.HTTP2])
+    pool = BackendPool(config.options[Fields.BackendURLs],
+                       probe_interval=config.options[Fields.BackendProbeInterval],
+                       retry=RetryPolicy(config.options[Fields.RequestAttempts], config.options[Fields.RetryBaseDelay]),
+                       breaker_threshold=config.options[Fields.BreakerThreshold],
+                       breaker_reset=config.options[Fields.BreakerResetTimeout],
+                       hedge_delay=config.options[Fields.HedgeDelay] or None,
+                       timeouts=TimeoutPolicy(tokencount=config.options[Fields.TokenCountTimeout],
+                                              generate_max=config.options[Fields.MaxGenerateTimeout]),
+                       connections=connections,
+                       limits_ttl=config.options[Fields.BackendLimitsTTL])
+    # A response length of 0 uses the servers' max_length
+    #api = KoboldAPI(tokenizer=load_tokenizer(tokenizer_path) if tokenizer_path else None, cache=token_cache, pool=pool,
+    #                response_length=config.options[Fields.ResponseLength] or None)
     api = TestAPI()
 
     mem = BasicMemoryFactory()
+    memory_factories = {
+        'none': NoMemoryFactory(),
+        'basic': mem,
+        'columnar': BasicMemoryFactory(columnar=True),
+        'summary': SummaryMemoryFactory(api),
+        'vector': VectorMemoryFactory(),
+        'keyword': KeywordMemoryFactory(),
+        'window': WindowMemoryFactory()
+    }
 
-    handler = TextHandler(api, {}, default_factory=mem, config=config)
+    scheduler = GenerationScheduler(config.options[Fields.MaxConcurrentGenerations],
+                                    policy=config.options[Fields.SchedulingPolicy])
+
+    # A limit of 0 disables it, and without any limits there's no admission control at all
+    limits = {'max_queue_depth': config.options[Fields.MaxQueueDepth] or None,
+              'user_rate': config.options[Fields.UserTokenRate] or None,
+              'guild_rate': config.options[Fields.GuildTokenRate] or None}
+    admission = AdmissionController(**limits,
+                                    user_burst=config.options[Fields.UserTokenBurst],
+                                    guild_burst=config.options[Fields.GuildTokenBurst]) \
+        if any(limit is not None for limit in limits.values()) else None
+
+    # 'sqlite' loads channels when first used, 'journal' and 'file' load everything at startup
+    storage = config.options[Fields.MemoryStorage]
+    journal = Journal('journal') if storage == 'journal' else None
+    store = SQLiteMemoryStore('memory.db', tail_tokens=config.options[Fields.MemoryTailTokens] or None) \
+        if storage == 'sqlite' else None
+
+    handler = TextHandler(api, memory_factories, default_factory=mem, config=config, scheduler=scheduler,
+                          admission=admission, journal=journal, store=store,
+                          max_resident=(config.options[Fields.MaxResidentMemories] or None) if store else None,
+                          codec=get_codec(config.options[Fields.MemoryCodec]),
+                          coalesce_window=config.options[Fields.CoalesceWindow] or None)
     handler.load()
 
+    # An interval of 0 only saves at shutdown
+    snapshot_interval = config.options[Fields.SnapshotInterval]
+    snapshotter = Snapshotter(handler, config, interval=snapshot_interval) if snapshot_interval else None
+
     client = discordclient.DiscordClient(handler=handler,
-                                         config=config)
+                                         config=config,
+                                         snapshotter=snapshotter,
+                                         backend_pool=pool,
+                                         queue_notice=config.options[Fields.QueueNotice] or None)
     try:
         client.run(getToken())
     finally:
         handler.save()
+        api.save()
         config.save('config.txt')
         logger.info('********************Log End********************\n')
 
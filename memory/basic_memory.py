@@ -1,17 +1,27 @@
+import bisect
 import logging
 import typing
+from array import array
 from typing import Any
 from memory.memory import AbstractMemory, Message
+from memory.columnar import ColumnarLog, MessageView
 import json
 
 
 class BasicMemory(AbstractMemory):
 
-    def __init__(self):
+    def __init__(self, *, columnar: bool = False):
+        """
+        :param columnar: Store messages in a ColumnarLog instead of a list of Message objects. Uses much less memory
+        for long histories, and log returns lightweight views
+        """
         # log order:
         #   0 - oldest log
         #   n - newest log
-        self._log: typing.List[Message] = []
+        self.columnar = columnar
+        self._log: typing.List[Message] | ColumnarLog = ColumnarLog() if columnar else []
+        # _prefix[i] is the total tokens of _log[:i], so the tokens of any range are found without summing it
+        self._prefix = array('Q', [0])
         self.logger = logging.getLogger(__name__)
 
     @property
@@ -20,20 +30,62 @@ class BasicMemory(AbstractMemory):
 
     def add_log(self, message: Message) -> None:
         self._log.append(message)
+        self._prefix.append(self._prefix[-1] + message.tokens)
 
-    def get_related_history(self, message: str) -> typing.List[int]:
+    def set_tokens(self, message: Message, tokens: int) -> None:
+        index = self._find(message)
+        if index is None:
+            message.tokens = tokens
+            message.estimated = False
+            return
+
+        difference = tokens - self._log[index].tokens
+        self._log[index].tokens = tokens
+        self._log[index].estimated = False
+        message.tokens = tokens
+        message.estimated = False
+        for i in range(index + 1, len(self._prefix)):
+            self._prefix[i] += difference
+
+    def _find(self, message: Message) -> int | None:
+        if self.columnar:
+            if isinstance(message, MessageView) and message.owner is self._log:
+                return message.index
+            # Stored rows aren't the same objects, but the count only depends on role and content. The newest match
+            # might be a repeat of the message, so callers should pass the row from log where they can
+            return self._log.find(message)
+
+        # Messages being updated are almost always the newest, so search from the end
+        for index in range(len(self._log) - 1, -1, -1):
+            if self._log[index] is message:
+                return index
+        return None
+
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
         # Return reverse chronological order (newest information first)
-        return [i for i in range(len(self._log) - 1, -1, -1)]
+        start = 0
+        if budget is not None:
+            # The oldest message where everything after it still fits in the budget
+            start = bisect.bisect_left(self._prefix, self._prefix[-1] - budget)
+            if chunk > 0 and start > 0:
+                # Move the start up to the next chunk boundary. The boundary only moves once every chunk tokens,
+                # so the oldest included message stays the same for several turns
+                boundary = -(-self._prefix[start] // chunk) * chunk
+                start = bisect.bisect_left(self._prefix, boundary)
+        return list(range(len(self._log) - 1, start - 1, -1))
 
-    def to_dict(self) -> dict[str, Any]:
+    def header_dict(self) -> dict[str, Any]:
         return {
             '__class__': 'BasicMemory',
-            'log': [o.to_dict() for o in self._log]
+            'columnar': self.columnar
         }
 
+    def to_dict(self) -> dict[str, Any]:
+        return self.header_dict() | {'log': [o.to_dict() for o in self._log]}
+
     @classmethod
     def from_dict(cls, dictionary: dict[str, Any]) -> 'BasicMemory':
-        mem = cls()
+        mem = cls(columnar=dictionary.get('columnar', False))
         for msg_dct in dictionary['log']:
             if msg_dct is None:
                 continue
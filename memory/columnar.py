@@ -0,0 +1,122 @@
+import typing
+from array import array
+from collections.abc import Sequence
+from typing import Any
+from memory.memory import Message, Role
+
+
+class MessageView:
+    """
+    A lightweight stand-in for a Message stored in a ColumnarLog. Reads go straight to the columns, and setting
+    tokens writes through.
+    """
+
+    __slots__ = ('_log', '_index')
+
+    def __init__(self, log: 'ColumnarLog', index: int):
+        self._log = log
+        self._index = index
+
+    @property
+    def index(self) -> int:
+        return self._index
+
+    @property
+    def owner(self) -> 'ColumnarLog':
+        return self._log
+
+    @property
+    def role(self) -> Role:
+        return Role(self._log.roles[self._index])
+
+    @property
+    def content(self) -> str:
+        return self._log.content(self._index)
+
+    @property
+    def tokens(self) -> int:
+        return self._log.tokens[self._index]
+
+    @tokens.setter
+    def tokens(self, value: int) -> None:
+        self._log.tokens[self._index] = value
+
+    @property
+    def estimated(self) -> bool:
+        return bool(self._log.estimated[self._index])
+
+    @estimated.setter
+    def estimated(self, value: bool) -> None:
+        self._log.estimated[self._index] = value
+
+    def to_message(self) -> Message:
+        return Message(role=self.role, content=self.content, tokens=self.tokens, estimated=self.estimated)
+
+    def to_dict(self) -> dict[str, Any]:
+        return self.to_message().to_dict()
+
+    def __str__(self):
+        return str(self.to_dict())
+
+
+class ColumnarLog(Sequence):
+    """
+    Stores messages column by column instead of as objects: roles and estimated flags as bytes, token counts as
+    unsigned ints, and all contents as UTF-8 in a single bytearray with an offset per message.
+
+    Indexing returns a MessageView. Messages can only be appended, like any memory log.
+    """
+
+    def __init__(self):
+        self.roles = array('B')
+        self.tokens = array('I')
+        self.estimated = array('B')
+        self._arena = bytearray()
+        self._offsets = array('Q', [0])  # Message i is _arena[_offsets[i]:_offsets[i + 1]]
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def __getitem__(self, index: int | slice) -> MessageView | typing.List[MessageView]:
+        if isinstance(index, slice):
+            return [MessageView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ColumnarLog index out of range')
+        return MessageView(self, index)
+
+    def append(self, message: Message) -> None:
+        self.roles.append(message.role)
+        self.tokens.append(message.tokens)
+        self.estimated.append(message.estimated)
+        self._arena += message.content.encode()
+        self._offsets.append(len(self._arena))
+
+    def content(self, index: int) -> str:
+        return self._arena[self._offsets[index]:self._offsets[index + 1]].decode()
+
+    def find(self, message: Message, limit: int = 64) -> int | None:
+        """
+        Finds the newest stored row with the same role and content as a message
+
+        :param message: The message to look for
+        :param limit: How many of the newest rows to check
+        :return: The row's index, or None if it isn't in the last limit rows
+        """
+        encoded = message.content.encode()
+        for index in range(len(self) - 1, max(-1, len(self) - 1 - limit), -1):
+            if self.roles[index] == message.role and \
+                    self._arena[self._offsets[index]:self._offsets[index + 1]] == encoded:
+                return index
+        return None
+
+    def nbytes(self) -> int:
+        """
+        Approximate memory used by the columns' buffers
+        """
+        return (self.roles.itemsize * self.roles.buffer_info()[1] +
+                self.tokens.itemsize * self.tokens.buffer_info()[1] +
+                self.estimated.itemsize * self.estimated.buffer_info()[1] +
+                self._offsets.itemsize * self._offsets.buffer_info()[1] +
+                len(self._arena))
@@ -0,0 +1,33 @@
+import zlib
+import numpy as np
+from memory.text import words
+
+
+class HashingEmbedder:
+    """
+    Embeds text without a model using the hashing trick: every word and pair of neighbouring words is hashed to a
+    dimension and a sign, and the counts are normalized to unit length. Similar wording gives similar vectors.
+
+    crc32 is used instead of hash() so vectors stay the same between runs.
+    """
+
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+
+    def _features(self, text: str) -> list[str]:
+        tokens = words(text)
+        return tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+
+    def embed(self, text: str) -> np.ndarray:
+        """
+        :param text: The text to embed
+        :return: A float32 vector of length dim with a norm of 1, or all zeros if the text has no words
+        """
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode())
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
@@ -1,8 +1,14 @@
 import logging
 import typing
 from memory.factories.memoryfactory import MemoryFactory
+from memory.memory import AbstractMemory
 from memory.no_memory import NoMemory
 from memory.basic_memory import BasicMemory
+from memory.summary_memory import SummaryMemory
+from memory.vector_memory import VectorMemory
+from memory.keyword_memory import KeywordMemory
+from memory.window_memory import WindowMemory
+from AbstractAPI import AbstractAPI
 
 
 class NoMemoryFactory(MemoryFactory):
@@ -14,6 +20,60 @@ class NoMemoryFactory(MemoryFactory):
 
 class BasicMemoryFactory(MemoryFactory):
 
+    def __init__(self, columnar: bool = False):
+        """
+        :param columnar: Make memories that store messages in columns. See BasicMemory
+        """
+        super().__init__()
+        self.columnar = columnar
+
     def make_memory(self) -> BasicMemory:
         self.logger.debug('Creating new BasicMemory')
-        return BasicMemory()
+        return BasicMemory(columnar=self.columnar)
+
+
+class SummaryMemoryFactory(MemoryFactory):
+
+    def __init__(self, api: AbstractAPI, **kwargs):
+        """
+        :param api: The API that generates the summaries
+        :param kwargs: Passed to SummaryMemory
+        """
+        super().__init__()
+        self.api = api
+        self.kwargs = kwargs
+
+    def make_memory(self) -> SummaryMemory:
+        self.logger.debug('Creating new SummaryMemory')
+        return SummaryMemory(self.api, **self.kwargs)
+
+
+class OptionsMemoryFactory(MemoryFactory):
+    """
+    Makes memories of memory_type, passing every memory the same keyword arguments
+    """
+
+    memory_type: typing.Type[AbstractMemory]
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: Passed to memory_type
+        """
+        super().__init__()
+        self.kwargs = kwargs
+
+    def make_memory(self) -> AbstractMemory:
+        self.logger.debug(f'Creating new {self.memory_type.__name__}')
+        return self.memory_type(**self.kwargs)
+
+
+class VectorMemoryFactory(OptionsMemoryFactory):
+    memory_type = VectorMemory
+
+
+class KeywordMemoryFactory(OptionsMemoryFactory):
+    memory_type = KeywordMemory
+
+
+class WindowMemoryFactory(OptionsMemoryFactory):
+    memory_type = WindowMemory
@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import typing
+from memory.memory import AbstractMemory, Message
+from memory.factories.memoryfactory import MemoryFactory
+from jsoncustom.memoryjson import MemoryEncoder, MemoryDecoder
+from AbstractAPI import AbstractAPI
+
+
+class Journal:
+    """
+    An append-only, per-channel log of new messages, so saving costs time proportional to what's new instead of the
+    whole history.
+
+    Each channel has two files in the journal directory:
+        <id>.jsonl          - one record per message added since the last snapshot, and one per exact token count
+                              that replaced an estimate
+        <id>.snapshot.json  - the whole memory as of record number 'seq'
+
+    Appends are buffered and written in batches by a background task, and fsynced every fsync_interval seconds.
+    Compaction writes a new snapshot and empties the journal. Every record has a sequence number, so records already
+    in a snapshot are skipped when replaying.
+
+    A snapshot must hold exactly the records up to its sequence number, so a channel can't be compacted while it has
+    messages that were added to its memory but not appended yet.
+    """
+
+    def __init__(self,
+                 directory: str = 'journal',
+                 *,
+                 flush_interval: float = 1.0,
+                 fsync_interval: float = 5.0,
+                 compact_after: int = 1000):
+        """
+        :param directory: Where the journal and snapshot files are kept
+        :param flush_interval: Seconds between batched writes
+        :param fsync_interval: Seconds between fsyncs of the written files
+        :param compact_after: Number of journal records in a channel that makes it due for compaction
+        """
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.compact_after = compact_after
+
+        self._seq: dict[str, int] = {}  # Last sequence number given out per channel
+        self._records: dict[str, int] = {}  # Records in each channel's journal file
+        self._pending: dict[str, typing.List[str]] = {}  # Lines waiting to be written
+        self._unsynced: set[str] = set()
+        self._last_fsync = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._writer: asyncio.Task | None = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _journal_path(self, channel: str) -> str:
+        return os.path.join(self.directory, f'{channel}.jsonl')
+
+    def _snapshot_path(self, channel: str) -> str:
+        return os.path.join(self.directory, f'{channel}.snapshot.json')
+
+    def append(self, channel_id: int | str, message: Message) -> int:
+        """
+        Queues a message to be written to the channel's journal
+
+        :param channel_id: The channel (memory ID)
+        :param message: The message that was just added to the channel's memory
+        :return: The record's sequence number, for update_tokens()
+        """
+        return self._add_record(str(channel_id), {'message': message.to_dict()})
+
+    def update_tokens(self, channel_id: int | str, seq: int, tokens: int) -> None:
+        """
+        Queues a record replacing a journaled message's estimated token count with the exact one. Messages already
+        in the snapshot get their exact count at the next compaction instead
+
+        :param channel_id: The channel (memory ID)
+        :param seq: The message's sequence number, from append()
+        :param tokens: The exact count
+        """
+        self._add_record(str(channel_id), {'update': seq, 'tokens': tokens})
+
+    def _add_record(self, channel: str, record: dict[str, typing.Any]) -> int:
+        seq = self._seq.get(channel, 0) + 1
+        self._seq[channel] = seq
+        self._records[channel] = self._records.get(channel, 0) + 1
+        self._pending.setdefault(channel, []).append(json.dumps({'seq': seq, **record}))
+        self._ensure_writer()
+        return seq
+
+    def needs_compaction(self, channel_id: int | str) -> bool:
+        return self._records.get(str(channel_id), 0) >= self.compact_after
+
+    def _ensure_writer(self) -> None:
+        if self._writer is not None and not self._writer.done():
+            return
+        try:
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+        except RuntimeError:
+            # No event loop, pending records are written by close()
+            pass
+
+    async def _write_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError as ex:
+                self.logger.error(f'Could not write journal: {repr(ex)}')
+
+    async def flush(self) -> None:
+        """
+        Writes every pending record in a worker thread
+        """
+        async with self._lock:
+            pending = self._pending
+            self._pending = {}
+            fsync = time.monotonic() - self._last_fsync >= self.fsync_interval
+            await asyncio.to_thread(self._write, pending, fsync)
+
+    def _write(self, pending: dict[str, typing.List[str]], fsync: bool) -> None:
+        for channel, lines in pending.items():
+            if len(lines) == 0:
+                continue
+            with open(self._journal_path(channel), 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if not fsync:
+                self._unsynced.add(channel)
+
+        if fsync:
+            for channel in self._unsynced - pending.keys():
+                with open(self._journal_path(channel), 'a') as f:
+                    os.fsync(f.fileno())
+            self._unsynced.clear()
+            self._last_fsync = time.monotonic()
+
+    async def compact(self, channel_id: int | str, memory: AbstractMemory) -> None:
+        """
+        Replaces the channel's snapshot with the current memory and empties its journal
+
+        :param channel_id: The channel (memory ID)
+        :param memory: The channel's memory, holding every message appended so far
+        """
+        channel = str(channel_id)
+        async with self._lock:
+            # Copied together with no await in between, so the snapshot matches the sequence number. Only encoded in
+            # the thread, since the memory keeps changing
+            snapshot = self._snapshot(channel, memory)
+            self._pending.pop(channel, None)
+            self._records[channel] = 0
+            await asyncio.to_thread(self._write_snapshot, channel, snapshot)
+        self.logger.info(f'Compacted journal for channel {channel}')
+
+    def _snapshot(self, channel: str, memory: AbstractMemory) -> dict[str, typing.Any]:
+        return {'seq': self._seq.get(channel, 0), 'memory': memory.to_dict()}
+
+    def _write_snapshot(self, channel: str, snapshot: dict[str, typing.Any]) -> None:
+        temp = self._snapshot_path(channel) + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(json.dumps(snapshot, cls=MemoryEncoder))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self._snapshot_path(channel))
+        # Only truncate once the snapshot is safely in place
+        open(self._journal_path(channel), 'w').close()
+
+    def close(self, memories: dict[str, AbstractMemory] | None = None) -> None:
+        """
+        Writes and fsyncs everything pending. Call at shutdown, after the event loop has stopped.
+
+        :param memories: If given, these channels are compacted as well
+        """
+        if self._writer is not None:
+            self._writer.cancel()
+        self._write(self._pending, True)
+        self._pending = {}
+        for channel, memory in (memories or {}).items():
+            self.write_snapshot(channel, memory)
+
+    def write_snapshot(self, channel_id: int | str, memory: AbstractMemory) -> None:
+        """
+        Compacts a channel right away, on the calling thread. Used outside the event loop (startup and shutdown)
+
+        :param channel_id: The channel (memory ID)
+        :param memory: The channel's memory
+        """
+        channel = str(channel_id)
+        self._pending.pop(channel, None)
+        self._write_snapshot(channel, self._snapshot(channel, memory))
+        self._records[channel] = 0
+
+    def replay(self, factory: MemoryFactory, api: AbstractAPI | None = None) -> dict[str, AbstractMemory]:
+        """
+        Rebuilds every channel's memory from its snapshot and journal
+
+        :param factory: Makes memories for channels that don't have a snapshot yet
+        :param api: Given to memories that need one, see MemoryDecoder
+        :return: The memories by channel ID
+        """
+        channels = set()
+        for name in os.listdir(self.directory):
+            if name.endswith('.snapshot.json'):
+                channels.add(name.removesuffix('.snapshot.json'))
+            elif name.endswith('.jsonl'):
+                channels.add(name.removesuffix('.jsonl'))
+
+        memories = {}
+        for channel in channels:
+            memories[channel] = self._replay_channel(channel, factory, api)
+        self.logger.info(f'Replayed journals of {len(memories)} channels')
+        return memories
+
+    def _replay_channel(self, channel: str, factory: MemoryFactory, api: AbstractAPI | None) -> AbstractMemory:
+        seq = 0
+        memory = None
+        try:
+            with open(self._snapshot_path(channel), 'r') as f:
+                snapshot = json.loads(f.read(), cls=MemoryDecoder, api=api)
+            seq = snapshot['seq']
+            memory = snapshot['memory']
+        except OSError:
+            pass
+        if memory is None:
+            memory = factory.make_memory()
+
+        records = 0
+        replayed: dict[int, Message] = {}  # By sequence number, for token count updates
+        try:
+            with open(self._journal_path(channel), 'rb+') as f:
+                end = 0  # Where the last complete line ends
+                for line in f:
+                    complete = line.endswith(b'\n')
+                    if len(line.strip()) == 0:
+                        end += len(line)
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A write cut off by a crash, everything before it is still good
+                        self.logger.error(f'Skipping unreadable journal record in channel {channel}')
+                        if complete:
+                            end += len(line)
+                        continue
+                    end += len(line)
+                    if not complete:
+                        # The crash came right before the newline. Add it, so the next append starts a new line
+                        f.write(b'\n')
+                        end += 1
+                    records += 1
+                    if record['seq'] <= seq:
+                        continue
+                    if 'update' in record:
+                        message = replayed.get(record['update'])
+                        if message is not None:
+                            memory.set_tokens(message, record['tokens'])
+                    else:
+                        message = Message.from_dict(record['message'])
+                        memory.add_log(message)
+                        replayed[record['seq']] = message
+                    seq = record['seq']
+                # Drop a torn last line, otherwise the next append would be glued onto it
+                f.truncate(end)
+        except OSError:
+            pass
+
+        self._seq[channel] = seq
+        self._records[channel] = records
+        return memory
@@ -0,0 +1,116 @@
+import heapq
+import logging
+import math
+import typing
+from collections import Counter
+from typing import Any
+from memory.memory import AbstractMemory, Message
+from memory.text import words
+
+
+class KeywordMemory(AbstractMemory):
+    """
+    Returns the most recent messages plus the older messages that best match the new one's keywords, scored with BM25.
+
+    An inverted index maps each word to the messages containing it, so a query only looks at messages sharing a word
+    with it. The index is updated as messages are added. Loaded memories build it on the first query instead of at
+    startup.
+    """
+
+    searches_log = True
+
+    def __init__(self, *, top_k: int = 8, recent: int = 8, k1: float = 1.2, b: float = 0.75):
+        """
+        :param top_k: How many matching messages to return
+        :param recent: How many of the newest messages to always return
+        :param k1: BM25 term frequency saturation
+        :param b: BM25 length normalization
+        """
+        self.logger = logging.getLogger(__name__)
+        self.top_k = top_k
+        self.recent = recent
+        self.k1 = k1
+        self.b = b
+
+        self._log: typing.List[Message] = []
+        self._postings: dict[str, list[tuple[int, int]]] = {}  # word -> [(message index, count in message)]
+        self._lengths: typing.List[int] = []  # Word count of each indexed message
+        self._total_length = 0
+
+    @property
+    def log(self) -> typing.List[Message]:
+        return self._log
+
+    def add_log(self, message: Message) -> None:
+        self._log.append(message)
+        # Only index right away if everything before it is indexed, otherwise the next query catches up
+        if len(self._lengths) == len(self._log) - 1:
+            self._index(len(self._log) - 1)
+
+    def _index(self, index: int) -> None:
+        terms = words(self._log[index].content)
+        for term, count in Counter(terms).items():
+            self._postings.setdefault(term, []).append((index, count))
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+
+    def _ensure_index(self) -> None:
+        if len(self._lengths) < len(self._log):
+            self.logger.debug(f'Indexing {len(self._log) - len(self._lengths)} messages')
+            for index in range(len(self._lengths), len(self._log)):
+                self._index(index)
+
+    def search(self, query: str, before: int) -> typing.List[int]:
+        """
+        Scores messages against the query with BM25
+
+        :param query: The text to match
+        :param before: Only messages with an index below this are considered
+        :return: The indexes of the top_k best matches, best first
+        """
+        self._ensure_index()
+        count = len(self._lengths)
+        if count == 0:
+            return []
+        average_length = self._total_length / count
+
+        scores: dict[int, float] = {}
+        for term in set(words(query)):
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, frequency in postings:
+                if index >= before:
+                    # Postings are in order, the rest are newer
+                    break
+                length_norm = 1 - self.b + self.b * self._lengths[index] / average_length
+                score = idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                scores[index] = scores.get(index, 0.0) + score
+
+        return heapq.nlargest(self.top_k, scores, key=scores.__getitem__)
+
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
+        recent_start = max(0, len(self._log) - self.recent)
+        indexes = list(range(len(self._log) - 1, recent_start - 1, -1))
+        if recent_start > 0 and self.top_k > 0:
+            indexes.extend(self.search(message, recent_start))
+
+        return self._trim_to_budget(indexes, budget)
+
+    def header_dict(self) -> dict[str, Any]:
+        return {
+            '__class__': 'KeywordMemory',
+            'top_k': self.top_k,
+            'recent': self.recent
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        # The index isn't stored, it's rebuilt from the log when needed
+        return self.header_dict() | {'log': [o.to_dict() for o in self._log]}
+
+    @classmethod
+    def from_dict(cls, dictionary: dict[str, Any]) -> 'KeywordMemory':
+        mem = cls(top_k=dictionary['top_k'], recent=dictionary['recent'])
+        mem._log = [Message.from_dict(msg_dct) for msg_dct in dictionary['log'] if msg_dct is not None]
+        return mem
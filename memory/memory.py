@@ -7,37 +7,54 @@ from enum import IntEnum
 class Role(IntEnum):
     USER = 0
     ASSISTANT = 1
+    SYSTEM = 2
 
 
 class Message:
 
-    def __init__(self, *, role: Role, content: str, tokens: int = 0):
+    # No per-instance __dict__, which matters with millions of stored messages
+    __slots__ = ('role', 'content', 'tokens', 'estimated')
+
+    def __init__(self, *, role: Role, content: str, tokens: int = 0, estimated: bool = False):
+        """
+        :param role: Who wrote the message
+        :param content: The text
+        :param tokens: The token count
+        :param estimated: True while tokens is only an estimate and the exact count is still pending
+        """
         self.role = role
         self.content = content
         self.tokens = tokens
+        self.estimated = estimated
 
     def __str__(self):
-        return str(self.__dict__())
+        return str(self.to_dict())
 
     @classmethod
     def from_dict(cls, data: dict[str, Any]) -> 'Message':
         return cls(role=data['role'],
                    content=data['content'],
-                   tokens=data['tokens'])
+                   tokens=data['tokens'],
+                   estimated=data.get('estimated', False))
 
     def to_dict(self) -> dict[str, Any]:
-        return {
+        data = {
             'role': self.role,
             'content': self.content,
             'tokens': self.tokens
         }
-
-    def __dict__(self):
-        return self.to_dict()
+        # Only stored when set, since almost every message has an exact count
+        if self.estimated:
+            data['estimated'] = True
+        return data
 
 
 class AbstractMemory(ABC):
 
+    # Whether older messages are searched for ones related to the new message, so the whole log has to be kept instead
+    # of just the newest messages
+    searches_log = False
+
     @property
     @abstractmethod
     def log(self) -> typing.List[Message]:
@@ -53,13 +70,89 @@ class AbstractMemory(ABC):
         pass
 
     @abstractmethod
-    def get_related_history(self, message: str) -> typing.List[int]:
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
+        """
+        Finds the stored messages to include with a new message, most important first.
+
+        :param message: The new message
+        :param budget: The most tokens the returned messages should add up to. No limit if None
+        :param chunk: If above 0, history is trimmed in steps of about this many tokens instead of one message at a
+        time, so the start of the prompt stays the same over several turns. Memories may ignore this
+        :return: Indexes into log
+        """
         pass
 
+    def set_tokens(self, message: Message, tokens: int) -> None:
+        """
+        Updates the token count of a message that was already added, and marks it as exact. Use this instead of
+        setting message.tokens so memories that keep token totals stay correct.
+
+        :param message: The stored message
+        :param tokens: Its token count
+        """
+        message.tokens = tokens
+        message.estimated = False
+
+    def set_generation_slot(self, slot: typing.Callable[[], typing.AsyncContextManager]) -> None:
+        """
+        Gives memories that generate text themselves (e.g. summaries) a way to wait for their turn like user
+        generations do. Ignored by default
+
+        :param slot: Returns an async context manager that holds a generation slot
+        """
+        pass
+
+    def _trim_to_budget(self, indexes: typing.List[int], budget: int | None) -> typing.List[int]:
+        """
+        Cuts a get_related_history() result off at the first message that doesn't fit in the budget
+
+        :param indexes: Indexes of log, most important first
+        :param budget: Most tokens the messages may take. No limit if None
+        :return: The indexes that fit
+        """
+        if budget is None:
+            return indexes
+        tokens = 0
+        log = self.log
+        for i, index in enumerate(indexes):
+            tokens += log[index].tokens
+            if tokens > budget:
+                return indexes[:i]
+        return indexes
+
+    def set_affinity(self, affinity: typing.Hashable) -> None:
+        """
+        Gives memories that generate text themselves the key their channel's generations are routed by, so theirs go
+        to the same server. Ignored by default
+
+        :param affinity: The channel's key, see AbstractAPI.get_response_structured
+        """
+        pass
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether the memory is still changing itself in the background (e.g. writing a summary), so it mustn't be
+        unloaded yet. Never by default
+        """
+        return False
+
     @abstractmethod
     def to_dict(self) -> dict[str, Any]:
         pass
 
+    def header_dict(self) -> dict[str, Any]:
+        """
+        The memory's type and settings from to_dict(), without its messages. Memories with a log override this, so
+        saving settings doesn't copy every message
+
+        :return: to_dict() without 'log' and 'vectors'
+        """
+        header = self.to_dict()
+        header.pop('log', None)
+        header.pop('vectors', None)
+        return header
+
     @classmethod
     @abstractmethod
     def from_dict(cls, dictionary: dict[str, Any]) -> 'AbstractMemory':
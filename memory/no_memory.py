@@ -17,7 +17,7 @@ class NoMemory(AbstractMemory):
     def add_log(self, message: Message) -> None:
         pass
 
-    def get_related_history(self, message: str) -> typing.List[int]:
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
         return []
 
     def to_dict(self) -> dict[str, Any]:
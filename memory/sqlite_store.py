@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+from memory.memory import AbstractMemory, Message
+from jsoncustom.memoryjson import MEMORY_TYPES, MemoryEncoder, memory_from_dict
+from AbstractAPI import AbstractAPI
+
+
+class SQLiteMemoryStore:
+    """
+    Keeps every channel's messages in an SQLite database so memories can be loaded one channel at a time, when first
+    needed, instead of all at startup.
+
+    Messages are stored one row each, keyed by channel and sequence number. A channel's memory is stored separately
+    as its settings without the log (the header). Loading reads the header and only the newest messages, up to
+    tail_tokens, walking the primary key backwards, so it costs the same no matter how long the history is. Memories
+    that search their whole log for related messages (see AbstractMemory.searches_log) are always loaded in full.
+
+    All queries run on a single worker thread, one after another, so writes never block the event loop and reads
+    always see earlier writes.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS memories (
+            channel TEXT PRIMARY KEY,
+            header TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            channel TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            estimated INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel, seq)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: str = 'memory.db', *, tail_tokens: int | None = 4096):
+        """
+        :param path: The database file
+        :param tail_tokens: Tokens of the newest messages loaded into a memory. Everything is loaded if None, and
+        always for memories that search their log
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.tail_tokens = tail_tokens
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory-store')
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # With WAL, only a power loss can lose the last commits, never corrupt the database
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info(messages)')]
+        if 'estimated' not in columns:
+            # Databases made before token counts could be estimates
+            with self._connection:
+                self._connection.execute('ALTER TABLE messages ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0')
+        # Channels with a stored header. Only IDs, so it stays small
+        self._channels = {row[0] for row in self._connection.execute('SELECT channel FROM memories')}
+
+    def _submit(self, fn: typing.Callable, *args) -> Future:
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def _log_error(self, future: Future) -> None:
+        if future.exception() is not None:
+            self.logger.error(f'Memory store write failed: {repr(future.exception())}')
+
+    def append(self, channel_id: int | str, message: Message) -> Future:
+        """
+        Queues a message to be written. The channel's header has to be saved before its first message
+
+        :param channel_id: The channel (memory ID)
+        :param message: The message that was added to the channel's memory
+        :return: A future of the message's sequence number, for update_tokens()
+        """
+        return self._submit(self._insert, str(channel_id), int(message.role), message.content, message.tokens,
+                            message.estimated)
+
+    def _insert(self, channel: str, role: int, content: str, tokens: int, estimated: bool) -> int:
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO messages (channel, seq, role, content, tokens, estimated) '
+                'VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE channel = ?), ?, ?, ?, ?)',
+                (channel, channel, role, content, tokens, int(estimated)))
+            return self._connection.execute('SELECT MAX(seq) FROM messages WHERE channel = ?', (channel,)).fetchone()[0]
+
+    def update_tokens(self, channel_id: int | str, seq: int, tokens: int) -> None:
+        """
+        Queues a stored message's estimated token count to be replaced with the exact one
+
+        :param channel_id: The channel (memory ID)
+        :param seq: The message's sequence number, from append()
+        :param tokens: The exact count
+        """
+        self._submit(self._update_tokens, str(channel_id), seq, tokens)
+
+    def _update_tokens(self, channel: str, seq: int, tokens: int) -> None:
+        with self._connection:
+            self._connection.execute('UPDATE messages SET tokens = ?, estimated = 0 WHERE channel = ? AND seq = ?',
+                                     (tokens, channel, seq))
+
+    def save_header(self, channel_id: int | str, memory: AbstractMemory) -> None:
+        """
+        Queues the memory's type and settings to be written. Call when a channel's memory is created or replaced
+
+        :param channel_id: The channel (memory ID)
+        :param memory: The channel's memory
+        """
+        self.save_headers({channel_id: memory})
+
+    def save_headers(self, memories: dict[int | str, AbstractMemory]) -> Future:
+        """
+        Queues several memories' types and settings to be written in one transaction. Only the settings are copied
+        here, they're encoded and written in the store's thread
+
+        :param memories: The memories by channel (memory ID)
+        :return: A future that's done once they're written
+        """
+        headers = {str(channel): memory.header_dict() for channel, memory in memories.items()}
+        self._channels.update(headers.keys())
+        return self._submit(self._upsert_headers, headers)
+
+    def has_header(self, channel_id: int | str) -> bool:
+        """
+        :param channel_id: The channel (memory ID)
+        :return: Whether a memory is stored (or queued to be) for the channel
+        """
+        return str(channel_id) in self._channels
+
+    def _upsert_headers(self, headers: dict[str, dict[str, typing.Any]]) -> None:
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO memories (channel, header) VALUES (?, ?)',
+                                         ((channel, json.dumps(header, cls=MemoryEncoder))
+                                          for channel, header in headers.items()))
+
+    def import_memory(self, channel_id: int | str, memory: AbstractMemory) -> None:
+        """
+        Queues a whole memory to be written, replacing anything stored for the channel. Used to move memories over
+        from memory.txt
+
+        :param channel_id: The channel (memory ID)
+        :param memory: The channel's memory
+        """
+        # The serialized log leaves out slots that belong in the header, like a summary
+        rows = [(int(msg['role']), msg['content'], msg['tokens'], int(msg.get('estimated', False)))
+                for msg in memory.to_dict()['log'] if msg is not None]
+        self._channels.add(str(channel_id))
+        self._submit(self._replace, str(channel_id), json.dumps(memory.header_dict(), cls=MemoryEncoder), rows)
+
+    def _replace(self, channel: str, header: str, rows: typing.List[tuple[int, str, int, int]]) -> None:
+        with self._connection:
+            self._connection.execute('DELETE FROM messages WHERE channel = ?', (channel,))
+            self._connection.executemany(
+                'INSERT INTO messages (channel, seq, role, content, tokens, estimated) VALUES (?, ?, ?, ?, ?, ?)',
+                ((channel, seq, *row) for seq, row in enumerate(rows, 1)))
+            self._connection.execute('INSERT OR REPLACE INTO memories (channel, header) VALUES (?, ?)',
+                                     (channel, header))
+
+    async def load(self, channel_id: int | str, api: AbstractAPI | None = None) -> AbstractMemory | None:
+        """
+        Loads a channel's memory with the newest messages that fit in tail_tokens
+
+        :param channel_id: The channel (memory ID)
+        :param api: Given to memories that need one, see memory_from_dict
+        :return: The memory, or None if nothing is stored for the channel
+        """
+        loop = asyncio.get_running_loop()
+        header = await loop.run_in_executor(self._executor, self._read, str(channel_id))
+        if header is None:
+            return None
+        return memory_from_dict(header, api)
+
+    def _read(self, channel: str) -> dict[str, Any] | None:
+        row = self._connection.execute('SELECT header FROM memories WHERE channel = ?', (channel,)).fetchone()
+        if row is None:
+            return None
+        header = json.loads(row[0])
+        memory_type = MEMORY_TYPES.get(header['__class__'])
+        tail_tokens = None if memory_type is not None and memory_type.searches_log else self.tail_tokens
+
+        log = []
+        tokens = 0
+        last_seq = 0
+        for seq, role, content, count, estimated in self._connection.execute(
+                'SELECT seq, role, content, tokens, estimated FROM messages WHERE channel = ? ORDER BY seq DESC',
+                (channel,)):
+            last_seq = max(last_seq, seq)
+            if tail_tokens is not None and tokens + count > tail_tokens:
+                break
+            tokens += count
+            msg = {'role': role, 'content': content, 'tokens': count}
+            if estimated:
+                msg['estimated'] = True
+            log.append(msg)
+        log.reverse()
+        header['log'] = log
+
+        if 'summarized' in header:
+            # SummaryMemory counts its summarized messages from the start of the log, which was cut short
+            skipped = last_seq - len(log)
+            header['summarized'] = max(1, header['summarized'] - skipped)
+        return header
+
+    async def flush(self) -> None:
+        """
+        Waits for every queued write to finish
+        """
+        await asyncio.get_running_loop().run_in_executor(self._executor, lambda: None)
+
+    def close(self, memories: dict[str, AbstractMemory] | None = None) -> None:
+        """
+        Finishes queued writes and closes the database. Call at shutdown, after the event loop has stopped.
+
+        :param memories: If given, the headers of these channels are saved first, since some memories change theirs
+        over time (e.g. a summary)
+        """
+        if memories:
+            self.save_headers(memories)
+        self._executor.shutdown(wait=True)
+        self._connection.close()
@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import logging
+import typing
+from typing import Any
+from AbstractAPI import AbstractAPI
+from memory.memory import AbstractMemory, Message, Role
+
+
+class SummaryMemory(AbstractMemory):
+    """
+    Keeps a running summary of older messages plus a window of recent ones.
+
+    Once the messages that aren't summarized yet pass summarize_threshold tokens, the oldest of them are folded into
+    the summary by the API in a background task, leaving about keep_recent_tokens of recent messages. The prompt then
+    only carries the summary and the recent window instead of as much raw history as fits.
+
+    Each summary prompt holds at most the API's history_token_budget of messages, so a long backlog is folded in over
+    several passes. Every pass waits for a generation slot if one was given with set_generation_slot().
+
+    log[0] is always the summary message. It's only returned by get_related_history once a summary exists.
+    """
+
+    SUMMARY_PROMPT = '[Write a short summary of the conversation below. Keep names, facts and anything the ' \
+                     'participants asked to remember]\n\n' \
+                     '{summary}' \
+                     '{conversation}\n\n' \
+                     'Summary:'
+
+    def __init__(self,
+                 api: AbstractAPI | None = None,
+                 *,
+                 summarize_threshold: int = 1024,
+                 keep_recent_tokens: int = 512):
+        """
+        :param api: Generates the summaries. Nothing is summarized until an API is bound
+        :param summarize_threshold: Unsummarized tokens needed before a summary refresh starts
+        :param keep_recent_tokens: Tokens of recent messages left out of the summary after a refresh
+        """
+        self.logger = logging.getLogger(__name__)
+        self.api = api
+        self.summarize_threshold = summarize_threshold
+        self.keep_recent_tokens = keep_recent_tokens
+
+        self._log: typing.List[Message] = [Message(role=Role.SYSTEM, content='', tokens=0)]
+        self._summarized = 1  # Messages before this index are part of the summary
+        self._task: asyncio.Task | None = None
+        self._slot: typing.Callable[[], typing.AsyncContextManager] | None = None
+        self._affinity: typing.Hashable | None = None
+
+    @property
+    def log(self) -> typing.List[Message]:
+        return self._log
+
+    @property
+    def summary(self) -> Message:
+        return self._log[0]
+
+    def bind_api(self, api: AbstractAPI) -> None:
+        """
+        Sets the API used to generate summaries, for memories that were loaded from a file
+
+        :param api: The API
+        """
+        self.api = api
+        self._maybe_summarize()
+
+    def set_generation_slot(self, slot: typing.Callable[[], typing.AsyncContextManager]) -> None:
+        self._slot = slot
+
+    def set_affinity(self, affinity: typing.Hashable) -> None:
+        self._affinity = affinity
+
+    def add_log(self, message: Message) -> None:
+        self._log.append(message)
+        self._maybe_summarize()
+
+    def set_tokens(self, message: Message, tokens: int) -> None:
+        message.tokens = tokens
+        message.estimated = False
+        self._maybe_summarize()
+
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
+        # Newest first, then the summary so it ends up above the recent messages
+        if budget is not None and len(self.summary.content) > 0:
+            budget -= self.summary.tokens
+
+        indexes = []
+        tokens = 0
+        for index in range(len(self._log) - 1, self._summarized - 1, -1):
+            tokens += self._log[index].tokens
+            if budget is not None and tokens > budget:
+                break
+            indexes.append(index)
+
+        if len(self.summary.content) > 0:
+            indexes.append(0)
+        return indexes
+
+    @staticmethod
+    def _tokens(message: Message) -> int:
+        # Counts might not be in yet when a message is added
+        return message.tokens if message.tokens > 0 else AbstractAPI.estimate_tokens(message.content)
+
+    @property
+    def busy(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _maybe_summarize(self) -> None:
+        if self.api is None or (self._task is not None and not self._task.done()):
+            return
+
+        pending = [self._tokens(msg) for msg in self._log[self._summarized:]]
+        if sum(pending) < self.summarize_threshold:
+            return
+
+        # Keep the newest messages that fit in keep_recent_tokens, summarize everything before them
+        end = len(self._log)
+        recent = 0
+        while end > self._summarized and recent + pending[end - 1 - self._summarized] <= self.keep_recent_tokens:
+            end -= 1
+            recent += pending[end - self._summarized]
+        if end == self._summarized:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running in the event loop (e.g. while loading), try again on the next message
+            return
+        self._task = loop.create_task(self._summarize(end))
+
+    async def _summarize(self, end: int) -> None:
+        """
+        Folds the messages up to end into the summary, as many per pass as fit in a prompt
+
+        :param end: Index of the first message to leave out of the summary
+        """
+        while self._summarized < end:
+            summary = f'Earlier summary: {self.summary.content}\n\n' if len(self.summary.content) > 0 else ''
+            stop = self._pass_end(end, self.SUMMARY_PROMPT.format(summary=summary, conversation=''))
+            self.logger.info(f'Summarizing {stop - self._summarized} messages')
+            conversation = '\n'.join(f'{Role(msg.role).name.title()}: {msg.content}'
+                                     for msg in self._log[self._summarized:stop])
+            prompt = self.SUMMARY_PROMPT.format(summary=summary, conversation=conversation)
+
+            try:
+                async with self._slot() if self._slot is not None else contextlib.nullcontext():
+                    # Sent to the channel's server, so it doesn't push another channel's prompt out of its cache
+                    text = (await self.api.get_response(prompt, ['\n\n'], affinity=self._affinity)).strip()
+                if len(text) == 0:
+                    self.logger.info('Got an empty summary, keeping the old one')
+                    return
+                new_summary = Message(role=Role.SYSTEM, content=text, tokens=AbstractAPI.estimate_tokens(text))
+                new_summary.tokens = max(1, await self.api.count_tokens(new_summary))
+            except RuntimeError as ex:
+                self.logger.error(f'Could not summarize: {repr(ex)}')
+                return
+
+            self._log[0] = new_summary
+            self._summarized = stop
+        self.logger.info(f'Summary refreshed, {len(self._log) - end} messages left unsummarized')
+
+    def _pass_end(self, end: int, prompt: str) -> int:
+        """
+        :param end: Index of the first message to leave out of the summary
+        :param prompt: The summary prompt without the conversation
+        :return: Index of the first message to leave out of this pass, which takes at least one message
+        """
+        budget = self.api.history_token_budget(prompt)
+        if budget is None:
+            return end
+        stop = self._summarized + 1
+        tokens = self._tokens(self._log[self._summarized])
+        while stop < end and tokens + self._tokens(self._log[stop]) <= budget:
+            tokens += self._tokens(self._log[stop])
+            stop += 1
+        return stop
+
+    def header_dict(self) -> dict[str, Any]:
+        return {
+            '__class__': 'SummaryMemory',
+            'summarize_threshold': self.summarize_threshold,
+            'keep_recent_tokens': self.keep_recent_tokens,
+            'summary': self.summary.to_dict(),
+            'summarized': self._summarized
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return self.header_dict() | {'log': [o.to_dict() for o in self._log[1:]]}
+
+    @classmethod
+    def from_dict(cls, dictionary: dict[str, Any]) -> 'SummaryMemory':
+        mem = cls(summarize_threshold=dictionary['summarize_threshold'],
+                  keep_recent_tokens=dictionary['keep_recent_tokens'])
+        summary = dictionary['summary']
+        mem._log[0] = Message(role=Role(summary['role']), content=summary['content'], tokens=summary['tokens'])
+        for msg_dct in dictionary['log']:
+            mem._log.append(Message.from_dict(msg_dct))
+        mem._summarized = dictionary['summarized']
+        return mem
@@ -0,0 +1,14 @@
+import re
+import typing
+
+_WORD = re.compile(r"[\w']+")
+
+
+def words(text: str) -> typing.List[str]:
+    """
+    Splits text into lowercase words for keyword matching and embedding. Punctuation is dropped.
+
+    :param text: The text to split
+    :return: The words in order
+    """
+    return _WORD.findall(text.lower())
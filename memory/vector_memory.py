@@ -0,0 +1,103 @@
+import base64
+import logging
+import typing
+from typing import Any
+import numpy as np
+from memory.memory import AbstractMemory, Message
+from memory.embedding import HashingEmbedder
+
+
+class VectorMemory(AbstractMemory):
+    """
+    Returns the most recent messages plus the stored messages most similar to the new one.
+
+    Every message is embedded when added and kept in one contiguous matrix that doubles in size when full, so a query
+    is a single matrix-vector product over all stored messages.
+    """
+
+    searches_log = True
+
+    def __init__(self, *, dim: int = 64, top_k: int = 8, recent: int = 8):
+        """
+        :param dim: Size of the embeddings. Queries read the whole matrix, so this mostly sets the query time
+        :param top_k: How many similar messages to return
+        :param recent: How many of the newest messages to always return
+        """
+        self.logger = logging.getLogger(__name__)
+        self.top_k = top_k
+        self.recent = recent
+        self.embedder = HashingEmbedder(dim)
+
+        self._log: typing.List[Message] = []
+        self._vectors = np.zeros((16, dim), dtype=np.float32)
+
+    @property
+    def log(self) -> typing.List[Message]:
+        return self._log
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        The embeddings of the stored messages, one row per message in log
+        """
+        return self._vectors[:len(self._log)]
+
+    def add_log(self, message: Message) -> None:
+        self._append_vector(self.embedder.embed(message.content))
+        self._log.append(message)
+
+    def _append_vector(self, vector: np.ndarray) -> None:
+        index = len(self._log)
+        if index == len(self._vectors):
+            grown = np.zeros((len(self._vectors) * 2, self.embedder.dim), dtype=np.float32)
+            grown[:index] = self._vectors
+            self._vectors = grown
+        self._vectors[index] = vector
+
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
+        count = len(self._log)
+        recent_start = max(0, count - self.recent)
+        indexes = list(range(count - 1, recent_start - 1, -1))
+
+        if recent_start > 0 and self.top_k > 0:
+            # Cosine similarity, since every stored vector has a norm of 1 (or is zero)
+            similarity = self._vectors[:recent_start] @ self.embedder.embed(message)
+            k = min(self.top_k, recent_start)
+            best = np.argpartition(-similarity, k - 1)[:k]
+            best = best[np.argsort(-similarity[best])]
+            indexes.extend(int(i) for i in best if similarity[i] > 0)
+
+        return self._trim_to_budget(indexes, budget)
+
+    def header_dict(self) -> dict[str, Any]:
+        return {
+            '__class__': 'VectorMemory',
+            'dim': self.embedder.dim,
+            'top_k': self.top_k,
+            'recent': self.recent
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        # Vectors are stored as base64 float16 bytes instead of a list of numbers per message
+        return self.header_dict() | {
+            'vectors': base64.b64encode(self.vectors.astype(np.float16).tobytes()).decode('ascii'),
+            'log': [o.to_dict() for o in self._log]
+        }
+
+    @classmethod
+    def from_dict(cls, dictionary: dict[str, Any]) -> 'VectorMemory':
+        mem = cls(dim=dictionary['dim'], top_k=dictionary['top_k'], recent=dictionary['recent'])
+        messages = [Message.from_dict(msg_dct) for msg_dct in dictionary['log'] if msg_dct is not None]
+
+        vectors = np.frombuffer(base64.b64decode(dictionary.get('vectors', '')), dtype=np.float16)
+        if len(vectors) != len(messages) * mem.embedder.dim:
+            mem.logger.info('Stored vectors don\'t match the log, embedding again')
+            for msg in messages:
+                mem.add_log(msg)
+            return mem
+
+        capacity = max(16, 1 << (len(messages) - 1).bit_length())
+        mem._vectors = np.zeros((capacity, mem.embedder.dim), dtype=np.float32)
+        mem._vectors[:len(messages)] = vectors.reshape(len(messages), mem.embedder.dim)
+        mem._log = messages
+        return mem
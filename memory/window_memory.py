@@ -0,0 +1,85 @@
+import logging
+import typing
+from collections import deque
+from typing import Any
+from memory.memory import AbstractMemory, Message
+
+
+class WindowMemory(AbstractMemory):
+    """
+    Keeps only the newest messages. The oldest are dropped once the stored tokens or messages go over their caps,
+    so a channel's memory use is bounded no matter how long it's been active.
+
+    log is a deque rather than a list, so indexes near either end are fast.
+    """
+
+    def __init__(self, *, max_tokens: int = 4096, max_messages: int = 1000):
+        """
+        :param max_tokens: The most tokens to keep. Should be around what the API can fit in a prompt
+        :param max_messages: The most messages to keep
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self._log: deque[Message] = deque()
+        self._tokens = 0
+
+    @property
+    def log(self) -> typing.Sequence[Message]:
+        return self._log
+
+    @property
+    def tokens(self) -> int:
+        """
+        The total tokens of the stored messages
+        """
+        return self._tokens
+
+    def add_log(self, message: Message) -> None:
+        self._log.append(message)
+        self._tokens += message.tokens
+        self._evict()
+
+    def set_tokens(self, message: Message, tokens: int) -> None:
+        for index in range(len(self._log) - 1, -1, -1):
+            if self._log[index] is message:
+                self._tokens += tokens - message.tokens
+                break
+        message.tokens = tokens
+        message.estimated = False
+        self._evict()
+
+    def _evict(self) -> None:
+        # Always keep the newest message, even if it's over the cap by itself
+        while len(self._log) > 1 and (self._tokens > self.max_tokens or len(self._log) > self.max_messages):
+            self._tokens -= self._log.popleft().tokens
+
+    def get_related_history(self, message: str, budget: int | None = None, chunk: int = 0) -> typing.List[int]:
+        # Newest first, stopping once the budget is used
+        indexes = []
+        tokens = 0
+        for index in range(len(self._log) - 1, -1, -1):
+            tokens += self._log[index].tokens
+            if budget is not None and tokens > budget:
+                break
+            indexes.append(index)
+        return indexes
+
+    def header_dict(self) -> dict[str, Any]:
+        return {
+            '__class__': 'WindowMemory',
+            'max_tokens': self.max_tokens,
+            'max_messages': self.max_messages
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return self.header_dict() | {'log': [o.to_dict() for o in self._log]}
+
+    @classmethod
+    def from_dict(cls, dictionary: dict[str, Any]) -> 'WindowMemory':
+        mem = cls(max_tokens=dictionary['max_tokens'], max_messages=dictionary['max_messages'])
+        for msg_dct in dictionary['log']:
+            if msg_dct is None:
+                continue
+            mem.add_log(Message.from_dict(msg_dct))
+        return mem
@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import logging
+import time
+import typing
+from collections import deque
+
+
+class _Ticket:
+    """
+    A single request waiting for a generation slot
+    """
+
+    def __init__(self, future: asyncio.Future, weight: int):
+        self.future = future
+        self.weight = weight
+        self.enqueued = time.monotonic()
+
+
+class GenerationScheduler:
+    """
+    Limits how many generations run at once and decides who goes next when the limit is reached.
+
+    Waiting requests are queued per key (a channel or guild ID). Keys take turns, so a single busy key can't starve
+    the others. Two policies are supported:
+        round_robin - every key with waiting requests gets one slot per turn
+        weighted    - keys get slots in proportion to their weight (smooth weighted round-robin)
+    """
+
+    POLICIES = ('round_robin', 'weighted')
+
+    def __init__(self,
+                 max_concurrent: int = 1,
+                 *,
+                 policy: typing.Literal['round_robin', 'weighted'] = 'round_robin',
+                 history_size: int = 100):
+        """
+        :param max_concurrent: Maximum number of generations allowed to run at the same time
+        :param policy: How to pick the next key to run. One of POLICIES
+        :param history_size: How many recent wait times to keep for statistics
+        """
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown scheduling policy {policy}')
+
+        self.logger = logging.getLogger(__name__)
+        self.max_concurrent = max_concurrent
+        self.policy = policy
+
+        self._active = 0
+        self._queues: dict[typing.Hashable, deque[_Ticket]] = {}
+        self._order: deque[typing.Hashable] = deque()  # Round-robin order of keys with waiting requests
+        self._current_weight: dict[typing.Hashable, int] = {}  # Used by the weighted policy
+
+        self._waits: deque[float] = deque(maxlen=history_size)
+        self._total_waited = 0
+        self._max_wait = 0.0
+
+    @property
+    def active(self) -> int:
+        """
+        The number of generations currently running
+        """
+        return self._active
+
+    def queue_depth(self, key: typing.Hashable | None = None) -> int:
+        """
+        The number of requests waiting for a slot
+
+        :param key: Only count requests for this key. Counts every key if None
+        :return: The number of waiting requests
+        """
+        if key is not None:
+            return len(self._queues.get(key, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def queue_depths(self) -> dict[typing.Hashable, int]:
+        return {key: len(q) for key, q in self._queues.items()}
+
+    def stats(self) -> dict[str, typing.Any]:
+        """
+        A summary of the scheduler's state and of recent wait times (in seconds)
+        """
+        waits = sorted(self._waits)
+        now = time.monotonic()
+        oldest = [q[0].enqueued for q in self._queues.values() if q]
+        return {
+            'active': self._active,
+            'max_concurrent': self.max_concurrent,
+            'queued': self.queue_depth(),
+            'queues': self.queue_depths(),
+            'oldest_wait': now - min(oldest) if oldest else 0.0,
+            'served': self._total_waited,
+            'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+            'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'max_wait': self._max_wait
+        }
+
+    async def acquire(self, key: typing.Hashable, weight: int = 1) -> None:
+        """
+        Waits until a generation slot is free and it's this key's turn. Must be followed by release().
+
+        :param key: The queue to wait in
+        :param weight: The key's weight, only used by the weighted policy
+        """
+        if self._active < self.max_concurrent and self.queue_depth() == 0:
+            self._active += 1
+            self._record_wait(0.0)
+            return
+
+        ticket = _Ticket(asyncio.get_running_loop().create_future(), max(1, weight))
+        queue = self._queues.setdefault(key, deque())
+        queue.append(ticket)
+        if len(queue) == 1:
+            self._order.append(key)
+        self.logger.debug(f'Queued generation for {key}. Queue depth: {self.queue_depth()}')
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # The slot was granted right as we got cancelled, so give it back
+                self.release()
+            else:
+                self._remove(key, ticket)
+            raise
+
+    def release(self) -> None:
+        """
+        Frees a slot taken by acquire() and hands it to the next waiting request
+        """
+        self._active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key: typing.Hashable, weight: int = 1) -> typing.AsyncIterator[None]:
+        """
+        Holds a generation slot for the duration of the context. See acquire().
+        """
+        await self.acquire(key, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _dispatch(self) -> None:
+        while self._active < self.max_concurrent and self._order:
+            key = self._next_key()
+            queue = self._queues[key]
+            ticket = queue.popleft()
+            if len(queue) == 0:
+                del self._queues[key]
+                self._order.remove(key)
+                self._current_weight.pop(key, None)
+            elif self.policy == 'round_robin':
+                self._order.rotate(-1)
+
+            self._active += 1
+            self._record_wait(time.monotonic() - ticket.enqueued)
+            ticket.future.set_result(None)
+
+    def _next_key(self) -> typing.Hashable:
+        if self.policy == 'round_robin':
+            return self._order[0]
+
+        # Smooth weighted round-robin: everyone gains their weight, the highest goes and pays back the total
+        total = 0
+        best = None
+        for key in self._order:
+            weight = self._queues[key][0].weight
+            total += weight
+            self._current_weight[key] = self._current_weight.get(key, 0) + weight
+            if best is None or self._current_weight[key] > self._current_weight[best]:
+                best = key
+        self._current_weight[best] -= total
+        return best
+
+    def _remove(self, key: typing.Hashable, ticket: _Ticket) -> None:
+        queue = self._queues.get(key)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if len(queue) == 0:
+            del self._queues[key]
+            self._order.remove(key)
+            self._current_weight.pop(key, None)
+
+    def _record_wait(self, wait: float) -> None:
+        self._waits.append(wait)
+        self._total_waited += 1
+        self._max_wait = max(self._max_wait, wait)
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import time
+import typing
+from configuration import Configuration
+from discordhandlers.texthandler import TextHandler
+
+
+def write_atomic(path: str, data: str | bytes) -> None:
+    """
+    Writes a file so it holds either the old or the new contents, never part of either, even after a crash
+
+    :param path: The file to replace
+    :param data: The new contents
+    """
+    temp = path + '.tmp'
+    with open(temp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+class Snapshotter:
+    """
+    Saves the memories and configuration every interval seconds while the bot runs, instead of only at shutdown.
+
+    Copying the data is the only part done on the event loop. Serializing and writing happen in a worker thread,
+    so saving doesn't hold up the Discord gateway.
+    """
+
+    def __init__(self,
+                 handler: TextHandler,
+                 config: Configuration,
+                 *,
+                 interval: float = 300.0,
+                 memory_path: str = 'memory.txt',
+                 config_path: str = 'config.txt'):
+        """
+        :param handler: Holds the memories
+        :param config: The bot configuration
+        :param interval: Seconds between snapshots
+        :param memory_path: Where memories are written, if the handler doesn't have a store or journal for them
+        :param config_path: Where the configuration is written
+        """
+        self.logger = logging.getLogger(__name__)
+        self.handler = handler
+        self.config = config
+        self.interval = interval
+        self.memory_path = memory_path
+        self.config_path = config_path
+        self.last_report: dict[str, float] = {}  # Durations of the last snapshot in seconds
+
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot()
+            except OSError as ex:
+                self.logger.error(f'Could not write snapshot: {repr(ex)}')
+
+    async def snapshot(self) -> dict[str, float]:
+        """
+        Copies the memories and configuration, then writes them in a worker thread
+
+        :return: How long copying, serializing and writing took, in seconds
+        """
+        start = time.perf_counter()
+        options = self.config.snapshot()
+        memories = await self.handler.snapshot_memories()
+        copied = time.perf_counter() - start
+
+        serialized, written = await asyncio.to_thread(self._write, options, memories)
+        self.last_report = {'copy': copied, 'serialize': serialized, 'write': written}
+        self.logger.info(f'Snapshot saved: copied in {copied:.3f}s, serialized in {serialized:.3f}s, '
+                         f'written in {written:.3f}s')
+        return self.last_report
+
+    def _write(self, options: dict, memories: dict[str, dict[str, typing.Any]] | None) -> tuple[float, float]:
+        start = time.perf_counter()
+        files: dict[str, str | bytes] = {self.config_path: Configuration.serialize(options)}
+        if memories is not None:
+            # Same format as TextHandler.save()
+            files[self.memory_path] = self.handler.codec.encode(memories)
+        serialized = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for path, data in files.items():
+            write_atomic(path, data)
+        return serialized, time.perf_counter() - start
@@ -31,7 +31,8 @@ class TestAPI(AbstractAPI):
 
     async def get_response_structured(self, message: str, history: typing.List[Message] | None = None,
                                       indexes: typing.List[int] | None = None,
-                                      options: dict[str, typing.Any] | None = None) -> str:
+                                      options: dict[str, typing.Any] | None = None,
+                                      affinity: typing.Hashable | None = None) -> str:
         if self._val_err:
             self._val_err = False
             raise ValueError('ValueError message')
@@ -48,7 +49,12 @@ class TestAPI(AbstractAPI):
     async def count_tokens(self, text: Message) -> int:
         return await self.sleep(len(text.content))
 
-    def get_response(self, s: str, stop: typing.List[str] | None = None, options: dict[str, typing.Any] | None = None) -> str:
+    async def get_response(self,
+                           s: str,
+                           stop: typing.List[str] | None = None,
+                           options: dict[str, typing.Any] | None = None,
+                           *,
+                           affinity: typing.Hashable | None = None) -> str:
         # Method not directly used by TextHandler
         if self.blank:
             return s
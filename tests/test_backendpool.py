@@ -0,0 +1,228 @@
+import unittest
+from unittest import IsolatedAsyncioTestCase
+import asyncio
+import json
+
+import httpx
+import respx
+from httpx import Response
+
+import koboldai
+from backendpool import BackendPool
+from koboldapi import KoboldAPI
+
+URLS = ['http://backend-a:5001', 'http://backend-b:5001']
+
+
+class BackendPoolTests(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.pool = BackendPool(URLS)
+        self.api = KoboldAPI(pool=self.pool)
+        self.calls = {url: 0 for url in URLS}
+        self.release = asyncio.Event()
+        self.release.set()
+
+        # Every backend says which one it is in its response
+        self.mock = respx.mock(assert_all_called=False)
+        for url in URLS:
+            self.mock.post(url + koboldai.Client.ROUTE_GENERATE).mock(side_effect=self.generate(url))
+            self.mock.get(url + koboldai.Client.ROUTE_VERSION).mock(return_value=Response(200, json={'result': '1.0'}))
+            self.mock.get(url + koboldai.Client.ROUTE_MODEL).mock(return_value=Response(200, json={'result': 'm'}))
+            self.mock.get(url + koboldai.Client.ROUTE_MAX_CONTEXT_LENGTH).mock(
+                return_value=Response(200, json={'value': 4096}))
+            self.mock.get(url + koboldai.Client.ROUTE_MAX_LENGTH).mock(return_value=Response(200, json={'value': 300}))
+
+    def generate(self, url: str):
+        async def side_effect(request: httpx.Request, route):
+            self.calls[url] += 1
+            await self.release.wait()
+            return Response(200, text=json.dumps({'results': [{'text': url}]}))
+        return side_effect
+
+    async def test_least_outstanding(self):
+        with self.mock:
+            self.release.clear()
+            first = asyncio.ensure_future(self.api.get_response('one'))
+            second = asyncio.ensure_future(self.api.get_response('two'))
+            await asyncio.sleep(0.01)
+            # The second request goes to the idle backend
+            self.assertEqual([1, 1], [b.outstanding for b in self.pool.backends])
+            self.release.set()
+            self.assertEqual(sorted(URLS), sorted(await asyncio.gather(first, second)))
+            self.assertEqual([0, 0], [b.outstanding for b in self.pool.backends])
+
+    async def test_affinity(self):
+        with self.mock:
+            first = await self.api.get_response_structured('hi', affinity=1)
+            for _ in range(4):
+                self.assertEqual(first, await self.api.get_response_structured('hi', affinity=1))
+            self.assertEqual(5, self.calls[first])
+            # Another channel sticks to whichever backend it got
+            other = await self.api.get_response_structured('hi', affinity=2)
+            self.assertEqual(other, await self.api.get_response_structured('hi', affinity=2))
+
+    async def test_failed_backend_drains(self):
+        with self.mock:
+            first = await self.api.get_response_structured('hi', affinity=1)
+            self.mock.post(first + koboldai.Client.ROUTE_GENERATE).mock(return_value=Response(503))
+            backend = self.pool.backends[URLS.index(first)]
+            with self.assertRaises(RuntimeError):
+                await self.api.get_response_structured('hi', affinity=1)
+            # One failure doesn't take the backend out of the pool
+            self.assertIn(backend, self.pool.healthy)
+
+            # It's skipped once its breaker opens, and the channel moves to the other backend
+            while not backend.client.breaker.is_open:
+                with self.assertRaises(RuntimeError):
+                    await self.api.get_response_structured('hi', affinity=1)
+            other = await self.api.get_response_structured('hi', affinity=1)
+            self.assertNotEqual(first, other)
+            self.assertEqual(other, await self.api.get_response_structured('hi', affinity=1))
+
+    async def test_single_backend_kept(self):
+        pool = BackendPool(URLS[:1])
+        api = KoboldAPI(pool=pool)
+        with self.mock:
+            self.mock.post(URLS[0] + koboldai.Client.ROUTE_GENERATE).mock(return_value=Response(503))
+            with self.assertRaises(RuntimeError):
+                await api.get_response('hi')
+            self.mock.post(URLS[0] + koboldai.Client.ROUTE_GENERATE).mock(side_effect=self.generate(URLS[0]))
+            self.assertEqual(URLS[0], await api.get_response('hi'))
+
+    async def test_rejected_request_keeps_backend(self):
+        with self.mock:
+            first = await self.api.get_response_structured('hi', affinity=1)
+            self.mock.post(first + koboldai.Client.ROUTE_GENERATE).mock(return_value=Response(422))
+            with self.assertRaises(koboldai.RequestRejectedError):
+                await self.api.get_response_structured('hi', affinity=1)
+            self.assertTrue(self.pool.backends[URLS.index(first)].healthy)
+            self.assertEqual(koboldai.CircuitBreaker.CLOSED, self.pool.backends[URLS.index(first)].client.breaker.state)
+
+    async def test_probe(self):
+        with self.mock:
+            self.pool.backends[0].healthy = False
+            self.mock.get(URLS[1] + koboldai.Client.ROUTE_VERSION).mock(return_value=Response(500))
+            await self.pool.probe_all()
+            self.assertEqual([True, False], [b.healthy for b in self.pool.backends])
+            self.assertEqual('m', self.pool.backends[0].model)
+
+    async def test_limits(self):
+        with self.mock:
+            # Defaults until probed
+            self.assertIsNone(self.pool.limits())
+            self.assertEqual(KoboldAPI.DEFAULT_MAX_CONTEXT_LENGTH, self.api.max_tokens)
+            self.assertEqual(KoboldAPI.DEFAULT_MAX_LENGTH, self.api.max_length)
+
+            # The smallest backend decides
+            self.mock.get(URLS[1] + koboldai.Client.ROUTE_MAX_CONTEXT_LENGTH).mock(
+                return_value=Response(200, json={'value': 8192}))
+            await self.pool.probe_all()
+            self.assertEqual((4096, 300), self.pool.limits())
+            self.assertEqual(4096, self.api.max_tokens)
+            self.assertEqual(300, self.api.max_length)
+            await self.api.get_response('hi')
+            self.assertEqual(4096, json.loads(self.mock.calls.last.request.content)['max_context_length'])
+
+            # Cached until the model changes
+            self.mock.get(URLS[0] + koboldai.Client.ROUTE_MAX_CONTEXT_LENGTH).mock(
+                return_value=Response(200, json={'value': 1024}))
+            await self.pool.probe_all()
+            self.assertEqual((4096, 300), self.pool.limits())
+            self.mock.get(URLS[0] + koboldai.Client.ROUTE_MODEL).mock(return_value=Response(200, json={'result': 'small'}))
+            await self.pool.probe_all()
+            self.assertEqual((1024, 300), self.pool.limits())
+            # Half the context at most is generated
+            self.assertEqual(512, KoboldAPI(pool=self.pool, response_length=1000).max_length)
+
+    async def test_limits_ttl(self):
+        self.pool.limits_ttl = 0
+        with self.mock:
+            await self.pool.probe_all()
+            self.mock.get(URLS[0] + koboldai.Client.ROUTE_MAX_LENGTH).mock(return_value=Response(200, json={'value': 50}))
+            await self.pool.probe_all()
+            self.assertEqual((4096, 50), self.pool.limits())
+            # A fixed response length overrides the servers'
+            self.assertEqual(80, KoboldAPI(pool=self.pool, response_length=80).max_length)
+
+    async def test_limits_set_together(self):
+        with self.mock:
+            # The context length is answered, the generation length fails
+            self.mock.get(URLS[1] + koboldai.Client.ROUTE_MAX_LENGTH).mock(return_value=Response(503))
+            await self.pool.probe_all()
+            self.assertIsNone(self.pool.backends[1].max_context_length)
+            self.assertFalse(self.pool.backends[1].healthy)
+            self.assertEqual((4096, 300), self.pool.limits())
+            # Only half-known limits are ignored, even with no healthy backend
+            self.pool.backends[0].healthy = False
+            self.pool.backends[0].max_length = None
+            self.assertIsNone(self.pool.limits())
+
+    async def test_count_batch_per_backend(self):
+        # The backends have different tokenizers, so each needs its own separator IDs
+        def tokenize(offset: int):
+            def side_effect(request: httpx.Request, route):
+                ids = [offset + sum(word.encode()) for word in json.loads(request.content)['prompt'].split()]
+                return Response(200, json={'value': len(ids), 'ids': ids})
+            return side_effect
+
+        with self.mock:
+            for i, url in enumerate(URLS):
+                self.mock.post(url + koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokenize(i * 100))
+            for _ in range(2 * len(URLS)):
+                self.assertEqual([2, 1], await self.api._count_batch(['a bb', 'ccc']))
+            self.assertEqual(len(URLS), len(self.api._separator_ids))
+
+    async def test_prefix_match_per_backend(self):
+        with self.mock:
+            first = await self.api.get_response('abcd', affinity=1)
+            other = await self.api.get_response('wxyz', affinity=2)
+            self.assertNotEqual(first, other)
+            # Compared with the last prompt on the same backend, not the last one sent
+            await self.api.get_response('abcdefgh', affinity=1)
+            self.assertEqual(0.5, self.api.last_prefix_match)
+            stats = self.api.prompt_cache_stats()
+            self.assertEqual(3, stats['prompts'])
+            self.assertEqual({'prompts': 2, 'last_prefix_match': 0.5, 'mean_prefix_match': 0.25},
+                             stats['backends'][first])
+            self.assertEqual(1, stats['backends'][other]['prompts'])
+
+    async def test_none_healthy(self):
+        for backend in self.pool.backends:
+            backend.healthy = False
+        with self.assertRaises(RuntimeError):
+            await self.api.get_response('hi')
+
+    async def test_open_breaker_skipped(self):
+        with self.mock:
+            breaker = self.pool.backends[0].client.breaker
+            breaker.failure_threshold = 1
+            breaker.record_failure()
+            for _ in range(3):
+                self.assertEqual(URLS[1], await self.api.get_response('hi'))
+
+    async def test_hedged(self):
+        pool = BackendPool(URLS, hedge_delay=0.01)
+        slow = asyncio.Event()
+
+        async def slow_count(request, route):
+            await slow.wait()
+            return Response(200, json={'value': 1, 'ids': [0]})
+
+        with respx.mock(assert_all_called=False) as mock:
+            mock.post(URLS[0] + koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=slow_count)
+            mock.post(URLS[1] + koboldai.Client.ROUTE_TOKENCOUNT).mock(
+                return_value=Response(200, json={'value': 2, 'ids': [0, 1]}))
+            # The first request goes to backend a, which doesn't answer in time
+            pool._next = len(URLS) - 1
+            self.assertEqual(2, await pool.hedged(lambda backend: backend.client.tokencount('hi')))
+            self.assertEqual(1, pool.metrics['hedges'])
+            self.assertEqual(1, pool.metrics['hedge_wins'])
+            self.assertEqual([1, 1], [b.requests for b in pool.backends])
+            await asyncio.sleep(0)
+            # The slow request was cancelled
+            self.assertEqual([0, 0], [b.outstanding for b in pool.backends])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from memory.basic_memory import BasicMemory
+from memory.summary_memory import SummaryMemory
+from memory.window_memory import WindowMemory
+from memory.memory import Message, Role
+from jsoncustom.codec import JSONCodec, JSONLinesCodec, MsgpackCodec, detect_codec, get_codec, load_memories
+from jsoncustom.memoryjson import MemoryDecoder
+
+
+def make_memories() -> dict:
+    basic = BasicMemory()
+    window = WindowMemory(max_tokens=100, max_messages=10)
+    for i in range(5):
+        basic.add_log(Message(role=Role(i % 2), content=f'basic {i} "quoted" ünicode', tokens=i + 1))
+        window.add_log(Message(role=Role(i % 2), content=f'window {i}', tokens=2))
+    summary = SummaryMemory()
+    summary.add_log(Message(role=Role.USER, content='summarized', tokens=3))
+    return {'1': basic, '2': window, '3': summary}
+
+
+class CodecTests(unittest.TestCase):
+
+    def assertSameMemories(self, expected: dict, actual: dict):
+        self.assertEqual(list(expected.keys()), list(actual.keys()))
+        for key in expected:
+            self.assertIs(type(expected[key]), type(actual[key]))
+            self.assertEqual(expected[key].to_dict(), actual[key].to_dict())
+
+    def round_trip(self, codec):
+        memories = make_memories()
+        data = codec.encode(memories)
+        self.assertSameMemories(memories, detect_codec(io.BytesIO(data)).decode(data))
+        # Dicts (e.g. from a snapshot) encode the same as the memories
+        self.assertEqual(data, codec.encode({key: mem.to_dict() for key, mem in memories.items()}))
+
+    def test_json(self):
+        self.round_trip(JSONCodec())
+
+    def test_json_is_legacy_format(self):
+        memories = make_memories()
+        data = JSONCodec().encode(memories)
+        self.assertSameMemories(memories, json.loads(data, cls=MemoryDecoder))
+
+    def test_jsonl(self):
+        self.round_trip(JSONLinesCodec())
+
+    def test_jsonl_without_orjson(self):
+        self.round_trip(JSONLinesCodec(use_orjson=False))
+
+    def test_jsonl_readable_either_way(self):
+        memories = make_memories()
+        data = JSONLinesCodec(use_orjson=False).encode(memories)
+        self.assertSameMemories(memories, JSONLinesCodec().decode(data))
+
+    def test_msgpack(self):
+        try:
+            codec = MsgpackCodec()
+        except ImportError:
+            self.skipTest('msgpack not installed')
+        self.round_trip(codec)
+
+    def test_detect(self):
+        for codec in [JSONCodec(), JSONLinesCodec()]:
+            stream = io.BytesIO(codec.encode(make_memories()))
+            self.assertIsInstance(detect_codec(stream), type(codec))
+
+    def test_load_file(self):
+        memories = make_memories()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'memory.txt')
+            for codec in [JSONCodec(), JSONLinesCodec()]:
+                with open(path, 'wb') as f:
+                    f.write(codec.encode(memories))
+                self.assertSameMemories(memories, load_memories(path))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, get_codec, 'xml')
+
+
+if __name__ == '__main__':
+    unittest.main()
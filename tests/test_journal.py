@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from memory.basic_memory import BasicMemory
+from memory.factories.factories import BasicMemoryFactory
+from memory.journal import Journal
+from memory.memory import Message, Role
+
+
+class JournalTests(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = Journal(self.dir.name, flush_interval=0.01, fsync_interval=0, compact_after=3)
+
+    def tearDown(self):
+        self.journal.close()
+        self.dir.cleanup()
+
+    def add(self, memory: BasicMemory, content: str) -> None:
+        msg = Message(role=Role.USER, content=content, tokens=1)
+        memory.add_log(msg)
+        self.journal.append(0, msg)
+
+    def replay(self) -> dict:
+        return Journal(self.dir.name).replay(BasicMemoryFactory())
+
+    async def test_replay_after_flush(self):
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        self.add(memory, 'two')
+        await self.journal.flush()
+
+        replayed = self.replay()
+        self.assertEqual([msg.content for msg in replayed['0'].log], ['one', 'two'])
+
+    async def test_compaction_skips_snapshotted_records(self):
+        memory = BasicMemory()
+        for content in ['one', 'two', 'three']:
+            self.add(memory, content)
+        await self.journal.flush()
+        self.assertTrue(self.journal.needs_compaction(0))
+
+        await self.journal.compact(0, memory)
+        self.assertFalse(self.journal.needs_compaction(0))
+        self.assertEqual(os.path.getsize(os.path.join(self.dir.name, '0.jsonl')), 0)
+
+        self.add(memory, 'four')
+        await self.journal.flush()
+        replayed = self.replay()
+        self.assertEqual([msg.content for msg in replayed['0'].log], ['one', 'two', 'three', 'four'])
+
+    async def test_token_updates_replayed(self):
+        memory = BasicMemory()
+        msg = Message(role=Role.USER, content='one', tokens=1, estimated=True)
+        memory.add_log(msg)
+        seq = self.journal.append(0, msg)
+        memory.set_tokens(msg, 4)
+        self.journal.update_tokens(0, seq, 4)
+        await self.journal.flush()
+
+        replayed = self.replay()['0']
+        self.assertEqual([(4, False)], [(m.tokens, m.estimated) for m in replayed.log])
+
+    async def test_stale_records_ignored(self):
+        # A crash between writing the snapshot and truncating leaves records the snapshot already has
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        await self.journal.flush()
+        path = os.path.join(self.dir.name, '0.jsonl')
+        with open(path) as f:
+            stale = f.read()
+
+        await self.journal.compact(0, memory)
+        with open(path, 'w') as f:
+            f.write(stale)
+
+        replayed = self.replay()
+        self.assertEqual([msg.content for msg in replayed['0'].log], ['one'])
+
+    async def test_torn_record_skipped(self):
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        await self.journal.flush()
+        with open(os.path.join(self.dir.name, '0.jsonl'), 'a') as f:
+            f.write('{"seq": 2, "mess')
+
+        replayed = self.replay()
+        self.assertEqual([msg.content for msg in replayed['0'].log], ['one'])
+
+    async def test_append_after_torn_record(self):
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        await self.journal.flush()
+        with open(os.path.join(self.dir.name, '0.jsonl'), 'a') as f:
+            f.write('{"seq": 2, "mess')
+
+        # After a restart the next record goes on a line of its own
+        self.journal.close()
+        self.journal = Journal(self.dir.name, flush_interval=0.01, fsync_interval=0)
+        memory = self.journal.replay(BasicMemoryFactory())['0']
+        self.add(memory, 'two')
+        await self.journal.flush()
+        self.assertEqual([msg.content for msg in self.replay()['0'].log], ['one', 'two'])
+
+    async def test_missing_newline(self):
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        await self.journal.flush()
+        path = os.path.join(self.dir.name, '0.jsonl')
+        with open(path) as f:
+            content = f.read()
+        with open(path, 'w') as f:
+            f.write(content.rstrip('\n'))
+
+        self.journal.close()
+        self.journal = Journal(self.dir.name, flush_interval=0.01, fsync_interval=0)
+        memory = self.journal.replay(BasicMemoryFactory())['0']
+        self.add(memory, 'two')
+        await self.journal.flush()
+        self.assertEqual([msg.content for msg in self.replay()['0'].log], ['one', 'two'])
+
+    def test_close_writes_pending(self):
+        memory = BasicMemory()
+        self.add(memory, 'one')
+        self.journal.close()
+
+        replayed = self.replay()
+        self.assertEqual([msg.content for msg in replayed['0'].log], ['one'])
+
+
+if __name__ == '__main__':
+    unittest.main()
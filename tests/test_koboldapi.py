@@ -9,6 +9,8 @@ import koboldapi
 from koboldapi import KoboldAPI
 import koboldai
 from memory.memory import Message, Role
+from localtokenizer import LocalTokenizer, load_tokenizer
+from tokencache import TokenCountCache
 
 import respx
 from httpx import Response
@@ -28,6 +30,25 @@ def tokencount_side_effect(request: httpx.Request, route):
     return Response(200, content=json.dumps(result))
 
 
+def tokenize_side_effect(request: httpx.Request, route):
+    # Every whitespace separated word is a token, and the same word always gets the same ID
+    cont: dict[str, str] = json.loads(request.content)
+    ids = [sum(word.encode()) for word in cont['prompt'].split()]
+    return Response(200, content=json.dumps({'value': len(ids), 'ids': ids}))
+
+
+def sse_body(tokens: list[str]) -> bytes:
+    # Format tokens the same way KoboldCpp's stream endpoint does
+    events = [f'event: message\ndata: {json.dumps({"token": t, "finish_reason": None})}\n\n' for t in tokens]
+    return ''.join(events).encode()
+
+
+class WordTokenizer(LocalTokenizer):
+    # Same counting rule as tokencount_side_effect
+    def encode(self, text: str) -> list[int]:
+        return [i for i in range(len(text.split(' ')))]
+
+
 class KoboldAITests(IsolatedAsyncioTestCase):
 
     base_url = 'http://localhost:5001'
@@ -158,6 +179,23 @@ class KoboldAITests(IsolatedAsyncioTestCase):
         generated = await self.client.generate('\n Hello world')
         self.assertEqual('Gen:\n Hello world', generated)
 
+    @respx.mock(base_url=base_url)
+    async def test_generate_stream(self, respx_mock):
+        respx_mock.post(koboldai.Client.ROUTE_GENERATE_STREAM).mock(
+            return_value=Response(200, content=sse_body(['Hel', 'lo', ' world']))
+        )
+        chunks = [chunk async for chunk in self.client.generate_stream('test str')]
+        self.assertEqual(['Hel', 'lo', ' world'], chunks)
+
+    @respx.mock(base_url=base_url)
+    async def test_generate_stream_stat_err(self, respx_mock):
+        respx_mock.post(koboldai.Client.ROUTE_GENERATE_STREAM).mock(
+            return_value=Response(503)
+        )
+        with self.assertRaises(RuntimeError):
+            async for _ in self.client.generate_stream('test str'):
+                pass
+
     @respx.mock(base_url=base_url)
     async def test_tokencount(self, respx_mock):
         respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(
@@ -169,6 +207,124 @@ class KoboldAITests(IsolatedAsyncioTestCase):
         self.assertEqual(4, res)
 
 
+    @respx.mock(base_url=base_url)
+    async def test_retry_idempotent(self, respx_mock):
+        self.client.retry = koboldai.RetryPolicy(attempts=3, base_delay=0.01)
+        route = respx_mock.get(koboldai.Client.ROUTE_MODEL).mock(
+            side_effect=[Response(503), httpx.ConnectError('down'), Response(200, json={'result': 'm'})]
+        )
+        self.assertEqual('m', await self.client.model())
+        self.assertEqual(3, route.call_count)
+        self.assertEqual(2, self.client.metrics['retries'])
+        self.assertEqual(2, self.client.metrics['failures'])
+
+    @respx.mock(base_url=base_url)
+    async def test_no_retry(self, respx_mock):
+        self.client.retry = koboldai.RetryPolicy(attempts=3, base_delay=0.01)
+        # Generating isn't idempotent, and client errors won't go away by retrying
+        generate = respx_mock.post(koboldai.Client.ROUTE_GENERATE).mock(return_value=Response(503))
+        model = respx_mock.get(koboldai.Client.ROUTE_MODEL).mock(return_value=Response(404))
+        with self.assertRaises(RuntimeError):
+            await self.client.generate('test str')
+        with self.assertRaises(RuntimeError):
+            await self.client.model()
+        self.assertEqual(1, generate.call_count)
+        self.assertEqual(1, model.call_count)
+        self.assertEqual(0, self.client.metrics['retries'])
+
+    @respx.mock(base_url=base_url)
+    async def test_circuit_breaker(self, respx_mock):
+        self.client.retry = koboldai.RetryPolicy(attempts=1)
+        self.client.breaker = koboldai.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        route = respx_mock.get(koboldai.Client.ROUTE_VERSION).mock(return_value=Response(503))
+
+        for _ in range(3):
+            with self.assertRaises(RuntimeError):
+                await self.client.version()
+        # The third call failed without a request
+        self.assertEqual(2, route.call_count)
+        self.assertTrue(self.client.breaker.is_open)
+        self.assertEqual(1, self.client.metrics['rejected'])
+        self.assertEqual(1, self.client.metrics['breaker_opened'])
+
+        # After the timeout a trial request closes the breaker again
+        await asyncio.sleep(0.06)
+        route.mock(return_value=Response(200, json={'result': '1.0'}))
+        self.assertEqual('1.0', await self.client.version())
+        self.assertEqual(koboldai.CircuitBreaker.CLOSED, self.client.breaker.state)
+
+    @respx.mock(base_url=base_url)
+    async def test_route_timeouts(self, respx_mock):
+        self.client.timeouts = koboldai.TimeoutPolicy(tokencount=2.0, slack=2.0, generate_min=1.0)
+        self.client.throughput = 100.0
+        count = respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokencount_side_effect)
+        generate = respx_mock.post(koboldai.Client.ROUTE_GENERATE).mock(side_effect=gen_side_effect)
+
+        await self.client.tokencount('random text')
+        self.assertEqual(2.0, count.calls.last.request.extensions['timeout']['read'])
+        # 400 tokens at 100 tokens/s, with a prompt of 10 tokens worth half a token, doubled
+        await self.client.generate('x' * 10 * koboldai.Client.CHARS_PER_TOKEN, max_length=400)
+        self.assertAlmostEqual(8.01, generate.calls.last.request.extensions['timeout']['read'])
+
+    def test_record_generation(self):
+        self.client.timeouts = koboldai.TimeoutPolicy(prompt_weight=0.0, smoothing=0.5)
+        self.client.record_generation(100, 50, 5.0)
+        self.assertEqual(10.0, self.client.throughput)  # The first measurement replaces the assumed throughput
+        self.client.record_generation(100, 50, 2.5)
+        self.assertEqual(15.0, self.client.throughput)
+        self.assertEqual(2, self.client.generations_measured)
+        self.assertEqual(4.0, self.client.estimate_duration(1000, 60))
+
+    @respx.mock(base_url=base_url)
+    async def test_generate_stream_measured(self, respx_mock):
+        respx_mock.post(koboldai.Client.ROUTE_GENERATE_STREAM).mock(
+            return_value=Response(200, content=sse_body(['Hel', 'lo']))
+        )
+        chunks = [chunk async for chunk in self.client.generate_stream('test str')]
+        self.assertEqual(['Hel', 'lo'], chunks)
+        self.assertEqual(1, self.client.generations_measured)
+
+    @respx.mock(base_url=base_url)
+    async def test_shared_connections(self, respx_mock):
+        respx_mock.get(koboldai.Client.ROUTE_MODEL).mock(return_value=Response(200, json={'result': 'm'}))
+        async with koboldai.ConnectionPool(max_connections=2) as connections:
+            first = koboldai.Client(self.base_url, connections=connections)
+            second = koboldai.Client(self.base_url, connections=connections)
+            self.assertIs(first.http_client, second.http_client)
+            await first.model()
+            await second.model()
+            self.assertEqual(2, connections.stats(self.base_url)['requests'])
+            http_client = first.http_client
+        self.assertTrue(http_client.is_closed)
+        # Used again after closing, a new client is made
+        self.assertFalse(first.http_client.is_closed)
+        await connections.aclose()
+
+    def test_http2_needs_h2(self):
+        try:
+            import h2  # noqa: F401
+            self.skipTest('h2 is installed')
+        except ImportError:
+            self.assertRaises(ImportError, koboldai.ConnectionPool, http2=True)
+
+    def test_breaker_half_open(self):
+        breaker = koboldai.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.assertTrue(breaker.record_failure())
+        self.assertTrue(breaker.allow())
+        self.assertEqual(koboldai.CircuitBreaker.HALF_OPEN, breaker.state)
+        # A failed trial opens it straight away
+        breaker.failures = 0
+        breaker.record_failure()
+        self.assertEqual(koboldai.CircuitBreaker.OPEN, breaker.state)
+
+    def test_retry_delay(self):
+        policy = koboldai.RetryPolicy(attempts=5, base_delay=0.5, max_delay=1.5)
+        for attempt, bound in enumerate([0.5, 1.0, 1.5, 1.5]):
+            for _ in range(20):
+                self.assertTrue(0 <= policy.delay(attempt) <= bound)
+        self.assertRaises(ValueError, koboldai.RetryPolicy, 0)
+
+
 class KoboldCppAPITests(IsolatedAsyncioTestCase):
 
     base_url = 'http://localhost:5001'
@@ -321,6 +477,131 @@ class KoboldCppAPITests(IsolatedAsyncioTestCase):
             with self.assertRaises(ValueError):
                 response = await self.api.get_response_structured('test message', history, order)
 
+    def test_structure_prompt_estimate_margin(self):
+        budget = self.api.history_token_budget('test message')
+        exact = [Message(role=Role.USER, content='past message', tokens=budget)]
+        self.assertIn('past message', self.api.structure_prompt('test message', exact, [0]))
+        # The same count as an estimate doesn't fit once the margin is added
+        estimated = [Message(role=Role.USER, content='past message', tokens=budget, estimated=True)]
+        self.assertNotIn('past message', self.api.structure_prompt('test message', estimated, [0]))
+
+    async def test_get_response_structured_stream(self):
+        with self.api_mock:
+            self.api_mock.post(koboldai.Client.ROUTE_GENERATE_STREAM).mock(
+                return_value=Response(200, content=sse_body(['Hi', ' there', '\nUs', 'er:']))
+            )
+            chunks = [c async for c in self.api.get_response_structured_stream('test message', [], [])]
+            # The stop sequence is held back and removed
+            self.assertEqual('Hi there\n', ''.join(chunks))
+            self.assertFalse(any('Us' in c for c in chunks))
+
+    async def test_count_tokens(self):
+        with self.api_mock:
+            res = await self.api.count_tokens(Message(role=Role.USER, content='random text two'))
+            # Role prefix is counted too
+            self.assertEqual(4, res)
+            self.assertTrue(self.api_mock.routes[0].called)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_local(self, respx_mock):
+        # No routes are mocked, so any request fails the test
+        self.api.tokenizer = WordTokenizer()
+        res = await self.api.count_tokens(Message(role=Role.USER, content='random text two'))
+        self.assertEqual(4, res)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_cached(self, respx_mock):
+        tokencount = respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokencount_side_effect)
+        model = respx_mock.get(koboldai.Client.ROUTE_MODEL).mock(return_value=Response(200, text='{"result": "m1"}'))
+        self.api.cache = TokenCountCache()
+
+        msg = Message(role=Role.USER, content='random text two')
+        self.assertEqual(4, await self.api.count_tokens(msg))
+        self.assertEqual(4, await self.api.count_tokens(msg))
+        self.assertEqual(1, tokencount.call_count)
+        self.assertEqual(1, model.call_count)
+
+        # A new model invalidates the cache
+        model.mock(return_value=Response(200, text='{"result": "m2"}'))
+        self.api.model_check_interval = 0
+        self.assertEqual(4, await self.api.count_tokens(msg))
+        self.assertEqual(2, tokencount.call_count)
+        self.assertEqual('m2', self.api.cache.model)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_local_cached(self, respx_mock):
+        # No routes are mocked, so asking the server for its model fails the test
+        self.api.tokenizer = WordTokenizer()
+        self.api.cache = TokenCountCache()
+        msg = Message(role=Role.USER, content='random text two')
+        self.assertEqual(4, await self.api.count_tokens(msg))
+        self.assertEqual([4], await self.api.count_tokens_many([msg]))
+        self.assertEqual('WordTokenizer:None', self.api.cache.model)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_model_check_failed(self, respx_mock):
+        respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokencount_side_effect)
+        respx_mock.get(koboldai.Client.ROUTE_MODEL).mock(return_value=Response(404))
+        self.api.cache = TokenCountCache()
+        self.assertEqual(4, await self.api.count_tokens(Message(role=Role.USER, content='random text two')))
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_many(self, respx_mock):
+        tokencount = respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokenize_side_effect)
+        messages = [Message(role=Role(i % 2), content=' '.join(['word'] * i)) for i in range(6)]
+        counts = await self.api.count_tokens_many(messages)
+        self.assertEqual([i + 1 for i in range(6)], counts)
+        # One request for the separator, one for the batch
+        self.assertEqual(2, tokencount.call_count)
+
+        counts = await self.api.count_tokens_many(messages)
+        self.assertEqual([i + 1 for i in range(6)], counts)
+        self.assertEqual(3, tokencount.call_count)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_many_fallback(self, respx_mock):
+        # The separator merges with the words around it when only splitting on spaces, so the batch can't be split
+        def merging_side_effect(request: httpx.Request, route):
+            ids = [sum(word.encode()) for word in json.loads(request.content)['prompt'].split(' ')]
+            return Response(200, content=json.dumps({'value': len(ids), 'ids': ids}))
+
+        tokencount = respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=merging_side_effect)
+        messages = [Message(role=Role.USER, content='a b'), Message(role=Role.ASSISTANT, content='c')]
+        counts = await self.api.count_tokens_many(messages)
+        self.assertEqual([3, 2], counts)
+        self.assertEqual(4, tokencount.call_count)
+
+    @respx.mock(base_url=base_url)
+    async def test_count_tokens_many_split_batches(self, respx_mock):
+        tokencount = respx_mock.post(koboldai.Client.ROUTE_TOKENCOUNT).mock(side_effect=tokenize_side_effect)
+        self.api.max_batch_chars = 40
+        messages = [Message(role=Role.USER, content='word word') for _ in range(4)]
+        counts = await self.api.count_tokens_many(messages)
+        self.assertEqual([3] * 4, counts)
+        # Separator, then two batches of two
+        self.assertEqual(3, tokencount.call_count)
+
+    def test_load_tokenizer_unknown(self):
+        with self.assertRaises(ValueError):
+            load_tokenizer('tokenizer.bin')
+
+    async def test_prefix_match(self):
+        with self.api_mock:
+            await self.api.get_response('abcd')
+            self.assertEqual(0.0, self.api.last_prefix_match)
+            await self.api.get_response('abcdefgh')
+            self.assertEqual(0.5, self.api.last_prefix_match)
+            stats = self.api.prompt_cache_stats()
+            self.assertEqual(2, stats['prompts'])
+            self.assertEqual(0.25, stats['mean_prefix_match'])
+
+    def test_history_trim_chunk(self):
+        self.assertEqual(0, self.api.history_trim_chunk)
+        self.api.prompt_layout = 'chunked'
+        self.assertEqual(self.api.max_tokens // 4, self.api.history_trim_chunk)
+        self.api.trim_chunk_tokens = 100
+        self.assertEqual(100, self.api.history_trim_chunk)
+
     async def test_empty_options(self):
         with self.api_mock:
             response = await self.api.get_response_structured('test message', [], [])
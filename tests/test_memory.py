@@ -0,0 +1,347 @@
+import json
+import unittest
+from unittest import IsolatedAsyncioTestCase, mock
+
+from memory.memory import Message, Role
+from memory.basic_memory import BasicMemory
+from memory.summary_memory import SummaryMemory
+from memory.vector_memory import VectorMemory
+from memory.keyword_memory import KeywordMemory
+from memory.window_memory import WindowMemory
+from memory.columnar import ColumnarLog, MessageView
+from jsoncustom.memoryjson import MemoryEncoder, MemoryDecoder
+from testapi import TestAPI
+from scheduler import GenerationScheduler
+
+
+def make_messages(tokens: list[int]) -> list[Message]:
+    return [Message(role=Role(i % 2), content=f'message {i}', tokens=t) for i, t in enumerate(tokens)]
+
+
+class BasicMemoryTests(unittest.TestCase):
+
+    def test_no_budget(self):
+        mem = BasicMemory()
+        for msg in make_messages([1, 2, 3]):
+            mem.add_log(msg)
+        self.assertEqual([2, 1, 0], mem.get_related_history('new'))
+
+    def test_budget(self):
+        mem = BasicMemory()
+        for msg in make_messages([5, 1, 2, 3]):
+            mem.add_log(msg)
+        self.assertEqual([3, 2, 1], mem.get_related_history('new', budget=6))
+        self.assertEqual([3, 2, 1], mem.get_related_history('new', budget=10))
+        self.assertEqual([3, 2, 1, 0], mem.get_related_history('new', budget=11))
+        self.assertEqual([], mem.get_related_history('new', budget=2))
+        self.assertEqual([], mem.get_related_history('new', budget=0))
+
+    def test_set_tokens(self):
+        mem = BasicMemory()
+        messages = make_messages([0, 0, 0])
+        for msg in messages:
+            mem.add_log(msg)
+        for msg in messages:
+            mem.set_tokens(msg, 4)
+        self.assertEqual(4, messages[1].tokens)
+        self.assertEqual([2, 1], mem.get_related_history('new', budget=8))
+        mem.set_tokens(messages[2], 1)
+        self.assertEqual([2, 1], mem.get_related_history('new', budget=5))
+
+    def test_from_dict(self):
+        mem = BasicMemory()
+        for msg in make_messages([3, 3, 3]):
+            mem.add_log(msg)
+        loaded = BasicMemory.from_dict(mem.to_dict())
+        self.assertEqual(3, len(loaded.log))
+        self.assertEqual([2, 1], loaded.get_related_history('new', budget=6))
+
+    def test_header_dict(self):
+        # The settings of every memory type, without the messages
+        for mem in [BasicMemory(columnar=True), SummaryMemory(TestAPI()), VectorMemory(top_k=2, recent=2),
+                    KeywordMemory(top_k=2, recent=2), WindowMemory(max_messages=4)]:
+            for msg in make_messages([3, 3]):
+                mem.add_log(msg)
+            full = mem.to_dict()
+            full.pop('log')
+            full.pop('vectors', None)
+            self.assertEqual(full, mem.header_dict())
+
+    def test_chunked_budget(self):
+        mem = BasicMemory()
+        for msg in make_messages([10] * 10):
+            mem.add_log(msg)
+        # 30 fits exactly 3 messages, but trimming happens at multiples of 40 tokens
+        self.assertEqual([9, 8], mem.get_related_history('new', budget=30, chunk=40))
+        self.assertEqual([9, 8, 7, 6, 5, 4, 3, 2, 1, 0], mem.get_related_history('new', budget=100, chunk=40))
+
+    def test_chunked_stable_start(self):
+        mem = BasicMemory()
+        starts = []
+        for msg in make_messages([10] * 30):
+            mem.add_log(msg)
+            indexes = mem.get_related_history('new', budget=100, chunk=40)
+            starts.append(indexes[-1])
+        # The oldest included message only moves in steps of 4 messages
+        self.assertEqual([0] * 10 + [4] * 4 + [8] * 4 + [12] * 4 + [16] * 4 + [20] * 4, starts)
+
+    def test_large_history(self):
+        mem = BasicMemory()
+        for msg in make_messages([10] * 100000):
+            mem.add_log(msg)
+        indexes = mem.get_related_history('new', budget=1000)
+        self.assertEqual(100, len(indexes))
+        self.assertEqual(99999, indexes[0])
+
+
+class ColumnarMemoryTests(unittest.TestCase):
+
+    def test_estimated(self):
+        for columnar in [False, True]:
+            mem = BasicMemory(columnar=columnar)
+            msg = Message(role=Role.USER, content='hello', tokens=2, estimated=True)
+            mem.add_log(msg)
+            self.assertTrue(mem.log[0].estimated)
+            self.assertTrue(BasicMemory.from_dict(mem.to_dict()).log[0].estimated)
+            mem.set_tokens(msg, 3)
+            self.assertFalse(mem.log[0].estimated)
+            self.assertNotIn('estimated', mem.to_dict()['log'][0])
+
+    def test_views(self):
+        log = ColumnarLog()
+        log.append(Message(role=Role.USER, content='héllo', tokens=3))
+        log.append(Message(role=Role.ASSISTANT, content='', tokens=1))
+        self.assertEqual(2, len(log))
+        self.assertIsInstance(log[0], MessageView)
+        self.assertEqual('héllo', log[0].content)
+        self.assertEqual(Role.USER, log[0].role)
+        self.assertEqual('', log[-1].content)
+        self.assertEqual(['héllo', ''], [m.content for m in log])
+        log[1].tokens = 5
+        self.assertEqual(5, log[1].tokens)
+        with self.assertRaises(IndexError):
+            log[2]
+
+    def test_memory(self):
+        mem = BasicMemory(columnar=True)
+        messages = make_messages([0, 0, 0])
+        for msg in messages:
+            mem.add_log(msg)
+        # Counts set on the original objects reach the columns
+        for msg in messages:
+            mem.set_tokens(msg, 4)
+        self.assertEqual([4, 4, 4], [m.tokens for m in mem.log])
+        self.assertEqual([2, 1], mem.get_related_history('new', budget=8))
+        mem.set_tokens(mem.log[0], 1)
+        self.assertEqual(1, mem.log[0].tokens)
+        self.assertEqual([2, 1, 0], mem.get_related_history('new', budget=9))
+
+    def test_serialization(self):
+        mem = BasicMemory(columnar=True)
+        for msg in make_messages([3, 3, 3]):
+            mem.add_log(msg)
+        loaded = json.loads(json.dumps({'0': mem}, cls=MemoryEncoder), cls=MemoryDecoder)['0']
+        self.assertTrue(loaded.columnar)
+        self.assertEqual(['message 0', 'message 1', 'message 2'], [m.content for m in loaded.log])
+
+
+class SummaryMemoryTests(IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.api = TestAPI()
+        self.api.set_sleep_time(0)
+
+    async def test_no_summary_below_threshold(self):
+        mem = SummaryMemory(self.api, summarize_threshold=100, keep_recent_tokens=20)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        self.assertIsNone(mem._task)
+        self.assertEqual([5, 4, 3, 2, 1], mem.get_related_history('new'))
+
+    async def test_summarize(self):
+        mem = SummaryMemory(self.api, summarize_threshold=50, keep_recent_tokens=20)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        await mem._task
+
+        self.assertTrue(mem.summary.content.startswith('response: '))
+        self.assertIn('message 0', mem.summary.content)
+        self.assertNotIn('message 3', mem.summary.content)
+        self.assertGreater(mem.summary.tokens, 0)
+        # Recent window newest first, then the summary
+        self.assertEqual([5, 4, 0], mem.get_related_history('new'))
+
+        # Messages added while summarizing stay in the window
+        mem.add_log(Message(role=Role.USER, content='later', tokens=10))
+        self.assertEqual([6, 5, 4, 0], mem.get_related_history('new'))
+
+    async def test_summarize_in_passes(self):
+        scheduler = GenerationScheduler(1)
+        mem = SummaryMemory(self.api, summarize_threshold=70, keep_recent_tokens=20)
+        mem.set_generation_slot(lambda: scheduler.slot('background'))
+        with mock.patch.object(self.api, 'history_token_budget', return_value=25):
+            for msg in make_messages([10] * 7):
+                mem.add_log(msg)
+            await mem._task
+
+        # 5 messages to fold, 2 per pass, each pass waiting for the scheduler
+        self.assertEqual(3, scheduler.stats()['served'])
+        self.assertIn('message 4', mem.summary.content)
+        self.assertEqual([7, 6, 0], mem.get_related_history('new'))
+
+    async def test_summary_affinity(self):
+        mem = SummaryMemory(self.api, summarize_threshold=50, keep_recent_tokens=20)
+        mem.set_affinity(7)
+        with mock.patch.object(self.api, 'get_response', wraps=self.api.get_response) as get_response:
+            for msg in make_messages([10] * 5):
+                mem.add_log(msg)
+            await mem._task
+        # Sent to the channel's server
+        self.assertEqual(7, get_response.call_args.kwargs['affinity'])
+
+    async def test_budget(self):
+        mem = SummaryMemory(self.api, summarize_threshold=1000)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        self.assertEqual([5, 4], mem.get_related_history('new', budget=25))
+
+    async def test_serialization(self):
+        mem = SummaryMemory(self.api, summarize_threshold=50, keep_recent_tokens=20)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        await mem._task
+
+        dump = json.dumps({'0': mem}, cls=MemoryEncoder)
+        loaded = json.loads(dump, cls=MemoryDecoder, api=self.api)['0']
+        self.assertIsInstance(loaded, SummaryMemory)
+        self.assertIs(self.api, loaded.api)
+        self.assertEqual(mem.summary.content, loaded.summary.content)
+        self.assertEqual(mem.get_related_history('new'), loaded.get_related_history('new'))
+
+
+class VectorMemoryTests(unittest.TestCase):
+
+    def make_memory(self) -> VectorMemory:
+        mem = VectorMemory(top_k=2, recent=2)
+        contents = ['my cat is called Tom', 'nice weather today', 'what is a good pizza topping',
+                    'pineapple on pizza is great', 'the stock market went up', 'I have to go now', 'bye']
+        for i, content in enumerate(contents):
+            mem.add_log(Message(role=Role(i % 2), content=content, tokens=5))
+        return mem
+
+    def test_recent_and_similar(self):
+        mem = self.make_memory()
+        indexes = mem.get_related_history('which pizza topping do you like')
+        # The two newest, then the most similar older ones
+        self.assertEqual([6, 5], indexes[:2])
+        self.assertEqual({2, 3}, set(indexes[2:]))
+
+    def test_budget(self):
+        mem = self.make_memory()
+        full = mem.get_related_history('which pizza topping do you like')
+        self.assertEqual(full[:3], mem.get_related_history('which pizza topping do you like', budget=15))
+
+    def test_growth(self):
+        mem = VectorMemory()
+        for i in range(100):
+            mem.add_log(Message(role=Role.USER, content=f'message {i}', tokens=1))
+        self.assertEqual((100, mem.embedder.dim), mem.vectors.shape)
+        self.assertEqual(128, len(mem._vectors))
+
+    def test_serialization(self):
+        mem = self.make_memory()
+        dct = mem.to_dict()
+        self.assertIsInstance(dct['vectors'], str)
+        loaded = json.loads(json.dumps({'0': mem}, cls=MemoryEncoder), cls=MemoryDecoder)['0']
+        self.assertIsInstance(loaded, VectorMemory)
+        self.assertEqual(7, len(loaded.log))
+        self.assertEqual(mem.get_related_history('pizza'), loaded.get_related_history('pizza'))
+
+        # Vectors are rebuilt if they don't match the log
+        dct['vectors'] = ''
+        self.assertEqual(mem.get_related_history('pizza'), VectorMemory.from_dict(dct).get_related_history('pizza'))
+
+
+class KeywordMemoryTests(unittest.TestCase):
+
+    contents = ['my cat is called Tom', 'nice weather today', 'what is a good pizza topping',
+                'pineapple on pizza is great', 'the stock market went up', 'pizza pizza pizza', 'I have to go now', 'bye']
+
+    def make_memory(self) -> KeywordMemory:
+        mem = KeywordMemory(top_k=2, recent=2)
+        for i, content in enumerate(self.contents):
+            mem.add_log(Message(role=Role(i % 2), content=content, tokens=5))
+        return mem
+
+    def test_recent_and_matching(self):
+        mem = self.make_memory()
+        indexes = mem.get_related_history('which pizza topping do you like?')
+        self.assertEqual([7, 6], indexes[:2])
+        self.assertEqual(2, indexes[2])  # Matches both words
+        self.assertEqual(4, len(indexes))
+
+    def test_no_match(self):
+        mem = self.make_memory()
+        self.assertEqual([7, 6], mem.get_related_history('unrelated words'))
+
+    def test_budget(self):
+        mem = self.make_memory()
+        self.assertEqual([7, 6, 2], mem.get_related_history('pizza topping', budget=15))
+
+    def test_lazy_index(self):
+        mem = self.make_memory()
+        loaded = json.loads(json.dumps({'0': mem}, cls=MemoryEncoder), cls=MemoryDecoder)['0']
+        self.assertIsInstance(loaded, KeywordMemory)
+        # Nothing is indexed until the first query, even after adding more
+        loaded.add_log(Message(role=Role.USER, content='pizza again', tokens=5))
+        self.assertEqual(0, len(loaded._lengths))
+        self.assertEqual([8, 7, 0], loaded.get_related_history('cat'))
+        self.assertEqual(len(loaded.log), len(loaded._lengths))
+
+
+class WindowMemoryTests(unittest.TestCase):
+
+    def test_token_cap(self):
+        mem = WindowMemory(max_tokens=25)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        self.assertEqual(2, len(mem.log))
+        self.assertEqual(20, mem.tokens)
+        self.assertEqual('message 3', mem.log[0].content)
+
+    def test_message_cap(self):
+        mem = WindowMemory(max_messages=3)
+        for msg in make_messages([1] * 5):
+            mem.add_log(msg)
+        self.assertEqual(['message 2', 'message 3', 'message 4'], [m.content for m in mem.log])
+
+    def test_set_tokens_evicts(self):
+        mem = WindowMemory(max_tokens=25)
+        messages = make_messages([0] * 4)
+        for msg in messages:
+            mem.add_log(msg)
+        self.assertEqual(4, len(mem.log))
+        for msg in messages:
+            mem.set_tokens(msg, 10)
+        self.assertEqual(2, len(mem.log))
+        self.assertEqual(20, mem.tokens)
+
+    def test_budget(self):
+        mem = WindowMemory()
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        self.assertEqual([4, 3, 2], mem.get_related_history('new', budget=35))
+        self.assertEqual([4, 3, 2, 1, 0], mem.get_related_history('new'))
+
+    def test_serialization(self):
+        mem = WindowMemory(max_tokens=25)
+        for msg in make_messages([10] * 5):
+            mem.add_log(msg)
+        loaded = json.loads(json.dumps({'0': mem}, cls=MemoryEncoder), cls=MemoryDecoder)['0']
+        self.assertIsInstance(loaded, WindowMemory)
+        self.assertEqual(25, loaded.max_tokens)
+        self.assertEqual(20, loaded.tokens)
+
+
+if __name__ == '__main__':
+    unittest.main()
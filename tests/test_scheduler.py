@@ -0,0 +1,89 @@
+import unittest
+from unittest import IsolatedAsyncioTestCase
+import asyncio
+
+from scheduler import GenerationScheduler
+
+
+class SchedulerTests(IsolatedAsyncioTestCase):
+
+    async def run_jobs(self, scheduler: GenerationScheduler, jobs: list[tuple[str, int]]) -> list[str]:
+        """
+        Queues every job behind a blocker and returns the keys in the order they got a slot
+        """
+        order = []
+
+        async def job(key: str, weight: int):
+            async with scheduler.slot(key, weight):
+                order.append(key)
+                await asyncio.sleep(0)
+
+        await scheduler.acquire('blocker')
+        tasks = [asyncio.create_task(job(key, weight)) for key, weight in jobs]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    async def test_round_robin(self):
+        scheduler = GenerationScheduler(1)
+        order = await self.run_jobs(scheduler, [('a', 1), ('a', 1), ('a', 1), ('b', 1), ('c', 1)])
+        # The busy key doesn't starve the others
+        self.assertEqual(['a', 'b', 'c', 'a', 'a'], order)
+
+    async def test_weighted(self):
+        scheduler = GenerationScheduler(1, policy='weighted')
+        order = await self.run_jobs(scheduler, [('a', 3)] * 6 + [('b', 1)] * 2)
+        self.assertEqual(6, order.count('a'))
+        # b gets one of the first four slots
+        self.assertIn('b', order[:4])
+
+    async def test_concurrency_limit(self):
+        scheduler = GenerationScheduler(2)
+        running = 0
+        peak = 0
+
+        async def job(key):
+            nonlocal running, peak
+            async with scheduler.slot(key):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*[job(i % 3) for i in range(9)])
+        self.assertEqual(2, peak)
+        self.assertEqual(0, scheduler.active)
+
+    async def test_stats(self):
+        scheduler = GenerationScheduler(1)
+        await scheduler.acquire('a')
+        task = asyncio.create_task(scheduler.acquire('b'))
+        await asyncio.sleep(0)
+        self.assertEqual(1, scheduler.queue_depth())
+        self.assertEqual({'b': 1}, scheduler.queue_depths())
+        self.assertEqual(1, scheduler.stats()['queued'])
+
+        scheduler.release()
+        await task
+        scheduler.release()
+        stats = scheduler.stats()
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(2, stats['served'])
+        self.assertGreaterEqual(stats['max_wait'], 0)
+
+    async def test_cancelled_waiter(self):
+        scheduler = GenerationScheduler(1)
+        await scheduler.acquire('a')
+        task = asyncio.create_task(scheduler.acquire('b'))
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(0, scheduler.queue_depth())
+        scheduler.release()
+        self.assertEqual(0, scheduler.active)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from configuration import Configuration
+from testapi import TestAPI
+from memory.factories.factories import BasicMemoryFactory
+from discordhandlers.abstracthandler import BasicMessage
+from discordhandlers.texthandler import TextHandler
+from jsoncustom.memoryjson import MemoryDecoder
+from snapshot import Snapshotter
+
+
+class SnapshotTests(IsolatedAsyncioTestCase):
+
+    api = TestAPI()
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = Configuration()
+        self.config._load_defaults()
+        self.config.options['channels_per_guild'] = 100
+        self.config.add_guild(0, 'test')
+        self.config.add_channel(0, 0, {})
+        self.handler = TextHandler(self.api, {}, default_factory=BasicMemoryFactory(), config=self.config)
+        self.snapshotter = Snapshotter(self.handler, self.config,
+                                       interval=0.01,
+                                       memory_path=os.path.join(self.dir.name, 'memory.txt'),
+                                       config_path=os.path.join(self.dir.name, 'config.txt'))
+        self.api.set_sleep_time(0)
+        self.api.blank = False
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_snapshot(self):
+        await self.handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        async with self.handler.lock(0):
+            pass
+
+        report = await self.snapshotter.snapshot()
+        self.assertEqual(['copy', 'serialize', 'write'], sorted(report.keys()))
+
+        with open(self.snapshotter.memory_path) as f:
+            memories = json.loads(f.read(), cls=MemoryDecoder)
+        self.assertEqual(['test', 'structured: test'], [m.content for m in memories['0'].log])
+        with open(self.snapshotter.config_path) as f:
+            self.assertEqual(self.config.options, json.loads(f.read()))
+        self.assertFalse(os.path.exists(self.snapshotter.memory_path + '.tmp'))
+
+    async def test_snapshot_is_a_copy(self):
+        options = self.config.snapshot()
+        self.config.add_guild(1, 'other')
+        self.assertNotIn('1', options['guilds'])
+
+    async def test_periodic(self):
+        self.snapshotter.start()
+        while len(self.snapshotter.last_report) == 0:
+            await asyncio.sleep(0.01)
+        await self.snapshotter.stop()
+        self.assertTrue(os.path.exists(self.snapshotter.config_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
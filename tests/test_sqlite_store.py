@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import IsolatedAsyncioTestCase
+from memory.basic_memory import BasicMemory
+from memory.keyword_memory import KeywordMemory
+from memory.summary_memory import SummaryMemory
+from memory.sqlite_store import SQLiteMemoryStore
+from memory.memory import Message, Role
+
+
+class SQLiteMemoryStoreTests(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'memory.db')
+        self.store = SQLiteMemoryStore(self.path, tail_tokens=10)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    async def test_missing_channel(self):
+        self.assertIsNone(await self.store.load(0))
+
+    async def test_append_and_load(self):
+        memory = KeywordMemory(top_k=2, recent=3)
+        self.store.save_header(5, memory)
+        for i in range(3):
+            self.store.append(5, Message(role=Role(i % 2), content=f'message {i}', tokens=2))
+
+        loaded = await self.store.load(5)
+        self.assertIsInstance(loaded, KeywordMemory)
+        self.assertEqual(loaded.top_k, 2)
+        self.assertEqual(loaded.recent, 3)
+        self.assertEqual([msg.content for msg in loaded.log], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual([msg.role for msg in loaded.log], [Role.USER, Role.ASSISTANT, Role.USER])
+
+    async def test_searched_log_loaded_in_full(self):
+        # Keyword and vector memories find related messages anywhere in the history
+        self.store.save_header(0, KeywordMemory())
+        for i in range(10):
+            self.store.append(0, Message(role=Role.USER, content=f'message {i}', tokens=3))
+        self.assertEqual(10, len((await self.store.load(0)).log))
+
+    async def test_only_tail_loaded(self):
+        self.store.save_header(0, BasicMemory())
+        for i in range(20):
+            self.store.append(0, Message(role=Role.USER, content=str(i), tokens=3))
+
+        loaded = await self.store.load(0)
+        # 10 tail tokens fit the newest 3 messages
+        self.assertEqual([msg.content for msg in loaded.log], ['17', '18', '19'])
+
+    async def test_channels_kept_apart(self):
+        self.store.save_header(1, BasicMemory())
+        self.store.save_header(2, BasicMemory())
+        self.store.append(1, Message(role=Role.USER, content='one', tokens=1))
+        self.store.append(2, Message(role=Role.USER, content='two', tokens=1))
+
+        self.assertEqual([msg.content for msg in (await self.store.load(1)).log], ['one'])
+        self.assertEqual([msg.content for msg in (await self.store.load(2)).log], ['two'])
+
+    async def test_import_replaces(self):
+        self.store.save_header(0, BasicMemory())
+        self.store.append(0, Message(role=Role.USER, content='old', tokens=1))
+
+        memory = BasicMemory()
+        memory.add_log(Message(role=Role.USER, content='new', tokens=1))
+        self.store.import_memory(0, memory)
+        self.store.append(0, Message(role=Role.ASSISTANT, content='newer', tokens=1))
+
+        self.assertEqual([msg.content for msg in (await self.store.load(0)).log], ['new', 'newer'])
+
+    async def test_import_summary(self):
+        memory = SummaryMemory(summarize_threshold=1000)
+        memory.log[0] = Message(role=Role.SYSTEM, content='the summary', tokens=2)
+        for i in range(3):
+            memory.add_log(Message(role=Role(i % 2), content=f'message {i}', tokens=1))
+        memory._summarized = 2
+        self.store.import_memory(0, memory)
+
+        loaded = await self.store.load(0)
+        self.assertEqual('the summary', loaded.summary.content)
+        self.assertEqual(['message 0', 'message 1', 'message 2'], [msg.content for msg in loaded.log[1:]])
+        self.assertEqual(memory.get_related_history('new'), loaded.get_related_history('new'))
+
+    async def test_persists(self):
+        self.store.save_header(0, BasicMemory())
+        self.store.append(0, Message(role=Role.USER, content='kept', tokens=1))
+        self.store.close()
+
+        self.store = SQLiteMemoryStore(self.path)
+        self.assertEqual([msg.content for msg in (await self.store.load(0)).log], ['kept'])
+
+    async def test_update_tokens(self):
+        self.store.save_header(0, BasicMemory())
+        seq = self.store.append(0, Message(role=Role.USER, content='counted', tokens=2, estimated=True))
+        self.store.append(0, Message(role=Role.ASSISTANT, content='not yet', tokens=2, estimated=True))
+        self.assertTrue(all(msg.estimated for msg in (await self.store.load(0)).log))
+
+        self.store.update_tokens(0, seq.result(), 3)
+        loaded = await self.store.load(0)
+        self.assertEqual([(3, False), (2, True)], [(msg.tokens, msg.estimated) for msg in loaded.log])
+
+    async def test_old_schema_migrated(self):
+        self.store.close()
+        os.remove(self.path)
+        connection = sqlite3.connect(self.path)
+        connection.executescript('''
+            CREATE TABLE memories (channel TEXT PRIMARY KEY, header TEXT NOT NULL);
+            CREATE TABLE messages (channel TEXT NOT NULL, seq INTEGER NOT NULL, role INTEGER NOT NULL,
+                                   content TEXT NOT NULL, tokens INTEGER NOT NULL,
+                                   PRIMARY KEY (channel, seq)) WITHOUT ROWID;
+        ''')
+        connection.execute("INSERT INTO messages VALUES ('0', 1, 0, 'old', 1)")
+        connection.commit()
+        connection.close()
+
+        self.store = SQLiteMemoryStore(self.path)
+        self.store.save_header(0, BasicMemory())
+        self.store.append(0, Message(role=Role.USER, content='new', tokens=1, estimated=True))
+        loaded = await self.store.load(0)
+        self.assertEqual([('old', False), ('new', True)], [(msg.content, msg.estimated) for msg in loaded.log])
+
+
+if __name__ == '__main__':
+    unittest.main()
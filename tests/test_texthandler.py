@@ -1,11 +1,22 @@
 import asyncio
+import os
+import tempfile
 import unittest
 from configuration import Configuration
 from unittest import IsolatedAsyncioTestCase
+from unittest import mock
 from testapi import TestAPI
-from memory.factories.factories import NoMemoryFactory, BasicMemoryFactory
-from discordhandlers.abstracthandler import BasicMessage
+from memory.factories.factories import NoMemoryFactory, BasicMemoryFactory, WindowMemoryFactory, SummaryMemoryFactory
+from koboldapi import KoboldAPI
+from memory.memory import Message, Role
+from memory.window_memory import WindowMemory
+from memory.basic_memory import BasicMemory
+from discordhandlers.abstracthandler import BasicMessage, ReplacingChunk
 from discordhandlers.texthandler import TextHandler
+from scheduler import GenerationScheduler
+from admission import AdmissionController
+from memory.sqlite_store import SQLiteMemoryStore
+from memory.journal import Journal
 
 
 class MessageResponses(IsolatedAsyncioTestCase):
@@ -66,6 +77,100 @@ class MessageResponses(IsolatedAsyncioTestCase):
         res = await self.handler.respond(BasicMessage('\r\n', user='me', channel_id=0, guild_id=0))
         self.assertEqual(res, '[No response]')
 
+    async def test_stream_response(self):
+        chunks = [c async for c in self.handler.respond_stream(BasicMessage('test', user='me', channel_id=0, guild_id=0))]
+        self.assertEqual('structured: test', ''.join(chunks))
+
+    async def test_stream_runtime_error(self):
+        self.api.trigger_runtime_error()
+        chunks = [c async for c in self.handler.respond_stream(BasicMessage('Test message', user='me', channel_id=0, guild_id=0))]
+        self.assertEqual(['[RuntimeError message]'], chunks)
+
+    async def test_stream_error_replaces(self):
+        async def stream(*args, **kwargs):
+            yield 'part'
+            raise RuntimeError('lost')
+
+        with mock.patch.object(self.api, 'get_response_structured_stream', stream):
+            chunks = [c async for c in self.handler.respond_stream(BasicMessage('test', user='me', channel_id=0, guild_id=0))]
+        self.assertEqual(['part', '[lost]'], chunks)
+        self.assertIsInstance(chunks[1], ReplacingChunk)
+        self.assertNotIsInstance(chunks[0], ReplacingChunk)
+
+    async def test_stream_saved_before_last_chunk(self):
+        async def stream(*args, **kwargs):
+            yield ''
+
+        handler = TextHandler(self.api, {}, default_factory=BasicMemoryFactory(), config=self.config)
+        with mock.patch.object(self.api, 'get_response_structured_stream', stream):
+            chunks = handler.respond_stream(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+            self.assertEqual('', await chunks.__anext__())
+            self.assertEqual('[No response]', await chunks.__anext__())
+            # Saved while the chunk is being sent
+            self.assertEqual(['test', '[No response]'], [m.content for m in handler.memory(0).log])
+            await chunks.aclose()
+
+    async def test_scheduled_response(self):
+        self.handler.scheduler = GenerationScheduler(1)
+        res = await self.handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        self.assertEqual(res, 'structured: test')
+        self.assertEqual(1, self.handler.scheduler.stats()['served'])
+        self.assertEqual(0, self.handler.scheduler.active)
+
+    async def test_busy_refusal(self):
+        self.handler.admission = AdmissionController(max_queue_depth=2)
+        # Keep the channel busy so messages have to wait
+        async with self.handler.lock(0):
+            tasks = [asyncio.create_task(self.handler.respond(BasicMessage(f'test{i}', user='me', channel_id=0, guild_id=0)))
+                     for i in range(3)]
+            await asyncio.sleep(0)
+            self.assertEqual(2, self.handler.queue_depth)
+        res = await asyncio.gather(*tasks)
+        self.assertEqual(res[0], 'structured: test0')
+        self.assertEqual(res[1], 'structured: test1')
+        self.assertEqual(res[2], AdmissionController.BUSY_MESSAGE)
+
+    async def test_estimated_wait(self):
+        msg = BasicMessage('test', user='me', channel_id=0, guild_id=0)
+        self.assertIsNone(self.handler.estimated_wait(msg))  # TestAPI can't estimate
+
+        self.handler.scheduler = GenerationScheduler(2)
+        with mock.patch.object(self.api, 'estimate_generation_time', return_value=3.0):
+            self.assertEqual(3.0, self.handler.estimated_wait(msg))
+            async with self.handler.lock(0):
+                tasks = [asyncio.create_task(self.handler.respond(BasicMessage(f'test{i}', user='me', channel_id=0, guild_id=0)))
+                         for i in range(4)]
+                await asyncio.sleep(0)
+                # Four ahead, two at a time
+                self.assertEqual(9.0, self.handler.estimated_wait(msg))
+            await asyncio.gather(*tasks)
+
+    async def test_token_budget(self):
+        self.handler.admission = AdmissionController(user_rate=0.001, user_burst=1)
+        refused = self.config.guild_usage(0)['refused']
+        res = await self.handler.respond(BasicMessage('test', user='budget', channel_id=0, guild_id=0))
+        self.assertEqual(res, 'structured: test')
+        res = await self.handler.respond(BasicMessage('test', user='budget', channel_id=0, guild_id=0))
+        self.assertTrue(res.startswith('[Your token budget is used up'))
+        self.assertEqual(refused + 1, self.config.guild_usage(0)['refused'])
+        # Other users aren't affected
+        res = await self.handler.respond(BasicMessage('test', user='other', channel_id=0, guild_id=0))
+        self.assertEqual(res, 'structured: test')
+
+    def test_token_rate_needs_burst(self):
+        with self.assertRaises(ValueError):
+            AdmissionController(user_rate=5)
+        with self.assertRaises(ValueError):
+            AdmissionController(guild_rate=20, guild_burst=0)
+
+    async def test_usage_without_admission(self):
+        # Usage is counted even when no limits are enforced
+        usage = dict(self.config.guild_usage(0))
+        res = await self.handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        self.assertEqual(usage['responses'] + 1, self.config.guild_usage(0)['responses'])
+        self.assertEqual(usage['generated_tokens'] + self.api.estimate_tokens(res),
+                         self.config.guild_usage(0)['generated_tokens'])
+
     async def test_value_error(self):
         self.api.trigger_value_error()
         res = await self.handler.respond(BasicMessage('Test message', user='me', channel_id=0, guild_id=0))
@@ -132,6 +237,30 @@ class UsingMemoryTests(IsolatedAsyncioTestCase):
         self.assertEqual('test2', self.handler.memory(1).log[0].content)
         self.assertEqual('structured: test2', self.handler.memory(1).log[1].content)
 
+    async def test_set_memory_type(self):
+        self.handler.memory_factory_lookup = {'window': WindowMemoryFactory(max_messages=2)}
+        res = await self.handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        res = await self.handler.respond(BasicMessage('test2', user='me', channel_id=0, guild_id=0))
+        self.assertEqual('Memory set to window', await self.handler.set_memory_type('window', 0))
+        self.assertIsInstance(self.handler.memory(0), WindowMemory)
+        self.assertEqual(['test2', 'structured: test2'], [m.content for m in self.handler.memory(0).log])
+        self.assertEqual('Unknown memory type basic', await self.handler.set_memory_type('basic', 0))
+        self.assertEqual(['window'], await self.handler.get_memory_types())
+
+    async def test_set_memory_type_from_summary(self):
+        self.handler.memory_factory_lookup = {'summary': SummaryMemoryFactory(self.api), 'basic': BasicMemoryFactory()}
+        self.assertEqual('Memory set to summary', await self.handler.set_memory_type('summary', 0))
+        self.handler.memory(0).add_log(Message(role=Role.USER, content='test', tokens=1))
+        self.handler.memory(0).add_log(Message(role=Role.ASSISTANT, content='structured: test', tokens=3))
+        self.assertEqual('Memory set to basic', await self.handler.set_memory_type('basic', 0))
+        memory = self.handler.memory(0)
+        # The summary's placeholder isn't a conversation message
+        self.assertEqual(['test', 'structured: test'], [m.content for m in memory.log])
+
+        api = KoboldAPI()
+        prompt = api.structure_prompt('next', memory.log, memory.get_related_history('next', api.history_token_budget('next')))
+        self.assertIn('User: test\nZippAI: structured: test', prompt)
+
     async def test_two_memories_many_messages(self):
         res = await self.handler.respond(BasicMessage('test', user='me', channel_id=346135, guild_id=0))
         res = await self.handler.respond(BasicMessage('test2', user='me', channel_id=9, guild_id=0))
@@ -146,6 +275,227 @@ class UsingMemoryTests(IsolatedAsyncioTestCase):
         self.assertEqual('hi', self.handler.memory(9).log[2].content)
         self.assertEqual('wait', self.handler.memory(9).log[4].content)
 
+    async def test_estimated_until_counted(self):
+        self.api.set_sleep_time(0.2)
+        await self.handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        log = self.handler.memory(0).log
+        self.assertTrue(all(m.estimated for m in log))
+        # The next message doesn't wait for the counts
+        await self.handler.respond(BasicMessage('test two', user='me', channel_id=0, guild_id=0))
+        self.assertEqual(4, len(log))
+        self.assertTrue(log[0].estimated)
+
+        await asyncio.sleep(0.3)
+        self.assertEqual([4, 16, 8, 20], [m.tokens for m in log])
+        self.assertFalse(any(m.estimated for m in log))
+
+    async def test_repeated_message_counted(self):
+        self.handler.default_factory = BasicMemoryFactory(columnar=True)
+        self.api.set_sleep_time(0.2)
+        await self.handler.respond(BasicMessage('hi', user='me', channel_id=0, guild_id=0))
+        # The same message again before the first counts are in
+        await self.handler.respond(BasicMessage('hi', user='me', channel_id=0, guild_id=0))
+        log = self.handler.memory(0).log
+        self.assertTrue(all(m.estimated for m in log))
+
+        await asyncio.sleep(0.3)
+        self.assertFalse(any(m.estimated for m in log))
+
+    async def test_coalesce_burst(self):
+        self.handler.coalesce_window = 0.05
+        res = await asyncio.gather(*[self.handler.respond(BasicMessage(text, user='me', channel_id=0, guild_id=0))
+                                     for text in ['one', 'two', 'three']])
+        self.assertEqual(['structured: one\ntwo\nthree', None, None], res)
+        async with self.handler.lock(0):
+            pass
+        self.assertEqual(['one\ntwo\nthree', 'structured: one\ntwo\nthree'],
+                         [m.content for m in self.handler.memory(0).log])
+
+    async def test_coalesce_while_busy(self):
+        self.handler.coalesce_window = 0
+        async with self.handler.lock(0):
+            first = asyncio.ensure_future(self.handler.respond(BasicMessage('one', user='me', channel_id=0, guild_id=0)))
+            await asyncio.sleep(0.01)
+            self.assertIsNone(await self.handler.respond(BasicMessage('two', user='me', channel_id=0, guild_id=0)))
+        self.assertEqual('structured: one\ntwo', await first)
+        # A new burst starts once the last one is answered
+        res = await self.handler.respond(BasicMessage('three', user='me', channel_id=0, guild_id=0))
+        self.assertEqual('structured: three', res)
+
+
+    async def test_coalesce_admitted_first(self):
+        self.handler.coalesce_window = 0.05
+        self.handler.admission = AdmissionController(user_rate=0.001, user_burst=1)
+        await self.handler.respond(BasicMessage('test', user='spent', channel_id=0, guild_id=0))
+        # Joining another user's burst doesn't get around the budget
+        res = await asyncio.gather(self.handler.respond(BasicMessage('one', user='me', channel_id=0, guild_id=0)),
+                                   self.handler.respond(BasicMessage('two', user='spent', channel_id=0, guild_id=0)))
+        self.assertEqual('structured: one', res[0])
+        self.assertTrue(res[1].startswith('[Your token budget is used up'))
+
+    async def test_coalesce_charge_split(self):
+        self.handler.coalesce_window = 0.05
+        self.handler.admission = AdmissionController(user_rate=0.001, user_burst=1000)
+        res = await asyncio.gather(*[self.handler.respond(BasicMessage(text, user=user, channel_id=0, guild_id=0))
+                                     for text, user in [('one', 'a'), ('two', 'b')]])
+        tokens = self.api.estimate_tokens(res[0])
+        for user in ['a', 'b']:
+            self.assertAlmostEqual(1000 - tokens / 2, self.handler.admission._user_buckets[(0, user)].tokens, places=1)
+
+class StoredMemoryTests(IsolatedAsyncioTestCase):
+
+    api = TestAPI()
+    mem = BasicMemoryFactory()
+    config = Configuration()  # Blank
+    config._load_defaults()
+    config.options['channels_per_guild'] = 100
+    config.add_guild(0, 'test')
+    for ch in [0, 1]:
+        config.add_channel(0, ch, {})
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'memory.db')
+        self.api.set_sleep_time(0)
+        self.api.blank = False
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make_handler(self, max_resident: int | None = None) -> TextHandler:
+        return TextHandler(self.api, {}, default_factory=self.mem, config=self.config,
+                           store=SQLiteMemoryStore(self.path), max_resident=max_resident)
+
+    async def test_loaded_on_first_use(self):
+        handler = self.make_handler()
+        await handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        await handler.respond(BasicMessage('other', user='me', channel_id=1, guild_id=0))
+        async with handler.lock(0), handler.lock(1):
+            pass
+        handler.save()
+
+        handler = self.make_handler()
+        handler.load()
+        self.assertEqual(0, len(handler.memories))
+
+        await handler.respond(BasicMessage('test2', user='me', channel_id=0, guild_id=0))
+        async with handler.lock(0):
+            pass
+        # Only the channel that was used is loaded
+        self.assertEqual(['0'], list(handler.memories.keys()))
+        self.assertEqual(['test', 'structured: test', 'test2', 'structured: test2'],
+                         [m.content for m in handler.memory(0).log])
+        handler.save()
+
+    async def test_exact_counts_stored(self):
+        handler = self.make_handler()
+        await handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        # Let the counts come in
+        await asyncio.sleep(0.05)
+        await handler.store.flush()
+        handler.save()
+
+        handler = self.make_handler()
+        await handler.ensure_memory(0)
+        # TestAPI counts a token per character
+        self.assertEqual([(4, False), (16, False)], [(m.tokens, m.estimated) for m in handler.memory(0).log])
+        handler.save()
+
+    async def test_stored_type_kept(self):
+        handler = self.make_handler()
+        handler.memory_factory_lookup = {'window': WindowMemoryFactory(max_messages=4)}
+        await handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        await handler.set_memory_type('window', 0)
+        handler.save()
+
+        handler = self.make_handler()
+        # Never replaced with a default memory when used without ensure_memory()
+        with self.assertRaises(ValueError):
+            handler.memory(0)
+        await handler.ensure_memory(0)
+        self.assertIsInstance(handler.memory(0), WindowMemory)
+        await handler.store.flush()
+        self.assertIsInstance(await handler.store.load(0), WindowMemory)
+        handler.save()
+
+    async def test_snapshot_saves_headers(self):
+        handler = self.make_handler()
+        handler.memory_factory_lookup = {'window': WindowMemoryFactory(max_messages=4)}
+        await handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        await handler.set_memory_type('window', 0)
+        handler.memory(0).max_messages = 6
+        # Only the settings are copied, never the messages
+        with mock.patch.object(Message, 'to_dict', side_effect=AssertionError):
+            self.assertIsNone(await handler.snapshot_memories())
+        self.assertEqual(6, (await handler.store.load(0)).max_messages)
+        handler.save()
+
+    async def test_one_compaction_at_a_time(self):
+        journal = Journal(os.path.join(self.dir.name, 'journal'), compact_after=1)
+        handler = TextHandler(self.api, {}, default_factory=self.mem, config=self.config, journal=journal)
+        release = asyncio.Event()
+
+        async def compact(channel_id, memory):
+            await release.wait()
+
+        with mock.patch.object(journal, 'compact', side_effect=compact) as compact_mock:
+            for content in ['one', 'two']:
+                await handler.respond(BasicMessage(content, user='me', channel_id=0, guild_id=0))
+            self.assertEqual(1, compact_mock.call_count)
+            release.set()
+            await asyncio.sleep(0.01)
+            await handler.respond(BasicMessage('three', user='me', channel_id=0, guild_id=0))
+            self.assertEqual(2, compact_mock.call_count)
+        journal.close()
+
+    async def test_eviction(self):
+        handler = self.make_handler(max_resident=1)
+        await handler.respond(BasicMessage('test', user='me', channel_id=0, guild_id=0))
+        # Kept until its token counts are in
+        handler.memory(2)
+        self.assertEqual(['0', '2'], list(handler.memories.keys()))
+        await asyncio.sleep(0.05)
+        await handler.respond(BasicMessage('other', user='me', channel_id=1, guild_id=0))
+        self.assertEqual(['1'], list(handler.memories.keys()))
+
+        await asyncio.sleep(0.05)
+        await handler.respond(BasicMessage('test2', user='me', channel_id=0, guild_id=0))
+        self.assertEqual(['0'], list(handler.memories.keys()))
+        self.assertEqual(['test', 'structured: test', 'test2', 'structured: test2'],
+                         [m.content for m in handler.memory(0).log])
+        handler.save()
+
+    async def test_lock_waiter_not_evicted(self):
+        handler = self.make_handler(max_resident=1)
+        msg = BasicMessage('test', user='me', channel_id=0, guild_id=0)
+        async with handler.generation(msg):
+            waiter = asyncio.ensure_future(handler.respond(BasicMessage('next', user='me', channel_id=0, guild_id=0)))
+            await asyncio.sleep(0)
+        # The lock is released, but the waiter hasn't woken up yet
+        self.assertFalse(handler.lock(0).locked())
+        handler.memory(1)
+        self.assertIn('0', handler.memories)
+        await waiter
+        handler.save()
+
+    async def test_summarizing_not_evicted(self):
+        handler = self.make_handler(max_resident=1)
+        handler.memory(0)
+        # Like a summary still being written
+        with mock.patch.object(BasicMemory, 'busy', True):
+            handler.memory(1)
+        self.assertIn('0', handler.memories)
+        handler.save()
+
+    async def test_locked_not_evicted(self):
+        handler = self.make_handler(max_resident=1)
+        async with handler.lock(0):
+            handler.memory(1)
+            self.assertEqual(['0', '1'], list(handler.memories.keys()))
+        handler.memory(2)
+        self.assertEqual(['2'], list(handler.memories.keys()))
+        handler.save()
+
 
 if __name__ == '__main__':
     unittest.main()
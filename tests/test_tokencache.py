@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+from tokencache import TokenCountCache
+
+
+class TokenCountCacheTests(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = TokenCountCache()
+        cache.set_model('model')
+        self.assertIsNone(cache.get('User: hi'))
+        cache.put('User: hi', 3)
+        self.assertEqual(3, cache.get('User: hi'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_lru(self):
+        cache = TokenCountCache(max_size=2)
+        cache.set_model('model')
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')  # b is now the least recently used
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_model_change(self):
+        cache = TokenCountCache()
+        cache.set_model('model')
+        cache.put('a', 1)
+        cache.set_model('model')
+        self.assertEqual(1, cache.get('a'))
+        cache.set_model('other model')
+        self.assertEqual(0, len(cache))
+        self.assertIsNone(cache.get('a'))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.txt')
+            cache = TokenCountCache(path=path)
+            cache.set_model('model')
+            cache.put('a', 1)
+            cache.put('b', 2)
+            cache.save()
+
+            loaded = TokenCountCache(max_size=1, path=path)
+            self.assertEqual('model', loaded.model)
+            # Only the most recently used entry fits
+            self.assertEqual(1, len(loaded))
+            self.assertEqual(2, loaded.get('b'))
+
+    def test_missing_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = TokenCountCache(path=os.path.join(directory, 'cache.txt'))
+            self.assertEqual(0, len(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
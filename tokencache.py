@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import typing
+from collections import OrderedDict
+
+
+class TokenCountCache:
+    """
+    A bounded LRU cache of token counts, keyed by a hash of the model ID and the counted text.
+
+    Counts depend on the model's tokenizer, so the whole cache is dropped when the model changes.
+    """
+
+    def __init__(self, max_size: int = 10000, path: str | None = None):
+        """
+        :param max_size: The most counts to keep. The least recently used are dropped first
+        :param path: File to persist the cache to. Loaded right away if it exists
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_size = max_size
+        self.path = path
+        self.model: str | None = None
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict[str, int] = OrderedDict()
+
+        if path is not None:
+            self.load(path)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    @staticmethod
+    def key(model: str | None, text: str) -> str:
+        return hashlib.blake2b(f'{model}\0{text}'.encode(), digest_size=16).hexdigest()
+
+    def set_model(self, model: str) -> None:
+        """
+        Sets the model the counts belong to, clearing the cache if it's a different one
+
+        :param model: The model ID reported by the server
+        """
+        if model != self.model:
+            if self.model is not None:
+                self.logger.info(f'Model changed from {self.model} to {model}, clearing {len(self._counts)} token counts')
+            self._counts.clear()
+            self.model = model
+
+    def get(self, text: str) -> int | None:
+        key = self.key(self.model, text)
+        count = self._counts.get(key)
+        if count is None:
+            self.misses += 1
+            return None
+        self._counts.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def put(self, text: str, count: int) -> None:
+        key = self.key(self.model, text)
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        return {
+            'model': self.model,
+            'counts': list(self._counts.items())  # Least recently used first
+        }
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, 'r') as f:
+                data = json.loads(f.read())
+        except OSError:
+            self.logger.info(f'No token count cache at {path}')
+            return
+        except ValueError as ex:
+            self.logger.error(f'Could not read token count cache: {repr(ex)}')
+            return
+
+        self.model = data['model']
+        self._counts = OrderedDict(data['counts'][-self.max_size:])
+        self.logger.info(f'Loaded {len(self._counts)} token counts for model {self.model}')
+
+    def save(self, path: str | None = None) -> None:
+        path = self.path if path is None else path
+        if path is None:
+            return
+        self.logger.info(f'Saving {len(self._counts)} token counts to {path}')
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.to_dict()))